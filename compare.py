@@ -39,6 +39,7 @@ Functions
 -`kurtosis` -- Calculates the kurtosis for given data sets
 -`bootstrap` -- Get bootstrapped samples from a dataset
 -`'mean_squared_error` -- Calculates the MSE between an obs and pred data set
+-`rad_squared_error` -- Calculates the MSE between an obs and pred rad
 
 
 '''
@@ -88,6 +89,7 @@ class CompareDistribution(object):
 
         # Fit the distributions objects 
         [dist.fit(data_list) for dist in self.dist_list]
+        self._fit_data = data_list
         
         # Set the observed data
         if observed_index == 0 and np.all([type(dt) != type((1,)) for dt in
@@ -99,6 +101,15 @@ class CompareDistribution(object):
         else:
             self.observed_data = [np.array(dt) for dt in data_list]
 
+        # Weighted samples (see distributions.weighted_sample) are split into
+        # values and weights so they are never expanded
+        if np.any([is_weighted(dt) for dt in self.observed_data]):
+            split_data = [split_weighted(dt) for dt in self.observed_data]
+            self.observed_data = [dt[0] for dt in split_data]
+            self.observed_weights = [dt[1] for dt in split_data]
+        else:
+            self.observed_weights = None
+
         # Set this in __init__ so other methods can check if compare_rads() has
         # been called
         self.rads = None
@@ -143,6 +154,11 @@ class CompareDistribution(object):
         -----
         Calculating the mse from the cdf is the least bias approximater
 
+        For weighted observed data, each term of the mse from the cdf is
+        weighted by the number of observations of its value, and each value
+        of the observed rad is compared to the run of predicted values it
+        stands for, giving the mse of the expanded data.
+
         '''
         if mse_base == 'cdf':
             if self.cdfs == None:
@@ -158,12 +174,20 @@ class CompareDistribution(object):
             raise NameError('%s value for mse_base not recognized' % mse_base)
 
 
+        if mse_base == 'cdf' and self.observed_weights is not None:
+            weights = self.observed_weights
+        else:
+            weights = [None] * len(self.observed_data)
+
         mse = {}
         for kw in vals.iterkeys():
             if kw != 'observed':
                 if not np.all([len(j) == 0 for j in vals[kw]]):
-                    mse[kw] = [mean_squared_error(vals['observed'][i], 
-                                   vals[kw][i]) for i in xrange(len(vals[kw]))]
+                    mse[kw] = [rad_squared_error(vals['observed'][i],
+                                   vals[kw][i]) if mse_base == 'rad' else
+                                   mean_squared_error(vals['observed'][i],
+                                   vals[kw][i], weights[i]) for i in
+                                   xrange(len(vals[kw]))]
                 else:
                     logging.warning('MSE values for %s set to NaN' % kw)
                     mse[kw] = [np.NaN for i in xrange(len(self.observed_data))]
@@ -195,10 +219,11 @@ class CompareDistribution(object):
         for dist in self.dist_list:
             
             try:
-                nlls = nll(dist.pmf(self.observed_data))
+                nlls = nll(dist.pmf(self.observed_data), self.observed_weights)
             except NotImplementedError:
                 try:
-                    nlls = nll(dist.pdf(self.observed_data))
+                    nlls = nll(dist.pdf(self.observed_data),
+                                                        self.observed_weights)
                 except NotImplementedError:
                     logging.warning('%s has neither a PMF nor a PDF. AIC set'
                                             % get_name(dist) + ' to infinity')
@@ -207,7 +232,11 @@ class CompareDistribution(object):
             #NOTE: dist.par_num is the number of parameters of distribution
             k = np.repeat(dist.par_num, len(nlls))
             if crt:
-                obs = np.array([len(data) for data in self.observed_data])
+                if self.observed_weights is None:
+                    obs = np.array([len(data) for data in self.observed_data])
+                else:
+                    obs = np.array([np.sum(wts) for wts in
+                                                        self.observed_weights])
                 aic_vals.append(aicc(nlls, k, obs))
             else:
                 aic_vals.append(aic(nlls, k))
@@ -272,10 +301,20 @@ class CompareDistribution(object):
         This method will not overwrite it.  To reset self.rads, set self.rads
         = None and then run self.compare_rads().
 
+        For weighted observed data, the observed rads are weighted samples
+        (see distributions.weighted_sample) with one value for each value of
+        the weighted sample, not for each observation. They are never
+        expanded.
+
         '''
         if self.rads == None:
             rads_dict = {}
-            rads_dict['observed'] = copy.deepcopy(self.observed_data)
+            if self.observed_weights is None:
+                rads_dict['observed'] = copy.deepcopy(self.observed_data)
+            else:
+                rads_dict['observed'] = [weighted_sample(data, wts) for
+                        data, wts in zip(self.observed_data,
+                                                        self.observed_weights)]
             for i, dist in enumerate(self.dist_list):
                 #Different Identifier?
                 rads_dict[get_name(dist)] = dist.rad()
@@ -297,13 +336,22 @@ class CompareDistribution(object):
             contains the predicted cdfs for the empirical data sets for the
             given distribution. 
 
+        Notes
+        -----
+        For weighted observed data, the cdfs have one value for each value of
+        the weighted sample, not for each observation.
 
         '''
         if self.cdfs == None:
 
             cdfs_dict = {}
-            cdfs_dict['observed'] = [empirical_cdf(data) for data in
+            if self.observed_weights is None:
+                cdfs_dict['observed'] = [empirical_cdf(data) for data in
                                                             self.observed_data]
+            else:
+                cdfs_dict['observed'] = [empirical_cdf(data, weights=wts) for
+                                data, wts in zip(self.observed_data,
+                                                        self.observed_weights)]
             for i, dist in enumerate(self.dist_list):
                 try:
                     cdfs_dict[get_name(dist)] = dist.cdf(self.observed_data)
@@ -338,20 +386,26 @@ class CompareDistribution(object):
             likelihood_ratio (chisquared, p-value).  The LRT is performed on
             each data set in self.observed_data for each given model pair.
 
+        Notes
+        -----
+        null_mdl is fit to the same data as the distributions in
+        self.dist_list, so weighted samples are fit with their weights.
+
         '''
         LRT_list = {}
-        null_mdl.fit(self.observed_data)
+        null_mdl.fit(self._fit_data)
 
+        wts = self.observed_weights
         try:
-            null_nlls = nll(null_mdl.pmf(self.observed_data))
+            null_nlls = nll(null_mdl.pmf(self.observed_data), wts)
         except:
-            null_nlls = nll(null_mdl.pdf(self.observed_data))
+            null_nlls = nll(null_mdl.pdf(self.observed_data), wts)
         for i, dist in enumerate(self.dist_list):
             
             try:
-                alt_nlls = nll(dist.pmf(self.observed_data))
+                alt_nlls = nll(dist.pmf(self.observed_data), wts)
             except:
-                alt_nlls = nll(dist.pdf(self.observed_data))
+                alt_nlls = nll(dist.pdf(self.observed_data), wts)
 
             k = dist.par_num - null_mdl.par_num
             df = np.repeat(k, len(alt_nlls))
@@ -401,7 +455,9 @@ class CompareDistribution(object):
         for kw in keys:
             rarity[kw] = {}
             for mins in mins_list:
-                rarity[kw][mins] = [sum(data <= mins) for data in rads[kw]]
+                rarity[kw][mins] = [np.sum(data['weight'][data['value'] <=
+                                    mins]) if is_weighted(data) else
+                                    sum(data <= mins) for data in rads[kw]]
         return rarity
 
     def compare_moments(self):
@@ -501,9 +557,18 @@ class CompareDistribution(object):
         rarity = self.compare_rarity(mins_list=mins_list)
         for kw in rads.iterkeys():
             summary[kw] = {}
-            summary[kw]['balls'] = [np.sum(data) for data in rads[kw]]
-            summary[kw]['urns'] = [len(data) for data in rads[kw]]
-            summary[kw]['max'] = [np.max(data) for data in rads[kw]]
+            if np.any([is_weighted(data) for data in rads[kw]]):
+                split_data = [split_weighted(data) for data in rads[kw]]
+                summary[kw]['balls'] = [np.sum(vals * wts) for vals, wts in
+                                                                split_data]
+                summary[kw]['urns'] = [np.sum(wts) for vals, wts in
+                                                                split_data]
+                summary[kw]['max'] = [np.max(vals[wts > 0]) for vals, wts in
+                                                                split_data]
+            else:
+                summary[kw]['balls'] = [np.sum(data) for data in rads[kw]]
+                summary[kw]['urns'] = [len(data) for data in rads[kw]]
+                summary[kw]['max'] = [np.max(data) for data in rads[kw]]
             summary[kw]['tot_min'] = rarity[kw]
 
         aic_vals = self.compare_aic_measures(crt=crt)
@@ -1083,12 +1148,14 @@ class CompareSAR(object):
             pred_sar.append(psar)
         return pred_sar
 
-def nll(pdist):
+def nll(pdist, weights=None):
     '''
     Parameters
     ----------
     pdist : list of arrays
         List of pmf values on which to compute the negative log-likelihood
+    weights : list of arrays or None
+        If not None, the number of observations for each pmf value in pdist.
 
     Returns
     -------
@@ -1096,18 +1163,22 @@ def nll(pdist):
         List of nll values
 
     '''
-    return [-sum(np.log(dist)) for dist in pdist]
+    if weights is None:
+        return [-sum(np.log(dist)) for dist in pdist]
+    return [-sum(wts * np.log(dist)) for dist, wts in zip(pdist, weights)]
 
     
 
-def empirical_cdf(emp_data):
+def empirical_cdf(emp_data, weights=None):
     '''
     Generates an empirical cdf from empirical data
 
     Parameters
     ----------
     emp_data : array-like object
-        Empirical data 
+        Empirical data or a weighted sample (see distributions.weighted_sample)
+    weights : array-like object or None
+        If not None, the number of observations of each value in emp_data.
 
     Returns
     --------
@@ -1115,16 +1186,20 @@ def empirical_cdf(emp_data):
         An empirical cdf
     '''
 
+    if is_weighted(emp_data):
+        emp_data, weights = split_weighted(emp_data)
     emp_data = cnvrt_to_arrays(emp_data)[0]
-    unq_vals = np.unique(emp_data)
-    leng = len(emp_data)
-    cdf = np.empty(len(emp_data))
-    count = 0
-    for i in unq_vals:
-        loc = np.where((i == emp_data))[0]
-        count += len(loc)
-        cdf[loc] = count / leng
-    return cdf
+    if weights is None:
+        weights = np.ones(len(emp_data))
+    else:
+        weights = cnvrt_to_arrays(weights)[0]
+
+    # Cumulative weight of all values less than or equal to each value
+    order = np.argsort(emp_data, kind='mergesort')
+    sorted_data = emp_data[order]
+    cum_weights = np.cumsum(weights[order])
+    loc = np.searchsorted(sorted_data, emp_data, side='right') - 1
+    return cum_weights[loc] / cum_weights[-1]
 
 def aic(neg_L, k, loglik=True):
     '''
@@ -1277,7 +1352,7 @@ def likelihood_ratio(nll_null, nll_alt, df_list):
     # Calculate G^2 statistic
     ll_null = nll_null * -1; ll_alt = nll_alt * -1
     test_stat = 2 * (ll_null - ll_alt) 
-    return [(ts, stats.chisqprob(ts, df)) for ts, df in zip(test_stat, df_list)]
+    return [(ts, stats.chi2.sf(ts, df)) for ts, df in zip(test_stat, df_list)]
 
 def variance(data_sets):
     '''Calculates the variance of the given data_sets
@@ -1285,13 +1360,19 @@ def variance(data_sets):
     Parameters
     ----------
     data_sets : list
-        A list of np.arrays on which the kurtosis will be calculated
+        A list of np.arrays on which the kurtosis will be calculated. Weighted
+        samples (see distributions.weighted_sample) are treated as if
+        expanded.
 
     '''
 
     variance_list = []
     for data in data_sets:
-        variance_list.append(np.var(data, ddof=1))
+        if is_weighted(data):
+            n, moments = _weighted_moments(data)
+            variance_list.append(moments[0] * n / (n - 1))
+        else:
+            variance_list.append(np.var(data, ddof=1))
 
     return variance_list
 
@@ -1301,7 +1382,9 @@ def skew(data_sets):
     Parameters
     ----------
     data_sets : list
-        A list of np.arrays on which the kurtosis will be calculated
+        A list of np.arrays on which the kurtosis will be calculated. Weighted
+        samples (see distributions.weighted_sample) are treated as if
+        expanded.
 
     Returns
     -------
@@ -1312,7 +1395,11 @@ def skew(data_sets):
 
     skewness_list = []
     for data in data_sets:
-        skewness_list.append(stats.skew(data))
+        if is_weighted(data):
+            m2, m3, m4 = _weighted_moments(data)[1]
+            skewness_list.append(m3 / m2 ** 1.5 if m2 != 0 else 0.)
+        else:
+            skewness_list.append(stats.skew(data))
 
     return skewness_list 
 
@@ -1323,7 +1410,9 @@ def kurtosis(data_sets):
     Parameters
     ----------
     data_sets : list
-        A list of np.arrays on which the kurtosis will be calculated
+        A list of np.arrays on which the kurtosis will be calculated. Weighted
+        samples (see distributions.weighted_sample) are treated as if
+        expanded.
 
     Returns
     -------
@@ -1333,10 +1422,25 @@ def kurtosis(data_sets):
     '''
     kurtosis_list = []
     for data in data_sets:
-        kurtosis_list.append(stats.kurtosis(data))
+        if is_weighted(data):
+            m2, m3, m4 = _weighted_moments(data)[1]
+            kurtosis_list.append((m4 / m2 ** 2 if m2 != 0 else 0.) - 3)
+        else:
+            kurtosis_list.append(stats.kurtosis(data))
 
     return kurtosis_list
 
+def _weighted_moments(data):
+    '''
+    Returns the number of observations of a weighted sample (see
+    distributions.weighted_sample) and its second, third and fourth central
+    moments, as if it were expanded.
+    '''
+    vals, wts = split_weighted(data)
+    n = np.sum(wts)
+    dev = vals - np.sum(wts * vals) / n
+    return n, [np.sum(wts * dev ** k) / n for k in (2, 3, 4)]
+
 def bootstrap(data_sets, num_samp=1000):
     '''Bootstrap a data_set within data_sets num_samp times. With replacement
 
@@ -1432,7 +1536,7 @@ def bootstrap_moment(data1, data2, moment, CI=.95, num_samp=1000):
     
     return stat_dist, ci 
 
-def mean_squared_error(obs, pred):
+def mean_squared_error(obs, pred, weights=None):
     '''
     Calculates the mean squared error between observed and predicted data sets.
     The data sets must be of the same length
@@ -1443,6 +1547,9 @@ def mean_squared_error(obs, pred):
         The observed data
     pred : array-like object
         The predicted data
+    weights : array-like object or None
+        If not None, the number of observations of each value, by which its
+        squared error is weighted
 
     Returns
     -------
@@ -1455,8 +1562,50 @@ def mean_squared_error(obs, pred):
 
     obs, pred = cnvrt_to_arrays(obs, pred)
 
-    return sum((pred - obs)**2) / len(obs)
+    if weights is None:
+        return sum((pred - obs)**2) / len(obs)
+    weights = cnvrt_to_arrays(weights)[0]
+    return sum(weights * (pred - obs)**2) / sum(weights)
+
+
+def rad_squared_error(obs, pred):
+    '''
+    Calculates the mean squared error between an observed rank abundance
+    distribution, which may be a weighted sample (see
+    distributions.weighted_sample), and a predicted one. A weighted sample is
+    compared as if each value were repeated by its weight, without repeating
+    it.
+
+    Parameters
+    ----------
+    obs : array-like object
+        The observed data, plain or weighted
+    pred : array-like object
+        The predicted data, with one value for each observation
+
+    Returns
+    -------
+    : float
+        The mean squared error
+    '''
+
+    if not is_weighted(obs):
+        return mean_squared_error(obs, pred)
+
+    vals, wts = split_weighted(obs)
+    keep = wts > 0
+    vals = vals[keep]
+    wts = wts[keep].astype(int)
+    pred = cnvrt_to_arrays(pred)[0].astype(float)
+    if np.sum(wts) != len(pred):
+        raise ValueError('obs and pred parameters must have the same length')
 
+    # Sums of the predicted values, and their squares, in the run of each
+    # observed value
+    starts = np.cumsum(wts) - wts
+    sum1 = np.add.reduceat(pred, starts)
+    sum2 = np.add.reduceat(pred ** 2, starts)
+    return np.sum(wts * vals ** 2 - 2 * vals * sum1 + sum2) / len(pred)
 
 def cnvrt_to_arrays(*args):
     '''
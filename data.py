@@ -7,14 +7,32 @@ Classes
 -------
 - `DataTable` -- data and metadata for a single censused area
 - `Metadata` -- load and parse EML metadata for data file
+- `Vocabulary` -- integer codes for the values of encoded columns
+
+Functions
+---------
+- `read_csv` -- read csv file into a recarray with a vectorized parser
+- `subset_mask` -- return mask of records of a table meeting subset
+- `csv_names` -- return column names of a csv file as used in tables
+- `csv_to_npy` -- write a csv file to a .npy file in chunks
+- `db_table` -- query a database and return the result as a recarray
+- `parse_value` -- convert metadata text to a number, bool or None
+- `clear_metadata_cache` -- forget parsed metadata files
+- `index_attributes` -- index the attribute elements of a metadata tree
+- `load_cache` -- load a parsed csv table and its metadata from a cache
+- `save_cache` -- save a parsed csv table and its metadata to a cache
+- `compile_sql` -- build a database from an sql script, once
+- `index_columns` -- index columns of the tables of a database
 '''
 
 from __future__ import division
 import os
+import csv
+import json
+import hashlib
 import logging
 import numpy as np
 import xml.etree.ElementTree as etree
-from matplotlib.mlab import csv2rec
 import sqlite3 as lite
 import pandas as pd
 
@@ -27,8 +45,35 @@ class DataTable:
     ----------
     data_path : str
         Path to data - location of metadata determined from this path.
-    subset : str
-        An SQL query string
+    subset : dict or str
+        Dictionary of conditions that records of a csv table must meet (see
+        description in Patch Class docstring), applied while the file is
+        read, or an SQL query string for db and sql files.
+    cache : bool
+        If True, a csv table and its metadata are saved to a binary cache
+        next to the csv file, and are loaded from it without parsing while
+        neither the csv file nor the metadata file has changed. See
+        load_cache. An sql script is built into a database next to it, which
+        is queried until the script changes. See compile_sql.
+    mmap : bool
+        If True, a csv table is written in chunks to the binary cache, and the
+        table is a read-only memory map of the cache file, so tables larger
+        than memory can be used. Implies cache.
+    load : bool
+        If False, the rows of a db or sql query are not loaded and table is
+        None. Only the column names are read, to load the metadata. Used by
+        Patch to compute results inside the database.
+    columns : list
+        Names of the columns to load. Other columns are not parsed or stored,
+        and have no metadata in meta. Columns in a dict subset are always
+        loaded. If None, all columns are loaded.
+    encode : list
+        Names of columns to dictionary-encode, eg, the species column. Each
+        value of these columns is replaced by its integer code in vocabulary.
+    vocabulary : object of class Vocabulary
+        Vocabulary giving the codes of encoded columns, shared with other
+        tables so that codes match between them. If None, a new Vocabulary is
+        used.
 
     Attributes
     ----------
@@ -41,15 +86,54 @@ class DataTable:
     meta : dict
         Dictionary of metadata needed for analysis. Needed variables for each 
         column are defined in asklist 
+    encoded : list
+        Names of the encoded columns of table. Empty if table is None.
+    vocabulary : object of class Vocabulary
+        Vocabulary of the encoded columns, or None if encode is not given.
+
+    Notes
+    -----
+    A memory-mapped table is read from disk only where it is used. Subtables
+    and tables with appended records are ordinary arrays in memory, holding
+    only the selected records. The file holds whole records, so scanning one
+    column of the table still reads the whole file.
+
+    A csv table with a dict subset is read in chunks, and only the records of
+    each chunk meeting subset are kept, so the whole file is never held in
+    memory. A cached or memory-mapped table is cached whole, and subset is
+    applied to it after loading.
+
+    Columns of a csv table are encoded after loading, so subset and the cache
+    hold the values of encoded columns, not their codes. Encoding a
+    memory-mapped table copies it into memory. Columns of a db or sql query
+    are encoded as rows are fetched, so their values are never held as a
+    whole column of strings. Encoded columns are meant for species, to be
+    grouped and matched as small integers. Use decode to get their values.
     '''
 
-    def __init__(self, data_path, subset={}):
+    def __init__(self, data_path, subset={}, cache=False, mmap=False,
+                 load=True, columns=None, encode=None, vocabulary=None):
         '''Initialize DataTable object. See class docstring.'''
 
-        self.table, self.meta = self.data_load(data_path, subset=subset)
+        if encode and vocabulary is None:
+            vocabulary = Vocabulary()
+        self.vocabulary = vocabulary
 
+        self.table, self.meta = self.data_load(data_path, subset=subset,
+                        cache=cache, mmap=mmap, load=load, columns=columns,
+                        encode=encode)
 
-    def data_load(self, data_path, subset={}):
+        self.encoded = []
+        if encode and self.table is not None:
+            self.encoded = [col for col in self.table.dtype.names if col in
+                                                                    encode]
+            # Columns of db and sql queries are encoded as they are fetched
+            if data_path.split('.')[-1] == 'csv':
+                self.table = self._encode(self.table)
+
+
+    def data_load(self, data_path, subset={}, cache=False, mmap=False,
+                  load=True, columns=None, encode=None):
         '''
         Load data and metadata from files.
         
@@ -57,54 +141,150 @@ class DataTable:
         ----------
         data_path : str
             Path to data table file.
+        subset : dict or str
+            Conditions that records of a csv table must meet, or an SQL query
+            string, for db and sql files.
+        cache : bool
+            If True, load a csv table and its metadata from the cache if it is
+            valid, and save them to the cache otherwise. Query an sql script
+            through the database built from it.
+        mmap : bool
+            If True, memory-map a csv table from the cache, saving it to the
+            cache in chunks if needed.
+        load : bool
+            If False, do not load the rows of a db or sql query.
+        columns : list
+            Names of the columns to load, or None to load all columns.
+        encode : list
+            Names of the columns of a db or sql query to encode with
+            vocabulary as rows are fetched.
             
         Returns
         -------
         table : recarray
-            Census data table.
+            Census data table, or None if load is False.
         meta : dict
             Dictionary of metadata associated with table.
         '''
         end = data_path.split('.')[-1]
-        # Check that file is csv. If so, read in as rec array
+        # Check that file is csv. If so, get the column names from its header
         if end == 'csv':
-            table = csv2rec(data_path)
-            # Load main table - dtype detected automatically
-            # Use panda to load and convert to records
-            #table = pd.read_csv(data_path)
-            # Check if there is a column named index, if so rename and delete
-            # it. Why? Index is a special word
-            #if hasattr(table, 'index'):
-            #    table['index_1'] = table['index']
-            #    del table['index']
-
-            #table = table.to_records()
+            if type(subset) != type({}):
+                subset = {}
+            if columns is not None:
+                columns = list(columns) + [col for col in subset if col not
+                                                                in columns]
+            mmap_mode = 'r' if mmap else None
+            if cache or mmap:
+                cached = load_cache(data_path, mmap_mode=mmap_mode,
+                                    columns=columns)
+                if cached is not None:
+                    table, meta = cached
+                    self.asklist = _asklist(table.dtype.names)
+                    return self.get_subtable(subset, table=table), meta
+            names = _used_names(data_path, csv_names(data_path), columns)
 
         elif end == 'db' or end == 'sql':
 
             if type(subset) == type({}):
                 raise ValueError('No SQL query string provided')
 
-            table = db_table(data_path, subset)
+            if columns is not None:
+                subset = 'SELECT %s FROM (%s)' % (', '.join(_sql_name(col) for
+                            col in columns), subset.strip().rstrip(';'))
+
+            if load:
+                table = db_table(data_path, subset, cache=cache,
+                                 encode=encode, vocabulary=self.vocabulary)
+                names = table.dtype.names
+            else:
+                table = None
+                names = db_table(data_path, 'SELECT * FROM (%s) LIMIT 1' %
+                        subset.strip().rstrip(';'), cache=cache).dtype.names
         else:
             raise TypeError('Cannot handle file of type %s' % end)
 
         # Store asklist defining columns and fields needed for analysis.
-        # asklist is
-        self.asklist = []
-        for name in table.dtype.names:
-            self.asklist.append((name, 'minimum'))
-            self.asklist.append((name, 'maximum'))
-            self.asklist.append((name, 'precision'))
-            self.asklist.append((name, 'type'))  
+        self.asklist = _asklist(names)
         
         # Load metadata from file
-        meta = Metadata(data_path, self.asklist).meta_dict
+        metadata = Metadata(data_path, self.asklist)
+        meta = metadata.meta_dict
+
+        # Load csv table, with the types of columns given by the metadata
+        if end == 'csv':
+            if metadata.valid_file:
+                dtypes = metadata.get_dtypes(names)
+            else:
+                dtypes = {}
+            if mmap:
+                save_cache(data_path, None, meta, dtypes=dtypes,
+                           columns=columns)
+                cached = load_cache(data_path, mmap_mode=mmap_mode,
+                                    columns=columns)
+                if cached is None:
+                    raise IOError('Cannot write memory-mapped table for %s' %
+                                                                    data_path)
+                table = self.get_subtable(subset, table=cached[0])
+            elif cache:
+                table = read_csv(data_path, dtypes=dtypes, columns=names)
+                save_cache(data_path, table, meta, columns=columns)
+                table = self.get_subtable(subset, table=table)
+            else:
+                table = read_csv(data_path, dtypes=dtypes, columns=names,
+                                 subset=subset)
 
         return table, meta
 
 
-    def get_subtable(self, subset):
+    def append(self, new_data, subset={}):
+        '''
+        Append records to the end of the table.
+
+        Parameters
+        ----------
+        new_data : str or ndarray
+            Path to a csv file or a structured array holding the new records.
+            Must have the columns of the table. Other columns are dropped.
+        subset : dict
+            Dictionary of conditions that new records must meet to be
+            appended (see description in Patch Class docstring).
+
+        Returns
+        -------
+        rows : recarray
+            The records that were appended, as they appear in the new table.
+
+        Notes
+        -----
+        The type of each column is promoted as needed to hold the new records
+        (eg, a longer string or a float count), so the table is replaced by a
+        new recarray.
+        '''
+
+        names = self.table.dtype.names
+        if type(new_data) == str:
+            new_data = read_csv(new_data, columns=[name for name in names if
+                                    name in csv_names(new_data)])
+        new_data = np.asarray(new_data)
+
+        if not set(names) <= set(new_data.dtype.names):
+            raise ValueError('New records must have columns %s' % str(names))
+        new_data = self._encode(self.get_subtable(subset, table=new_data))
+
+        old_len = len(self.table)
+        dtype = [(name, np.promote_types(self.table.dtype[name],
+                                    new_data.dtype[name])) for name in names]
+        table = np.empty(old_len + len(new_data), dtype=dtype)
+        for name in names:
+            table[name][:old_len] = self.table[name]
+            table[name][old_len:] = new_data[name]
+
+        self.table = table.view(np.recarray)
+        return self.table[old_len:]
+
+
+    def get_subtable(self, subset, table=None):
         '''
         Return subtable matching all conditions in subset.
 
@@ -113,6 +293,8 @@ class DataTable:
         subset : dict
             Dictionary of conditions for subsetting data (see description in 
             Patch Class docstring).
+        table : ndarray
+            Table to subset. If None, the data table is used.
 
         Returns
         -------
@@ -121,35 +303,129 @@ class DataTable:
 
         '''
 
+        if table is None:
+            table = self.table
+
         # If no subset, return original table
         if subset == {}:
-            return self.table
+            return table
         
-        # Declare array to track valid rows of table
-        valid = np.ones(len(self.table), dtype=bool)
-
-        # TODO: Add ability to do logical or - and is just multiple subsets on 
-        # same column.
-        for key, value in subset.iteritems():
-            if type(value) is not type(['a']):  # Make all iterables
-                value = [value]
-            
-            # Merge tuples into a string
-            merged_values = []
-            for val in value:
-                try: # check if val[1] is a string
-                    eval(str(val[1]))
-                    merged_values.append(val[0] + str(val[1]))
-                except:
-                    merged_values.append(val[0]  + "'" +  val[1] + "'")
-                    
-            for this_value in merged_values:
-                if this_value != "=='whole'":
-                    this_valid = eval("self.table[key]" + this_value)
-                    valid = np.logical_and(valid, this_valid)
-
-        subtable = self.table[valid]
-        return subtable
+        return table[subset_mask(table, subset)]
+
+    def _encode(self, table):
+        '''Returns table with the values of encoded columns replaced by codes.'''
+
+        if not self.encoded:
+            return table
+        names = [name for name in table.dtype.names if name in
+                                    self.table.dtype.names]
+        columns = [self.vocabulary.encode(table[name]) if name in self.encoded
+                   else table[name] for name in names]
+        return np.rec.fromarrays(columns, names=names)
+
+    def decode(self, col, values):
+        '''
+        Return the values of codes of column col.
+
+        Parameters
+        ----------
+        col : str
+            Name of a column of the table.
+        values : ndarray
+            Values of col in the table, eg, a slice of the column.
+
+        Returns
+        -------
+        : ndarray
+            The values given by the codes, if col is encoded, or values.
+        '''
+
+        if col in self.encoded:
+            return self.vocabulary.decode(values)
+        return values
+
+
+class Vocabulary:
+    '''
+    Integer codes for the values of dictionary-encoded columns.
+
+    Parameters
+    ----------
+    values : list
+        Values to give the first codes, in order.
+
+    Attributes
+    ----------
+    values : list
+        The value of each code, in order of code.
+    codes : dict
+        Dictionary looking up the code of each value.
+
+    Notes
+    -----
+    Codes are given to new values in the order they are first encoded, and
+    never change, so tables encoded with one Vocabulary have the same code
+    for the same value. Values are compared as Python values, so the string
+    '1' and the integer 1 get different codes. Codes are not ordered like
+    their values.
+    '''
+
+    def __init__(self, values=[]):
+        '''Initialize Vocabulary object. See class docstring.'''
+
+        self.values = []
+        self.codes = {}
+        self._array = None
+        self.encode(values)
+
+    def __len__(self):
+        return len(self.values)
+
+    def encode(self, values):
+        '''
+        Return the codes of values, giving new codes to new values.
+
+        Parameters
+        ----------
+        values : ndarray
+            1D array of values.
+
+        Returns
+        -------
+        : ndarray
+            Array of int32 codes, one for each value.
+        '''
+
+        uniq, inverse = np.unique(np.asarray(values), return_inverse=True)
+        uniq_codes = np.empty(len(uniq), dtype=np.int32)
+        for i, value in enumerate(uniq.tolist()):
+            code = self.codes.get(value)
+            if code is None:
+                code = len(self.values)
+                self.codes[value] = code
+                self.values.append(value)
+                self._array = None
+            uniq_codes[i] = code
+        return uniq_codes[inverse]
+
+    def decode(self, codes):
+        '''
+        Return the values of codes.
+
+        Parameters
+        ----------
+        codes : ndarray
+            Array of codes given by encode.
+
+        Returns
+        -------
+        : ndarray
+            Array of the value of each code.
+        '''
+
+        if self._array is None:
+            self._array = np.array(self.values)
+        return self._array[np.asarray(codes, dtype=int)]
 
 
 class Metadata:
@@ -168,9 +444,20 @@ class Metadata:
         Whether valid metadata file was found.
     root : object
         Root of Element Tree representation of metadata xml file.
+    index : dict
+        Dictionary of the metadata of each column, {'column_name':
+        {'element': attribute element, 'type': type, 'minimum': value, ...}}.
+        Values, typed as by parse_value, are added as they are first asked
+        for (see get_value).
     meta_dict : dict
         Dictionary of metadata with values given by asklist.
 
+    Notes
+    -----
+    The metadata file is parsed and indexed by column once, and the result is
+    shared by all Metadata objects for the file until it changes (in size or
+    modification time) or clear_metadata_cache is called.
+
     '''
 
     def __init__(self, data_path, asklist):
@@ -184,20 +471,19 @@ class Metadata:
         self.valid_file = True
 
         try:
-            open(xml_path)
-        except:
+            self.root, self.index = _parse_metadata(xml_path)
+        except (IOError, OSError):
             logging.info('Missing or invalid metadata file at %s' % xml_path)
+            self.root = None
             self.valid_file = False
-        
-        try:
-            self.root = etree.ElementTree(file=xml_path).getroot()
-        except:
+        except etree.ParseError:
             logging.info('Error parsing metadata file at %s' % xml_path)
             self.root = None
             self.valid_file = False
         
         # Check if metadata file is missing or invalid, if so return None
         if self.valid_file == False:
+            self.index = {}
             self.meta_dict = None
         else:
             self.meta_dict = self.get_meta_dict(asklist)
@@ -230,64 +516,72 @@ class Metadata:
         meta_dict = {}
 
         for item in asklist:
-            # Get list of all elements for this attribute
-            all_elements = self.get_all_elements(item[0])
+            meta_dict[item] = self.get_value(item[0], item[1])
 
-            # Get value of element for this attribute if it exists
-            if all_elements is None:
-                value = None
-            else:
-                value = self.get_element_value(all_elements, item[1], item[0])
-            
-            # Eval value if possible and log outcome
-            try:
-                value = eval(value)
-                value_type = str(type(value)).split("'")[1]
-                logging.debug('Metadata value %s, %s evaluated to %s' % 
-                              (item[0], item[1], value_type))
-            except:
-                logging.debug('Metadata value %s, %s left as string' % 
-                              (item[0], item[1]))
+        return meta_dict
 
-            # Store value for this item
-            meta_dict[item] = value
 
-        return meta_dict
+    def get_value(self, column_name, element_name):
+        '''
+        Returns the value of element_name of a column, typed as by
+        parse_value, or None if the column is not in the metadata. The value
+        is found in the attribute element of the column the first time it is
+        asked for, and kept in the shared index.
+        '''
+        column = self.index.get(column_name)
+        if column is None:
+            return None
+        if element_name not in column:
+            column[element_name] = parse_value(self.get_element_value(
+                                column['element'], element_name, column_name))
+        return column[element_name]
 
 
     def get_all_elements(self, attribute):
         '''Returns list of XML elements of type attribute for attribute.'''
-
-        attributes = self.root.findall('.//dataTable/attributeList/attribute')
-        for a in attributes:
-            if a.find('.//attributeName').text == attribute:
-                return a
+        column = self.index.get(attribute)
+        if column is not None:
+            return column['element']
 
 
     def get_element_value(self, all_elements, element_name, col_name):
         '''Returns value of attribute_name from all_attributes list.'''
-        if element_name == 'type':
-            if len(all_elements.findall('.//dateTime')) == 1:
-                return 'ordinal'
-            elif len(all_elements.findall('.//interval')) == 1:
-                return 'interval'
-            elif len(all_elements.findall('.//ordinal')) == 1:
-                return 'ordinal'
-            elif len(all_elements.findall('.//nominal')) == 1:
-                return 'nominal'
-            elif len(all_elements.findall('.//ratio')) == 1:
-                return 'ratio'
-            else:
-                logging.warning("Could not find recognizable column type. " +\
-                             "Setting type of column name '%s' to ordinal." %\
-                             col_name)
-                return 'ordinal'
-        else:
-            try:
-                value = all_elements.find('.//%s' % element_name).text
-                return value
-            except AttributeError:
-                return None
+        return _element_value(all_elements, element_name, col_name)
+
+
+    def get_dtypes(self, columns):
+        '''
+        Returns a dictionary of the numpy type of each column in columns
+        whose type is fixed by the metadata.
+
+        Notes
+        -----
+        Nominal columns are strings. Interval and ratio columns with a
+        positive precision are integers if the precision is a whole number and
+        floats otherwise. Other columns (eg, ordinal, which is also the
+        default type written by MetaWriter) are left out, and their types are
+        found by the csv parser.
+        '''
+
+        dtypes = {}
+        for col in columns:
+            if col not in self.index:
+                continue
+
+            col_type = self.get_value(col, 'type')
+            if col_type == 'nominal':
+                dtypes[col] = str
+            elif col_type in ('interval', 'ratio'):
+                try:
+                    prec = float(self.get_value(col, 'precision'))
+                except (TypeError, ValueError):
+                    continue
+                if prec > 0 and prec == int(prec):
+                    dtypes[col] = np.int64
+                elif prec > 0:
+                    dtypes[col] = np.float64
+
+        return dtypes
 
 
     def get_physical_coverage(self):
@@ -304,7 +598,735 @@ class Metadata:
         '''Extracts the title of the dataset. Not currently used.'''
         return self.root.find('.//dataset/title').text
 
-def db_table(data_path, query_str):
+# Parsed metadata files, by path, with the size and modification time parsed
+_META_CACHE = {}
+
+
+def _parse_metadata(xml_path):
+    '''
+    Returns the root of the metadata file at xml_path and the index of its
+    columns (see Metadata), parsing the file only if it is not cached.
+    '''
+
+    stat = os.stat(xml_path)
+    key = (stat.st_size, stat.st_mtime)
+    cached = _META_CACHE.get(xml_path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    root = etree.ElementTree(file=xml_path).getroot()
+    index = index_attributes(root)
+
+    _META_CACHE[xml_path] = (key, (root, index))
+    return root, index
+
+
+def index_attributes(root):
+    '''
+    Returns a dictionary of the attribute element of each column in the
+    metadata tree root, {'column_name': {'element': attribute element}}. The
+    first attribute of a name is used.
+    '''
+
+    index = {}
+    for element in root.iterfind('.//dataTable/attributeList/attribute'):
+        name = element.find('.//attributeName').text
+        if name not in index:
+            index[name] = {'element': element}
+    return index
+
+
+def _element_value(all_elements, element_name, col_name):
+    '''Returns value of element_name in the attribute element of a column.'''
+    if element_name == 'type':
+        if len(all_elements.findall('.//dateTime')) == 1:
+            return 'ordinal'
+        elif len(all_elements.findall('.//interval')) == 1:
+            return 'interval'
+        elif len(all_elements.findall('.//ordinal')) == 1:
+            return 'ordinal'
+        elif len(all_elements.findall('.//nominal')) == 1:
+            return 'nominal'
+        elif len(all_elements.findall('.//ratio')) == 1:
+            return 'ratio'
+        else:
+            logging.warning("Could not find recognizable column type. " +\
+                         "Setting type of column name '%s' to ordinal." %\
+                         col_name)
+            return 'ordinal'
+    else:
+        try:
+            value = all_elements.find('.//%s' % element_name).text
+            return value
+        except AttributeError:
+            return None
+
+
+def clear_metadata_cache(xml_path=None):
+    '''
+    Clears the parsed metadata of the file at xml_path, or of all files if
+    xml_path is None, so they are parsed again when next used.
+    '''
+
+    if xml_path is None:
+        _META_CACHE.clear()
+    else:
+        _META_CACHE.pop(os.path.abspath(xml_path), None)
+
+
+def parse_value(text):
+    '''
+    Returns metadata text as an int, float, bool or None if it is written as
+    one, and as a string otherwise.
+    '''
+
+    if text is None:
+        return None
+    text = text.strip()
+    for convert in (int, float):
+        try:
+            return convert(text)
+        except ValueError:
+            pass
+    return {'None': None, 'True': True, 'False': False}.get(text, text)
+
+
+# Characters removed from column names, as by matplotlib.mlab.csv2rec
+_DELETE_CHARS = set(r"""~!@#$%^&*()-=+~\|}[]{';: /?.>,<""" + '"')
+_RESERVED_NAMES = {'return': 'return_', 'file': 'file_', 'print': 'print_'}
+
+
+def csv_names(data_path):
+    '''
+    Returns the names of the columns of a csv file as they appear in tables.
+
+    Names are stripped, lower case, have spaces replaced by underscores and
+    other punctuation removed, and repeated names are numbered, as by
+    matplotlib.mlab.csv2rec.
+    '''
+
+    with open(data_path, 'rU') as f:
+        headers = next(csv.reader(f))
+
+    names = []
+    seen = {}
+    for i, item in enumerate(headers):
+        item = item.strip().lower().replace(' ', '_')
+        item = ''.join([c for c in item if c not in _DELETE_CHARS])
+        if not len(item):
+            item = 'column%d' % i
+        item = _RESERVED_NAMES.get(item, item)
+        if seen.get(item, 0) > 0:
+            names.append(item + '_%d' % seen[item])
+        else:
+            names.append(item)
+        seen[item] = seen.get(item, 0) + 1
+
+    return names
+
+
+def read_csv(data_path, dtypes={}, columns=None, subset={},
+             chunksize=2**16):
+    '''
+    Read a csv file into a recarray.
+
+    Parameters
+    ----------
+    data_path : str
+        Path to csv file with a header row.
+    dtypes : dict
+        Dictionary of numpy types of columns, by name as given by csv_names.
+        The types of other columns are found by the parser.
+    columns : list
+        Names of the columns to read, as given by csv_names. Other columns are
+        skipped by the parser. If None, all columns are read.
+    subset : dict
+        Dictionary of conditions that records must meet to be kept (see
+        description in Patch Class docstring), on columns that are read.
+    chunksize : int
+        Number of rows parsed at a time if subset is given.
+
+    Returns
+    -------
+    table : recarray
+        Table with one field for each column. Text columns are strings.
+
+    Notes
+    -----
+    The file is parsed by the C parser of pandas, which converts whole
+    columns at once. It gives the same tables as matplotlib.mlab.csv2rec
+    (except that dates are left as strings and lines starting with '#' are
+    not skipped), which parses and guesses the type of each value in
+    Python. If a column cannot be read as the type
+    given in dtypes, its type is found by the parser instead. Columns of the
+    table are in the order of the file.
+
+    If subset is given, the file is read in chunks of chunksize rows and only
+    the records of each chunk meeting subset are kept, so at most one chunk
+    of the whole file is held in memory. The file is first scanned for the
+    type of each column, so the table is the subset of the table read at
+    once, even if a column has only numbers in some chunks.
+    '''
+
+    names = csv_names(data_path)
+    used = _used_names(data_path, names, columns)
+    missing = [col for col in subset if col not in used]
+    if missing:
+        raise ValueError('Subset columns %s are not read from %s' % (missing,
+                                                                data_path))
+    dtypes = dict((col, dtypes[col]) for col in used if col in dtypes)
+    try:
+        arrays = _read_arrays(data_path, names, dtypes, used, subset,
+                              chunksize)
+    except (TypeError, ValueError):
+        logging.warning('Column types in metadata do not match data in %s' %
+                                                                    data_path)
+        dtypes = {}
+        arrays = _read_arrays(data_path, names, dtypes, used, subset,
+                              chunksize)
+
+    return np.rec.fromarrays(arrays, names=used)
+
+
+def subset_mask(table, subset):
+    '''
+    Return mask of the records of a table meeting all conditions in subset.
+
+    Parameters
+    ----------
+    table : ndarray
+        Structured array with the columns in subset.
+    subset : dict
+        Dictionary of conditions for subsetting data (see description in 
+        Patch Class docstring).
+
+    Returns
+    -------
+    valid : ndarray
+        Boolean array, True for the records of table meeting subset.
+    '''
+
+    # Declare array to track valid rows of table
+    valid = np.ones(len(table), dtype=bool)
+
+    # TODO: Add ability to do logical or - and is just multiple subsets on 
+    # same column.
+    for key, value in subset.iteritems():
+        if type(value) is not type(['a']):  # Make all iterables
+            value = [value]
+        
+        # Merge tuples into a string
+        merged_values = []
+        for val in value:
+            try: # check if val[1] is a string
+                eval(str(val[1]))
+                merged_values.append(val[0] + str(val[1]))
+            except:
+                merged_values.append(val[0]  + "'" +  val[1] + "'")
+                
+        for this_value in merged_values:
+            if this_value != "=='whole'":
+                this_valid = eval("table[key]" + this_value)
+                valid = np.logical_and(valid, this_valid)
+
+    return valid
+
+
+def csv_to_npy(data_path, npy_path, dtypes={}, chunksize=2**16,
+               columns=None):
+    '''
+    Write a csv file to a .npy file of fixed-width records, in chunks.
+
+    Parameters
+    ----------
+    data_path : str
+        Path to csv file with a header row.
+    npy_path : str
+        Path of .npy file to write.
+    dtypes : dict
+        Dictionary of numpy types of columns, as in read_csv.
+    chunksize : int
+        Number of rows parsed at a time.
+    columns : list
+        Names of the columns to write, as in read_csv.
+
+    Notes
+    -----
+    The table written is the table given by read_csv, but at most chunksize
+    rows are held in memory at once, so the csv file may be larger than
+    memory. The file is read twice, once to find the number of rows and the
+    type of each column (eg, the longest string), and once to write the
+    records to the .npy file through a memory map. The .npy file can then be
+    opened with np.load(npy_path, mmap_mode='r').
+    '''
+
+    names = csv_names(data_path)
+    used = _used_names(data_path, names, columns)
+    dtypes = dict((col, dtypes[col]) for col in used if col in dtypes)
+
+    # Find column types, promoted over all chunks
+    try:
+        n_rows, dtype, dtypes = _scan_frames(data_path, names, dtypes,
+                                             chunksize, used)
+    except (TypeError, ValueError):
+        logging.warning('Column types in metadata do not match data in %s' %
+                                                                    data_path)
+        dtypes = {}
+        n_rows, dtype, dtypes = _scan_frames(data_path, names, dtypes,
+                                             chunksize, used)
+
+    out = np.lib.format.open_memmap(npy_path, mode='w+', dtype=dtype,
+                                    shape=(n_rows,))
+    start = 0
+    for frame in _read_frame(data_path, names, dtypes, chunksize, used):
+        stop = start + len(frame)
+        for name, column in zip(used, _frame_arrays(frame, dtypes)):
+            out[name][start:stop] = column
+        start = stop
+    out.flush()
+    del out
+
+
+def _used_names(data_path, names, columns):
+    '''Returns the names of the csv file in columns, in the order of names.'''
+
+    if columns is None:
+        return list(names)
+    missing = [col for col in columns if col not in names]
+    if missing:
+        raise ValueError('Columns %s not found in %s' % (missing, data_path))
+    return [name for name in names if name in columns]
+
+
+def _read_frame(data_path, names, dtypes, chunksize=None, usecols=None):
+    '''Returns data frame, or iterator of chunks, of columns of csv file.'''
+
+    return pd.read_csv(data_path, header=None, skiprows=1, names=names,
+                       usecols=usecols, dtype=dtypes or None, engine='c',
+                       float_precision='round_trip', chunksize=chunksize)
+
+
+def _read_arrays(data_path, names, dtypes, usecols, subset, chunksize):
+    '''Returns list of arrays of the columns of records meeting subset.'''
+
+    if subset:
+        # Types of the whole file, so columns are read as by a single read
+        n_rows, dtype, dtypes = _scan_frames(data_path, names, dtypes,
+                                             chunksize, usecols)
+        kept = []
+        for frame in _read_frame(data_path, names, dtypes, chunksize, usecols):
+            chunk = np.rec.fromarrays(_frame_arrays(frame, dtypes),
+                                      names=usecols)
+            kept.append(chunk[subset_mask(chunk, subset)])
+        if kept:
+            return [np.concatenate([chunk[name] for chunk in kept]).astype(
+                                        dtype[name]) for name in usecols]
+
+    frame = _read_frame(data_path, names, dtypes, usecols=usecols)
+    return _frame_arrays(frame, dtypes)
+
+
+def _scan_frames(data_path, names, dtypes, chunksize, usecols):
+    '''
+    Returns number of rows, record dtype and dtypes to read csv file in
+    chunks. A column read as text in some chunks but not in others (eg,
+    codes 007 and a3) is read as text in all chunks, as by a single read.
+    '''
+
+    n_rows = 0
+    types = None
+    kinds = [set() for col in usecols]
+    for frame in _read_frame(data_path, names, dtypes, chunksize, usecols):
+        n_rows += len(frame)
+        chunk_types = [column.dtype for column in _frame_arrays(frame, dtypes)]
+        for kind, chunk_type in zip(kinds, chunk_types):
+            kind.add(chunk_type.kind)
+        if types is None:
+            types = chunk_types
+        else:
+            types = [np.promote_types(a, b) for a, b in zip(types,
+                                                            chunk_types)]
+    if types is None:
+        frame = _read_frame(data_path, names, dtypes, usecols=usecols)
+        types = [column.dtype for column in _frame_arrays(frame, dtypes)]
+
+    mixed = [col for col, kind in zip(usecols, kinds) if len(kind) > 1 and
+                                                    not kind <= set('iuf')]
+    if mixed:
+        dtypes = dict(dtypes)
+        dtypes.update((col, str) for col in mixed)
+        return _scan_frames(data_path, names, dtypes, chunksize, usecols)
+    return n_rows, np.dtype(zip(usecols, types)), dtypes
+
+
+def _frame_arrays(frame, dtypes):
+    '''Returns list of arrays of columns of data frame read from csv.'''
+
+    arrays = []
+    for name in frame.columns:
+        column = frame[name]
+
+        # The exact float parser does not skip spaces before numbers
+        if column.dtype == object and name not in dtypes:
+            try:
+                column = column.str.strip().astype(float)
+            except (TypeError, ValueError):
+                pass
+
+        if column.dtype == object:
+            column = column.fillna('').values.astype(str)
+        else:
+            column = column.values
+        arrays.append(column)
+    return arrays
+
+
+def _asklist(names):
+    '''Returns the asklist of metadata attributes needed for columns names.'''
+
+    asklist = []
+    for name in names:
+        asklist.append((name, 'minimum'))
+        asklist.append((name, 'maximum'))
+        asklist.append((name, 'precision'))
+        asklist.append((name, 'type'))
+    return asklist
+
+
+# Version of the cache format, changed when cached tables would differ
+_CACHE_VERSION = 1
+
+
+def _cache_paths(data_path):
+    '''Returns paths of the cached table and of its description.'''
+
+    return data_path + '.cache.npy', data_path + '.cache.json'
+
+
+def _source_paths(data_path):
+    '''Returns paths of the csv file and of its metadata file.'''
+
+    return [data_path, os.path.splitext(data_path)[0] + '.xml']
+
+
+def _md5(path, block_size=2**20):
+    '''Returns the md5 hex digest of the contents of file at path.'''
+
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _stamp(path):
+    '''Returns dict of size, mtime and md5 of file at path, or None.'''
+
+    try:
+        stat = os.stat(path)
+        return {'size': stat.st_size, 'mtime': stat.st_mtime,
+                'md5': _md5(path)}
+    except (IOError, OSError):
+        return None
+
+
+def _check_stamp(path, stamp):
+    '''
+    Returns whether file at path is the file described by stamp (made by
+    _stamp), and whether only its modification time differs, in which case
+    stamp is updated to the new time.
+    '''
+
+    try:
+        stat = os.stat(path)
+    except (IOError, OSError):
+        stat = None
+    if stat is None or stamp is None:
+        return stat is None and stamp is None, False
+    if stat.st_size != stamp['size']:
+        return False, False
+    if stat.st_mtime != stamp['mtime']:
+        if _md5(path) != stamp['md5']:
+            return False, False
+        stamp['mtime'] = stat.st_mtime
+        return True, True
+    return True, False
+
+
+def load_cache(data_path, mmap_mode=None, columns=None):
+    '''
+    Load a csv table and its metadata from the cache saved by save_cache.
+
+    Parameters
+    ----------
+    data_path : str
+        Path to csv file.
+    mmap_mode : str
+        If not None, the table is memory-mapped with this mode (see np.load),
+        and is read from disk only where it is used.
+    columns : list
+        Names of the columns needed. If None, all columns of the csv file
+        are needed.
+
+    Returns
+    -------
+    cached : tuple or None
+        Tuple of table (recarray) and meta (dict or None), as given by
+        DataTable.data_load, or None if there is no valid cache.
+
+    Notes
+    -----
+    The cache is valid while the csv file and the metadata file (or its
+    absence) are the same as when the cache was saved. A file with the same
+    size and modification time is taken to be unchanged. A file with the same
+    size but a new modification time is hashed, and the cache is kept if the
+    contents are the same. The table is loaded from a .npy file, so no text is
+    parsed. A cache of some columns of the csv file is only valid if it holds
+    all columns needed, and the table then holds only the columns needed.
+    '''
+
+    npy_path, json_path = _cache_paths(data_path)
+    try:
+        with open(json_path) as f:
+            info = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if info.get('version') != _CACHE_VERSION:
+        return None
+    cached_cols = info.get('columns')
+    if cached_cols is not None and (columns is None or not
+                                        set(columns) <= set(cached_cols)):
+        return None
+
+    # Check that the sources are unchanged, hashing only if touched
+    touched = False
+    for path, stamp in zip(_source_paths(data_path), info['sources']):
+        valid, this_touched = _check_stamp(path, stamp)
+        if not valid:
+            return None
+        touched = touched or this_touched
+
+    try:
+        table = np.load(npy_path, mmap_mode=mmap_mode, allow_pickle=False)
+    except (IOError, OSError, ValueError):
+        return None
+
+    if columns is not None and set(table.dtype.names) - set(columns):
+        table = table[[name for name in table.dtype.names if name in
+                                                                    columns]]
+
+    if info['meta'] is None:
+        meta = None
+    else:
+        meta = dict(((str(col), str(attr)), _unjson(value)) for col, attr,
+                        value in info['meta'] if col in table.dtype.names)
+
+    # Store new modification times so later loads do not hash again
+    if touched:
+        _write_atomic(json_path, lambda path: _write_text(path,
+                                                          json.dumps(info)))
+
+    logging.info('Loaded cached table for %s' % data_path)
+    return table.view(np.recarray), meta
+
+
+def _unjson(value):
+    '''Returns value read from json, with unicode strings as str.'''
+
+    if isinstance(value, unicode):
+        return str(value)
+    return value
+
+
+def save_cache(data_path, table, meta, dtypes={}, columns=None):
+    '''
+    Save a csv table and its metadata to a cache next to the csv file.
+
+    Parameters
+    ----------
+    data_path : str
+        Path to csv file.
+    table : recarray or None
+        Table parsed from csv file. If None, the csv file is written to the
+        cache in chunks by csv_to_npy, without holding the table in memory.
+    meta : dict or None
+        Metadata of table, in form {('column_name', 'element'): value}.
+    dtypes : dict
+        Dictionary of numpy types of columns, used if table is None.
+    columns : list
+        Names of the columns of the csv file in the table, or None if it
+        holds all columns.
+
+    Notes
+    -----
+    The table is saved to data_path + '.cache.npy', and the metadata with the
+    size, modification time and md5 hash of the csv and metadata files to
+    data_path + '.cache.json'. If the cache cannot be written, as in a
+    read-only directory, a warning is logged and no cache is saved.
+    '''
+
+    npy_path, json_path = _cache_paths(data_path)
+    info = {'version': _CACHE_VERSION,
+            'sources': [_stamp(path) for path in _source_paths(data_path)],
+            'columns': None if columns is None else list(columns)}
+    if meta is None:
+        info['meta'] = None
+    else:
+        info['meta'] = [[col, attr, value] for (col, attr), value in
+                                                            meta.iteritems()]
+
+    try:
+        text = json.dumps(info)
+    except (TypeError, ValueError):
+        logging.warning('Cannot cache metadata of %s' % data_path)
+        return
+
+    # Remove description first, so a partly written cache is never valid
+    try:
+        if os.path.exists(json_path):
+            os.remove(json_path)
+    except OSError:
+        pass
+    if table is None:
+        write = lambda path: csv_to_npy(data_path, path, dtypes=dtypes,
+                                        columns=columns)
+    else:
+        write = lambda path: np.save(path, np.asarray(table),
+                                     allow_pickle=False)
+    if _write_atomic(npy_path, write):
+        _write_atomic(json_path, lambda path: _write_text(path, text))
+
+
+def _write_text(path, text):
+    '''Writes string text to file at path.'''
+
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+def _write_atomic(path, write):
+    '''Writes file at path with write(path), replacing it in one step.'''
+
+    root, ext = os.path.splitext(path)
+    tmp_path = '%s.%d.tmp%s' % (root, os.getpid(), ext)
+    try:
+        write(tmp_path)
+        os.rename(tmp_path, path)
+        return True
+    except (IOError, OSError, ValueError, lite.Error):
+        logging.warning('Cannot write cache file %s' % path)
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return False
+
+
+def compile_sql(data_path):
+    '''
+    Build a database from an sql script, if not built already.
+
+    Parameters
+    ----------
+    data_path : str
+        Path to sql script.
+
+    Returns
+    -------
+    db_path : str or None
+        Path to the database, or None if it cannot be written.
+
+    Notes
+    -----
+    The database is data_path + '.cache.db'. It holds the size, modification
+    time and md5 hash of the script in the table macroeco_source, and is
+    rebuilt only when the script changes (see load_cache). Indexes made by
+    index_columns are kept until then.
+    '''
+
+    db_path = data_path + '.cache.db'
+    stamp = None
+    if os.path.exists(db_path):
+        try:
+            con = lite.connect(db_path)
+            try:
+                row = con.execute('SELECT size, mtime, md5 FROM '
+                                  'macroeco_source').fetchone()
+            finally:
+                con.close()
+            stamp = {'size': row[0], 'mtime': row[1], 'md5': str(row[2])}
+        except (lite.Error, TypeError):
+            pass
+
+    if stamp is not None:
+        valid, touched = _check_stamp(data_path, stamp)
+        if valid:
+            if touched:
+                con = lite.connect(db_path)
+                con.execute('UPDATE macroeco_source SET mtime = ?',
+                                                            (stamp['mtime'],))
+                con.commit()
+                con.close()
+            return db_path
+
+    stamp = _stamp(data_path)
+
+    def build(path):
+        con = lite.connect(path)
+        try:
+            with open(data_path, 'r') as f:
+                con.executescript(f.read())
+            con.execute('CREATE TABLE macroeco_source (size, mtime, md5)')
+            con.execute('INSERT INTO macroeco_source VALUES (?, ?, ?)',
+                        (stamp['size'], stamp['mtime'], stamp['md5']))
+            con.commit()
+        finally:
+            con.close()
+
+    if _write_atomic(db_path, build):
+        logging.info('Built database %s' % db_path)
+        return db_path
+    return None
+
+
+def index_columns(db_path, columns):
+    '''
+    Index columns of the tables of a database.
+
+    Parameters
+    ----------
+    db_path : str
+        Path to database.
+    columns : list
+        Names of columns. Each table holding a column gets an index on it, if
+        it has none made by index_columns.
+    '''
+
+    con = lite.connect(db_path)
+    try:
+        tables = [str(row[0]) for row in con.execute("SELECT name FROM "
+                    "sqlite_master WHERE type = 'table' AND name != "
+                    "'macroeco_source'")]
+        for table in tables:
+            table_cols = [row[1] for row in con.execute('PRAGMA table_info(%s)'
+                                                        % _sql_name(table))]
+            for col in columns:
+                if col in table_cols:
+                    con.execute('CREATE INDEX IF NOT EXISTS %s ON %s (%s)' %
+                                (_sql_name('%s_%s_index' % (table, col)),
+                                 _sql_name(table), _sql_name(col)))
+        con.commit()
+    finally:
+        con.close()
+
+
+def _sql_name(name):
+    '''Returns name quoted for use as a table or column name in SQL.'''
+    return '"%s"' % name.replace('"', '""')
+
+
+def db_table(data_path, query_str, chunksize=2**14, cache=False,
+             encode=None, vocabulary=None):
     '''Query a database and return query result as a recarray
 
     Parameters
@@ -313,16 +1335,45 @@ def db_table(data_path, query_str):
         The data_path of the .db file
     query_str : str
         The SQL query string
+    chunksize : int
+        Number of rows fetched from the database at a time.
+    cache : bool
+        If True, an sql script is queried through the database built from it
+        by compile_sql, instead of being run into a new database in memory.
+    encode : list
+        Names of columns whose values are replaced by their codes in
+        vocabulary, one chunk at a time as rows are fetched.
+    vocabulary : object of class Vocabulary
+        Vocabulary giving the codes of columns in encode.
 
     Returns
     -------
     table : recarray
         The database query as a recarray
+
+    Notes
+    -----
+    The query is run once, into a temporary table. The type of each column is
+    found by aggregate queries over that table, before any rows are fetched.
+    Columns holding any text are strings as wide as the longest value, columns
+    holding any real numbers are floats and other columns are integers. NULL
+    values are empty strings in text columns and nan in numeric columns, which
+    are then floats. Rows are then fetched in chunks straight into the table,
+    so only chunksize rows are held as Python objects at once.
         
     '''
     
+    if encode and vocabulary is None:
+        raise ValueError('A Vocabulary is needed to encode columns')
+
     end = data_path.split('.')[-1]
 
+    if end == 'sql' and cache:
+        db_path = compile_sql(data_path)
+        if db_path is not None:
+            data_path = db_path
+            end = 'db'
+
     if end == 'sql':
 
         def readData():
@@ -333,8 +1384,6 @@ def db_table(data_path, query_str):
                 return data
 
         con = lite.connect(':memory:')
-        con.row_factory = lite.Row
-
         cur = con.cursor()
         sql = readData()
         cur.executescript(sql)
@@ -343,29 +1392,84 @@ def db_table(data_path, query_str):
         
         con = lite.connect(data_path)
 
-        con.row_factory = lite.Row
-        cur = con.cursor()
-
-    cur.execute(query_str)
-    db_info = cur.fetchall()
+    # Read text as byte strings, as stored in tables
+    con.text_factory = str
     try:
-        col_names = db_info[0].keys()
-    except IndexError:
+        con.execute('CREATE TEMP TABLE query_result AS %s' %
+                                                query_str.strip().rstrip(';'))
+        table = _query_table(con, 'query_result', chunksize, encode or [],
+                             vocabulary)
+    finally:
+        con.close()
+
+    if len(table) == 0:
         raise lite.OperationalError("Query '%s' to database '%s' is empty" %
                                                         (query_str, data_path))
 
-    # Convert objects to tuples
-    converted_info = [tuple(x) for x in db_info]
-        
-    # NOTE: Using default value for Unicode: Seems better than checking
-    # lengths.  Should we keep the type as unicode?
-    dtypes = [type(x) if type(x) != unicode else 'S150' for x in db_info[0]]
-
-    table = np.array(converted_info, dtype=zip(col_names, dtypes))
-    con.commit()
-    con.close()
-    
     # Return a recarray for consistency
     return table.view(np.recarray)
 
 
+def _query_table(con, table_name, chunksize, encode, vocabulary):
+    '''
+    Returns structured array of the rows of a table, fetched in chunks, with
+    the columns in encode encoded with vocabulary.
+    '''
+
+    cur = con.execute('SELECT * FROM %s LIMIT 0' % table_name)
+    col_names = [str(desc[0]) for desc in cur.description]
+    quoted = [_sql_name(col) for col in col_names]
+
+    # Find number of rows, and type and NULLs of each column
+    stats = ["max(CASE typeof(%s) WHEN 'null' THEN 0 WHEN 'integer' THEN 1 "
+             "WHEN 'real' THEN 2 ELSE 3 END), count(%s)" % (col, col)
+             for col in quoted]
+    result = con.execute('SELECT count(*), %s FROM %s' % (', '.join(stats),
+                                                    table_name)).fetchone()
+    kinds = result[1::2]
+    nulls = [count < result[0] for count in result[2::2]]
+
+    # Find width of text columns
+    text = [col for col, kind in zip(quoted, kinds) if kind == 3]
+    if text:
+        widths = con.execute('SELECT %s FROM %s' % (', '.join(
+                    ['max(length(CAST(%s AS BLOB)))' % col for col in text]),
+                    table_name)).fetchone()
+        widths = dict(zip(text, widths))
+
+    dtype = []
+    select = []
+    for name, col, kind, null in zip(col_names, quoted, kinds, nulls):
+        if kind == 3:
+            dtype.append((name, 'S%d' % max(widths[col], 1)))
+            select.append("ifnull(%s, '')" % col if null else col)
+        else:
+            dtype.append((name, np.float64 if kind != 1 or null else
+                                                                    np.int64))
+            select.append(col)
+
+    # Fetch rows in chunks into the table, encoding each chunk
+    encode = [name for name in col_names if name in encode]
+    table_dtype = [(name, np.int32) if name in encode else (name, col_type)
+                   for name, col_type in dtype]
+    table = np.empty(result[0], dtype=table_dtype)
+    cur = con.execute('SELECT %s FROM %s' % (', '.join(select),
+                                                                table_name))
+    start = 0
+    while True:
+        rows = cur.fetchmany(chunksize)
+        if not rows:
+            break
+        chunk = np.array(rows, dtype=dtype)
+        stop = start + len(rows)
+        if encode:
+            for name in col_names:
+                if name in encode:
+                    table[name][start:stop] = vocabulary.encode(chunk[name])
+                else:
+                    table[name][start:stop] = chunk[name]
+        else:
+            table[start:stop] = chunk
+        start = stop
+
+    return table
@@ -54,6 +54,9 @@ Misc Functions
 - `check_list_of_iterables`
 - `set_up_and_down`
 - `unpack`
+- `weighted_sample`
+- `is_weighted`
+- `split_weighted`
 
 References
 ----------
@@ -3191,7 +3194,8 @@ class psi(Distribution):
         data_eng = check_list_of_iterables(ied)
 
         # Store energy data in self.params
-        E = [np.sum(np.array(edata)) for edata in data_eng]
+        E = [np.sum(np.prod(split_weighted(edata), axis=0)) for edata in
+                                                                    data_eng]
         self.params['E'] = E
 
         return self
@@ -3336,12 +3340,13 @@ class theta(Distribution):
 
         # Check and set energy data
         data_eng = check_list_of_iterables(ied)
-        E = [np.sum(np.array(edata)) for edata in data_eng]
+        E = [np.sum(np.prod(split_weighted(edata), axis=0)) for edata in
+                                                                    data_eng]
         self.params['E'] = E
         
         # Check and set species abundance data
         n_data = check_list_of_iterables(sed)
-        n = [len(np.array(ndata)) for ndata in n_data]
+        n = [int(np.sum(split_weighted(ndata)[1])) for ndata in n_data]
         self.params['n'] = n
 
         
@@ -3595,7 +3600,8 @@ class nu(Distribution):
         data_eng = check_list_of_iterables(ied)
 
         # Store energy data in self.params
-        E = [np.sum(np.array(edata)) for edata in data_eng]
+        E = [np.sum(np.prod(split_weighted(edata), axis=0)) for edata in
+                                                                    data_eng]
         self.params['E'] = E
 
         return self
@@ -3671,6 +3677,61 @@ def expand_n(n, size):
 
     return new_n
 
+def weighted_sample(values, weights):
+    '''
+    Makes a weighted sample, a structured array with fields 'value' and
+    'weight', in which each value stands for weight identical observations.
+
+    Parameters
+    ----------
+    values : array-like object
+        Observed values
+    weights : array-like object
+        Number of observations of each value. Same length as values.
+
+    Returns
+    -------
+    : structured array
+        Weighted sample with fields 'value' and 'weight'
+
+    '''
+    values = make_array(values)
+    weights = make_array(weights)
+    if len(values) != len(weights):
+        raise ValueError('values and weights must have the same length')
+
+    sample = np.empty(len(values), dtype=[('value', np.float),
+                                          ('weight', np.float)])
+    sample['value'] = values
+    sample['weight'] = weights
+    return sample
+
+def is_weighted(data):
+    '''Checks if data is a weighted sample (see weighted_sample).'''
+    names = getattr(np.asarray(data).dtype, 'names', None)
+    return names is not None and 'weight' in names
+
+def split_weighted(data):
+    '''
+    Splits data into values and weights.  If data is not a weighted sample
+    (see weighted_sample), every value has a weight of one.
+
+    Parameters
+    ----------
+    data : array-like object
+        Weighted sample or plain data
+
+    Returns
+    -------
+    : tuple
+        1D arrays of values and of weights
+
+    '''
+    data = np.asarray(data)
+    if is_weighted(data):
+        return data['value'], data['weight']
+    return data, np.ones(len(data))
+
 def check_list_of_iterables(data):
     '''
     Checks if the given object is a list of iterables.  If so, returns a
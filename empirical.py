@@ -7,30 +7,61 @@ is interpreted broadly as any temporally and spatially defined census.
 Classes
 -------
 - `Patch` -- empirical metrics for census data
+- `CensusTensor` -- sparse abundances of species in cells in each census
+- `Combinations` -- lazy sequence of combinations of criteria levels
+- `SpatialIndex` -- Morton order (quadtree) index for rectangle and radius
+  queries, used by sar_sample
 
 Patch Methods
 -------------
+- `build_spatial_index` -- sort records in Morton order and index them for
+  sar_sample
+- `append` -- add new census records, updating cached values
 - `sad` -- calculate species abundance distribution (grid or sample)
 - `sar` -- calculate species-area relationship (grid or sample)
 - `ear` -- calculate endemics-area relationship (grid or sample)
+- `sar_window` -- calculate species-area relationship from moving windows
+- `sar_sample` -- calculate species-area relationship from random quadrats
+- `o_ring` -- calculate O-ring and pair-correlation statistics of species
+- `census_tensor` -- build sparse (census, cell, species) abundances
+- `sta` -- calculate species-time-area relationship (grid)
 - `comm` -- calculate commonality between sub-patches (grid)
 - `ssad` -- calculate species-level spatial abundance distrib (grid or sample)
+- `ssad_summary` -- tabulate occupancy, mean, variance and aggregation of
+  ssads at each division (grid)
 - `sed` -- calculate species energy distribution (grid or sample)
 - `ied` -- calculate the community (individual) energy distribution
 - `ased` -- calculate the average species energy distribution
+- `rarefaction` -- calculate expected species richness of random samples
 
-- `get_sp_centers` --
+- `get_sp_centers` -- return centers of sub-patches made by criteria
 - 'get_div_areas' -- return list of areas made by div_list
 
 Misc functions
 --------------
+- `rarefy` -- expected species richness of random samples from an sad
+- `group_by_species` -- group records by species with one stable sort
+- `integral_image` -- summed-area table of species abundances in a grid
+- `window_sums` -- species abundances in moving windows of an integral image
+- `sar_ear_counts` -- count species and endemics in each cell
+- `pack_presence` -- pack species presence in cells into bit sets
+- `popcount` -- count species in packed bit sets
+- `single_presence` -- bit set of species found in only one packed cell
+- `morton_code` -- interleave bits of integer coordinates
+- `criteria_columns` -- return names of the columns used by criteria
 - `distance` -- return Euclidean distance between two points
 '''
 
 from __future__ import division
 import numpy as np
+import scipy.sparse as sparse
+from scipy.spatial import cKDTree
+import itertools
 from copy import deepcopy
-from data import DataTable
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from data import DataTable, db_table, compile_sql, index_columns, _sql_name
+from distributions import weighted_sample, split_weighted, _ln_choose
 
 
 class Patch:
@@ -51,22 +82,521 @@ class Patch:
         would look something like {'name' : [('==', 'John'), ('==', 'Harry')]}.
         In addition, subset can be a query string for a SQL database.
 
+    cache_limit : int
+        Maximum number of bytes of species lists, level arrays and row-to-cell
+        assignments kept in the cache of the Patch. Default is 256 MB.
+    cache : bool
+        If True, a csv data table and its metadata are kept in a binary cache
+        next to the csv file, and loaded from it without parsing when the files
+        have not changed. An sql script is built into a database once, and
+        with pushdown the columns used in criteria are indexed in it. See
+        DataTable.
+    mmap : bool
+        If True, a csv data table is memory-mapped from the binary cache, so
+        tables larger than memory can be used. See DataTable.
+    pushdown : bool
+        If True, datapath is a db or sql file and subset a query string, and
+        the rows of the query are not loaded. Species lists, levels of split
+        columns and species abundances in each cell are computed by queries
+        in the database, with GROUP BY on an integer cell expression for
+        each metric column, so only counts are loaded. Methods that use the
+        sads of cells (sad, ssad, ssad_summary, sar, ear, comm, sta and
+        rarefaction) are available. Methods that need individual records
+        (eg, ied, sed, ased, o_ring, sar_sample, census_tensor and
+        build_spatial_index) raise ValueError.
+    columns : list
+        Names of the columns to load, eg, as given by criteria_columns for the
+        criteria of the analyses to be run. Columns in subset are always
+        loaded. If None, all columns are loaded.
+    encode : list
+        Names of columns to dictionary-encode as integer codes, eg, the
+        species column, so species are grouped and matched as small integers.
+        Results give the species themselves. Encoded columns should only be
+        species columns in criteria. Not used with pushdown. See DataTable.
+    vocabulary : object of class Vocabulary
+        Vocabulary of encoded columns shared with other patches, eg, those of
+        a Workflow run (Workflow.vocabulary), so that codes match between
+        them. If None, a new Vocabulary is used.
+
     Attributes
     ----------
     data_table : object of class DataTable
         Object containing patch data and metadata.
+    datapath : str
+        Path to data, as given.
+    subset : dict or str
+        Permanent subset of the data, as given.
+    pushdown : bool
+        Whether results are computed in the database. data_table.table is
+        None if True.
+    spatial_index : object of class SpatialIndex
+        Index made by build_spatial_index, or None.
+    cache_limit : int
+        Maximum size of the cache in bytes. The least recently used entries
+        are dropped when the cache grows past this size.
+
+    Notes
+    -----
+    Species lists, criteria levels and the cell that each row of the table
+    falls in are cached for each criteria, so repeated analyses with the same
+    criteria do not rescan the table. The cache is cleared automatically when
+    data_table.table or data_table.meta is replaced. Call clear_cache after
+    changing either in place. Records added with append update the cache
+    instead of clearing it.
 
     '''
 
-    def __init__(self, datapath, subset = {}):
+    def __init__(self, datapath, subset = {}, cache_limit=2**28, cache=False,
+                 mmap=False, pushdown=False, columns=None, encode=None,
+                 vocabulary=None):
         '''Initialize object of class Patch. See class documentation.'''
-        
-        # Handle csv 
-        self.data_table = DataTable(datapath, subset=subset)
-        
-        # If datapath is sql or db the subsetting is already done.
-        if type(subset) == type({}):
-            self.data_table.table = self.data_table.get_subtable(subset)
+
+        if pushdown and type(subset) == type({}):
+            raise ValueError('pushdown needs a db or sql file and a query ' +
+                             'string')
+
+        # A dict subset is applied to a csv file while it is read. If datapath
+        # is sql or db the subsetting is done by the query.
+        self.data_table = DataTable(datapath, subset=subset, cache=cache,
+                            mmap=mmap, load=not pushdown, columns=columns,
+                            encode=encode, vocabulary=vocabulary)
+        self.datapath = datapath
+        self.subset = subset
+        self.pushdown = pushdown
+        self._file_cache = cache
+
+        self.cache_limit = cache_limit
+        self.clear_cache()
+        self.spatial_index = None
+
+    def clear_cache(self):
+        '''Removes all species lists, levels and cell assignments cached.'''
+
+        self._cache = OrderedDict()
+        self._cache_bytes = 0
+        self._cache_table = self.data_table.table
+        self._cache_meta = self.data_table.meta
+
+    def _check_cache(self):
+        '''Clears the cache if the table or metadata was replaced.'''
+        if (self._cache_table is not self.data_table.table or
+                                self._cache_meta is not self.data_table.meta):
+            self.clear_cache()
+
+    def _cached(self, key, builder):
+        '''
+        Returns the cached value for key, calling builder to make and cache it
+        if it is not in the cache.
+        '''
+
+        self._check_cache()
+
+        if key in self._cache:
+            value, size = self._cache.pop(key)
+            self._cache[key] = (value, size)  # Mark as most recently used
+            return value
+
+        value = builder()
+        size = _nbytes(value)
+        if size <= self.cache_limit:
+            self._cache[key] = (value, size)
+            self._cache_bytes += size
+            while self._cache_bytes > self.cache_limit:
+                old_value, old_size = self._cache.popitem(last=False)[1]
+                self._cache_bytes -= old_size
+
+        return value
+
+    def append(self, new_data):
+        '''
+        Appends new census records to the patch.
+
+        Parameters
+        ----------
+        new_data : str or ndarray
+            Path to a csv file or a structured array holding the new records,
+            with the same columns as the data table. Records not meeting the
+            permanent subset of the patch are dropped.
+
+        Returns
+        -------
+        : int
+            Number of records appended.
+
+        Notes
+        -----
+        Species lists, cell assignments and species-by-cell abundances in the
+        cache are updated from the new records alone, so later analyses do
+        not rescan the records already in the patch. Cached values that depend
+        on the order of all records, or on levels of split columns that gain a
+        new value, are dropped and rebuilt when next needed.
+        '''
+
+        if self.pushdown:
+            raise TypeError('Cannot append records to a patch computed in ' +
+                            'the database')
+
+        # Bring the cache up to date with the table before updating it
+        self._check_cache()
+
+        # New records are not in Morton order
+        self.spatial_index = None
+
+        if type(self.subset) == type({}):
+            rows = self.data_table.append(new_data, subset=self.subset)
+        else:
+            rows = self.data_table.append(new_data)
+
+        old_cache = self._cache
+        self.clear_cache()
+        self._update_cache(old_cache, rows)
+
+        return len(rows)
+
+    def build_spatial_index(self, cols=('x', 'y'), bits=16):
+        '''
+        Sorts the records of the patch in Morton (Z-order) order of cols and
+        stores a SpatialIndex over them in the spatial_index attribute, which
+        sar_sample uses to find the records in its random quadrats.
+
+        Parameters
+        ----------
+        cols : tuple
+            Names of the two columns giving the location of each record.
+        bits : int
+            Depth of the quadtree. See SpatialIndex.
+
+        Returns
+        -------
+        : object of class SpatialIndex
+            The index. Positions in its ranges are rows of the sorted table.
+
+        Notes
+        -----
+        Sorting the table replaces data_table.table, so the cache is cleared
+        and results that list records in table order (eg, ied) list them in
+        the new order. Appending records drops the index. Grid-based methods
+        (eg, sad, sar and ssad) do not use the index: they assign every
+        record to a cell in one vectorized pass over the table.
+        '''
+
+        self._check_records('build_spatial_index')
+        table = self.data_table.table
+        index = SpatialIndex(table[cols[0]], table[cols[1]], bits=bits)
+        self.data_table.table = table[index.order]
+        index.order = np.arange(len(index.order))
+        index.cols = tuple(cols)
+        index.table = self.data_table.table
+
+        self.spatial_index = index
+        return index
+
+    def _spatial_index(self, cols):
+        '''
+        Returns the index made by build_spatial_index if it is over cols and
+        the current table, or a cached SpatialIndex over cols.
+        '''
+
+        index = self.spatial_index
+        if (index is not None and index.cols == tuple(cols) and
+                                    index.table is self.data_table.table):
+            return index
+
+        table = self.data_table.table
+        return self._cached(('spatial_index', tuple(cols)), lambda:
+                            SpatialIndex(table[cols[0]], table[cols[1]]))
+
+    def _update_cache(self, old_cache, rows):
+        '''
+        Adds rows appended to the end of the table to the values in old_cache
+        and stores those values in the (cleared) cache.
+        '''
+
+        old_len = len(self.data_table.table) - len(rows)
+
+        # Species lists and levels of split columns, noting those that grew
+        changed = set()
+        spp_pos = {}
+        for key, (value, size) in old_cache.items():
+            if key[0] == 'species':
+                uniq, inverse = value
+                new_spp = self.data_table.decode(key[1], rows[key[1]])
+                new_uniq = np.union1d(uniq, new_spp)
+                if len(new_uniq) != len(uniq):
+                    changed.add(key[1])
+                    spp_pos[key[1]] = np.searchsorted(new_uniq, uniq)
+                    inverse = spp_pos[key[1]][inverse]
+                new_inverse = np.concatenate((inverse,
+                                    np.searchsorted(new_uniq, new_spp)))
+                self._cached(key, lambda: (new_uniq, new_inverse))
+            elif key[0] == 'levels':
+                new_levels = np.union1d(value, rows[key[1]])
+                if len(new_levels) == len(value):
+                    self._cached(key, lambda: value)
+                else:
+                    changed.add(key[1])
+
+        def stale(criteria, grown):
+            '''
+            Whether criteria use a species list or levels of a column in grown,
+            or one no longer cached, which may have grown unnoticed.
+            '''
+            for col, value in criteria.items():
+                if value == 'species':
+                    kind = 'species'
+                elif value == 'split':
+                    kind = 'levels'
+                else:
+                    continue
+                if col in grown or (kind, col) not in old_cache:
+                    return True
+            return False
+
+        # Parsed criteria do not depend on the rows unless a list grew
+        for key, (value, size) in old_cache.items():
+            if key[0] == 'parse' and not stale(dict(key[1]), changed):
+                self._cached(key, lambda: value)
+
+        for key, (value, size) in old_cache.items():
+            if key[0] not in ('cells', 'sxc'):
+                continue
+            criteria = dict(key[1])
+            if stale(criteria, [col for col in changed if criteria.get(col) ==
+                                                                    'split']):
+                continue
+
+            spp_list, spp_col, count_col, engy_col, mass_col, combinations = \
+                                            self.parse_criteria(criteria)
+            new_cell = _combination_index(rows, combinations)
+
+            if key[0] == 'cells':
+                new_value = np.concatenate((value, new_cell))
+            else:
+                new_value = np.zeros((len(spp_list), len(combinations)),
+                                                            dtype=value.dtype)
+                new_value[spp_pos.get(spp_col, slice(None))] = value
+
+                valid = new_cell >= 0
+                spp_ind = self._species_index(spp_col)[1][old_len:]
+                if count_col:
+                    counts = rows[count_col][valid]
+                else:
+                    counts = None
+                new_value += np.bincount(new_cell[valid] * len(spp_list) +
+                    spp_ind[valid], weights=counts, minlength=new_value.size
+                    ).reshape(len(combinations), -1).T.astype(value.dtype)
+
+            self._cached(key, lambda: new_value)
+
+    def _species_index(self, spp_col):
+        '''
+        Returns the sorted unique species in spp_col and the index of the
+        species of each row of the table in that list.
+        '''
+        if self.pushdown:
+            return self._cached(('species', spp_col), lambda:
+                                            (self._distinct(spp_col), None))
+
+        def build():
+            codes = self.data_table.table[spp_col]
+            if spp_col not in self.data_table.encoded:
+                return np.unique(codes, return_inverse=True)
+
+            # Codes present, found without sorting, are sorted by species
+            present = np.flatnonzero(np.bincount(codes))
+            spp_list = self.data_table.decode(spp_col, present)
+            order = np.argsort(spp_list)
+            index = np.zeros(len(present) and present[-1] + 1, dtype=int)
+            index[present[order]] = np.arange(len(present))
+            return spp_list[order], index[codes]
+
+        return self._cached(('species', spp_col), build)
+
+    def _levels(self, col):
+        '''Returns the sorted unique values of col.'''
+        if self.pushdown:
+            return self._cached(('levels', col), lambda: self._distinct(col))
+        return self._cached(('levels', col), lambda:
+                                        np.unique(self.data_table.table[col]))
+
+    def _distinct(self, col):
+        '''Returns the sorted unique values of col found in the database.'''
+        self._index_columns([col])
+        return np.unique(self._query('SELECT DISTINCT %s FROM patch' %
+                                                    _sql_name(col))[col])
+
+    def _query(self, query_str):
+        '''
+        Returns recarray of the result of query_str, in which the records of
+        the patch are the table "patch".
+        '''
+        return db_table(self.datapath, 'WITH patch AS (%s) %s' %
+                    (self.subset.strip().rstrip(';'), query_str),
+                    cache=self._file_cache)
+
+    def _check_records(self, method):
+        '''Raises ValueError if the records of the patch are not loaded.'''
+        if self.pushdown:
+            raise ValueError('%s needs the records of the patch, which are '
+                             'not loaded with pushdown' % method)
+
+    def _index_columns(self, cols):
+        '''Indexes cols in the database built from an sql script, if any.'''
+        if self._file_cache and self.datapath.split('.')[-1] == 'sql':
+            db_path = compile_sql(self.datapath)
+            if db_path is not None:
+                index_columns(db_path, cols)
+
+    def _sql_species_by_cell(self, criteria):
+        '''
+        Returns the 2D array of the abundance of each species in each
+        combination of criteria, summed by a GROUP BY query in the database.
+        See _species_by_cell.
+        '''
+
+        spp_list, spp_col, count_col, engy_col, mass_col, combinations = \
+            self.parse_criteria(criteria)
+
+        # Integer cell expression of each metric column, raw values of others
+        select = [_sql_name(spp_col)]
+        where = []
+        for col, levels in zip(combinations.columns, combinations.levels):
+            name = _sql_name(col)
+            if type(levels[0]) == type([]):
+                select.append(_sql_level_index(name, levels))
+                where.append('%s >= %r AND %s < %r' % (name,
+                    float(levels[0][0][1]), name, float(levels[-1][1][1])))
+            elif not (type(levels[0][1]) == type('') and
+                                                    levels[0][1] == 'whole'):
+                select.append(name)
+        where = 'WHERE ' + ' AND '.join(where) if where else ''
+        self._index_columns([spp_col] + combinations.columns)
+        groups = ', '.join('g%d' % i for i in range(len(select)))
+        select = ', '.join('%s AS g%d' % (expr, i) for i, expr in
+                                                        enumerate(select))
+        total = 'sum(%s)' % _sql_name(count_col) if count_col else 'count(*)'
+        query = 'SELECT %s, %s AS total FROM patch %s GROUP BY %s' % (select,
+                                                        total, where, groups)
+
+        nspp = len(spp_list)
+        abund = np.zeros(nspp * len(combinations))
+        if not self._query('SELECT EXISTS (SELECT 1 FROM patch %s)' %
+                                                                where)[0][0]:
+            return abund.reshape(len(combinations), nspp).T.astype(int)
+        counts = self._query(query)
+
+        # Cell of each group, as by _combination_index
+        cell = np.zeros(len(counts), dtype=int)
+        stride = 1
+        g = 1
+        for col, levels in zip(combinations.columns, combinations.levels):
+            if type(levels[0]) == type([]):
+                col_ind = counts['g%d' % g]
+                g += 1
+            elif type(levels[0][1]) == type('') and levels[0][1] == 'whole':
+                col_ind = np.zeros(len(counts), dtype=int)
+            else:
+                col_ind = _level_index(counts['g%d' % g], levels)
+                g += 1
+            cell = np.where((cell >= 0) & (col_ind >= 0), cell + stride *
+                                                                col_ind, -1)
+            stride *= len(levels)
+
+        valid = cell >= 0
+        spp_ind = np.searchsorted(spp_list, counts['g0'][valid])
+        np.add.at(abund, cell[valid] * nspp + spp_ind, counts['total'][valid])
+        if not count_col or counts['total'].dtype.kind == 'i':
+            abund = abund.astype(int)
+        return abund.reshape(len(combinations), nspp).T
+
+    def _cell_index(self, criteria):
+        '''
+        Returns the index of the combination in parse_criteria(criteria) that
+        each row of the table falls in, or -1 for rows that are in none.
+        '''
+
+        self._check_records('Assigning records to cells')
+        return self._cached(('cells', _criteria_key(criteria)), lambda:
+                    _combination_index(self.data_table.table,
+                                            self.parse_criteria(criteria)[5]))
+
+    def _cell_rows(self, criteria):
+        '''
+        Returns the indices of the rows of the table sorted by the combination
+        they fall in and the bounds of each combination in those indices.
+        Rows of the same combination keep their order in the table.
+        '''
+
+        self._check_records('Assigning records to cells')
+        def build():
+            cell = self._cell_index(criteria)
+            order = np.argsort(cell, kind='mergesort')
+            ncells = len(self.parse_criteria(criteria)[5])
+            bounds = np.searchsorted(cell[order], np.arange(ncells + 1))
+            return order, bounds
+
+        return self._cached(('rows', _criteria_key(criteria)), build)
+
+    def _species_by_cell(self, criteria):
+        '''
+        Returns the 2D array of the abundance of each species (rows) in each
+        combination of criteria (columns), in the order of parse_criteria.
+        '''
+
+        if self.pushdown:
+            return self._cached(('sxc', _criteria_key(criteria)), lambda:
+                                        self._sql_species_by_cell(criteria))
+
+        def build():
+            spp_list, spp_col, count_col, engy_col, mass_col, combinations = \
+                self.parse_criteria(criteria)
+            spp_ind = self._species_index(spp_col)[1]
+            cell = self._cell_index(criteria)
+
+            valid = cell >= 0
+            nspp = len(spp_list)
+            flat_ind = cell[valid] * nspp + spp_ind[valid]
+            if count_col:
+                counts = self.data_table.table[count_col]
+                abund = np.bincount(flat_ind, weights=counts[valid],
+                            minlength=nspp * len(combinations))
+                abund = abund.astype(counts.dtype)
+            else:
+                abund = np.bincount(flat_ind, minlength=nspp *
+                                                            len(combinations))
+            return abund.reshape(len(combinations), nspp).T
+
+        return self._cached(('sxc', _criteria_key(criteria)), build)
+
+    def _presence_by_cell(self, criteria):
+        '''
+        Returns the species present in each combination of criteria as packed
+        bit sets (see pack_presence), one row for each combination in the
+        order of parse_criteria. Bits are set from the species and cell of
+        each record with a nonzero count, without a species-by-cell array.
+        '''
+
+        if self.pushdown:
+            return self._cached(('presence', _criteria_key(criteria)), lambda:
+                            pack_presence(self._species_by_cell(criteria)))
+
+        def build():
+            spp_list, spp_col, count_col, engy_col, mass_col, combinations = \
+                self.parse_criteria(criteria)
+            spp_ind = self._species_index(spp_col)[1]
+            cell = self._cell_index(criteria)
+
+            present = cell >= 0
+            if count_col:
+                present &= self.data_table.table[count_col] > 0
+            spp_ind = spp_ind[present]
+            packed = np.zeros((len(combinations), (len(spp_list) + 7) // 8),
+                                                                dtype=np.uint8)
+            np.bitwise_or.at(packed, (cell[present], spp_ind >> 3),
+                                    (128 >> (spp_ind & 7)).astype(np.uint8))
+            return packed
+
+        return self._cached(('presence', _criteria_key(criteria)), build)
 
     
     def sad(self, criteria, clean=False):
@@ -107,21 +637,12 @@ class Patch:
         if spp_col == None:
             raise TypeError('No species column specified in "criteria" ' +
                                                                    'parameter')
-        result = []
-        for comb in combinations:
-            
-            subtable = self.data_table.get_subtable(comb)
+        spp_by_cell = self._species_by_cell(criteria)
 
-            sad_list = []
-            for species in spp_list:
-                spp_subtable = subtable[subtable[spp_col] == species]
-                if count_col:
-                    count = np.sum(spp_subtable[count_col])
-                else:
-                    count = len(spp_subtable)
-                sad_list.append(count)
+        result = []
+        for i, comb in enumerate(combinations):
 
-            sad_list = np.array(sad_list)
+            sad_list = np.array(spp_by_cell[:, i])
 
             if clean:
                 ind = np.where(sad_list != 0)[0]
@@ -168,6 +689,90 @@ class Patch:
 
         return combs, ssad
 
+    def ssad_summary(self, div_cols, div_list, criteria):
+        '''
+        Calculates summary statistics of the species-level spatial abundance
+        distribution of every species at each division.
+
+        Parameters
+        ----------
+        div_cols : tuple
+            Column names to divide, eg, ('x', 'y'). Must be metric.
+        div_list : list of tuples
+            List of division pairs in same order as div_cols, eg, [(2,2),
+            (2,4), (4,4)]. Values are number of divisions of div_col.
+        criteria : dict
+            See docstring for Patch.sad. Here, criteria should only contain
+            the species and count columns and columns with the value 'whole'
+            (any items referring to div_cols are ignored).
+
+        Returns
+        -------
+        : structured array
+            Table with one row for each division and species, division by
+            division, with fields 'species', 'area' (of a cell), 'cells'
+            (number of cells), 'abundance' (total), 'occupancy' (fraction of
+            cells where the species is present), 'mean' and 'var' (mean and
+            population variance of abundance per cell), 'vmr' (variance to
+            mean ratio) and 'morisita' (Morisita's index of dispersion).
+
+        Notes
+        -----
+        All statistics are reductions along the cells of the cached
+        species-by-cell matrix of each division, so every species is
+        summarized at once. The vmr and Morisita's index are nan for species
+        with too few individuals to define them.
+        '''
+
+        criteria = {k: v for k, v in criteria.items() if k not in div_cols}
+        spp_list = self.parse_criteria(criteria)[0]
+        if spp_list is None:
+            raise TypeError('No species column specified in "criteria" ' +
+                                                                   'parameter')
+
+        nspp = len(spp_list)
+        summary = np.empty(nspp * len(div_list), dtype=[('species',
+                spp_list.dtype), ('area', np.float), ('cells', int),
+                ('abundance', np.float), ('occupancy', np.float), ('mean',
+                np.float), ('var', np.float), ('vmr', np.float), ('morisita',
+                np.float)])
+
+        for d, div in enumerate(div_list):
+
+            this_criteria = deepcopy(criteria)
+            for i, col in enumerate(div_cols):
+                this_criteria[col] = div[i]
+            if set(self.parse_criteria(this_criteria)[5].columns) != \
+                                                                set(div_cols):
+                raise ValueError('criteria for ssad_summary can only split ' +
+                                 'div_cols')
+
+            spp_by_cell = self._species_by_cell(this_criteria).astype(float)
+            ncells = spp_by_cell.shape[1]
+            abund = np.sum(spp_by_cell, axis=1)
+            mean = abund / ncells
+            var = np.maximum(np.mean(spp_by_cell ** 2, axis=1) - mean ** 2,
+                                                                        0)
+
+            with np.errstate(invalid='ignore', divide='ignore'):
+                vmr = var / mean
+                morisita = ncells * np.sum(spp_by_cell * (spp_by_cell - 1),
+                                            axis=1) / (abund * (abund - 1))
+
+            rows = slice(d * nspp, (d + 1) * nspp)
+            summary['species'][rows] = spp_list
+            summary['area'][rows] = np.prod([self._col_length(col) / div[i]
+                                            for i, col in enumerate(div_cols)])
+            summary['cells'][rows] = ncells
+            summary['abundance'][rows] = abund
+            summary['occupancy'][rows] = np.mean(spp_by_cell > 0, axis=1)
+            summary['mean'][rows] = mean
+            summary['var'][rows] = var
+            summary['vmr'][rows] = vmr
+            summary['morisita'][rows] = np.where(abund > 1, morisita, np.nan)
+
+        return summary
+
     def parse_criteria(self, criteria):
         '''
         Parses criteria list to get all possible column combinations.
@@ -189,19 +794,27 @@ class Patch:
             Name of column containing species identifiers.
         count_col : str
             Name of column containing counts, if any.
-        combinations : list of dicts
-            List of dictionaries giving all possible combinations of criteria. 
-            Columns not mentioned in criteria are ignored and will be averaged 
-            over in later analyses.
+        combinations : Combinations
+            Lazy sequence of dictionaries giving all possible combinations of
+            criteria, generated from the levels of each column as they are
+            iterated over. Columns not mentioned in criteria are ignored and
+            will be averaged over in later analyses.
 
         '''
 
+        return self._cached(('parse', _criteria_key(criteria)),
+                                    lambda: self._parse_criteria(criteria))
+
+    def _parse_criteria(self, criteria):
+        '''Parses criteria without the cache. See parse_criteria.'''
+
         spp_list = None
         spp_col = None
         count_col = None
         engy_col = None
         mass_col = None
-        combinations = []
+        comb_cols = []
+        comb_levels = []
 
         # Calculate all possible combinations of columns based on criteria
         # TODO: Add error checking
@@ -209,7 +822,7 @@ class Patch:
             
             # Look for two special values indicating species and count cols
             if value == 'species':
-                spp_list = np.unique(self.data_table.table[key])
+                spp_list = self._species_index(key)[0]
                 spp_col = key
                 continue
             if value == 'count':
@@ -224,7 +837,7 @@ class Patch:
 
             # Get levels of categorial or metric data
             if value == 'split':  # Categorial
-                levels = np.unique(self.data_table.table[key])
+                levels = self._levels(key)
                 levels_str = [('==' , x.astype(levels.dtype)) for x in levels]
             elif value == 'whole':
                 # Random string to minimize chance of overlap?
@@ -253,22 +866,12 @@ class Patch:
                 levels_str = [list(lvl) for lvl in zip(starts_str, ends_str)]
 
 
-            # Add these levels to combinations dictionary
-            if len(combinations) == 0:  # If first criteria
-                for i, level in enumerate(levels_str):
-                    combinations.append({key: level})
-            else:
-                temp_comb = []
-                for i, level in enumerate(levels_str):
-                    exist_recs = deepcopy(combinations)
-                    for rec in exist_recs:
-                        rec[key] = level
-                    temp_comb += exist_recs
-                combinations = temp_comb
-        
-        if len(combinations) == 0:
-            combinations.append({})
-        
+            # Store levels of this column for the combinations
+            comb_cols.append(key)
+            comb_levels.append(levels_str)
+
+        combinations = Combinations(comb_cols, comb_levels)
+
         return spp_list, spp_col, count_col, engy_col, mass_col, combinations
 
 
@@ -288,27 +891,45 @@ class Patch:
             See docstring for EPatch.sad. Here, criteria SHOULD NOT include 
             items referring to div_cols (if there are any, they are ignored).
         form : string
-            'sar' or 'ear' for species or endemics area relationship. EAR is 
+            'sar' or 'ear' for species or endemics area relationship. EAR is
             relative to the subtable selected after criteria is applied.
+            'both' calculates the SAR and the EAR from the same bit sets.
 
         Returns
         -------
         rec_sar: structured array
             Returns a structured array with fields 'items' and 'area' that
             contains the average items/species for each given area specified by
-            critieria.
+            critieria. If form is 'both', 'items' holds the mean number of
+            species and the additional field 'endemics' holds the mean number
+            of endemics.
         full_result : list of ndarrays
-            List of same length as areas containing arrays with element for 
-            count of species or endemics in each subpatch at corresponding 
-            area.
+            List of same length as areas containing arrays with element for
+            count of species or endemics in each subpatch at corresponding
+            area. If form is 'both', each element is a 2D array with species
+            counts in the first row and endemics counts in the second.
+
+        Notes
+        -----
+        The species present in each subpatch are held as packed bit sets
+        (see pack_presence). Richness is the popcount of each set, and the
+        endemics of a subpatch are the species present in it and in no other
+        subpatch (see single_presence).
         '''
 
         # If any element in div_cols in criteria, remove from criteria
         criteria = {k: v for k, v in criteria.items() if k not in div_cols}
+        if self.parse_criteria(criteria)[1] == None:
+            raise TypeError('No species column specified in "criteria" ' +
+                                                                   'parameter')
+
+        if form not in ('sar', 'ear', 'both'):
+            raise NotImplementedError('No SAR of form %s available' % form)
 
         # Loop through div combinations (ie, areas), calc sad, and summarize
         areas = []
         mean_result = []
+        mean_endemics = []
         full_result = []
 
         for div in div_list:
@@ -318,23 +939,24 @@ class Patch:
             for i, col in enumerate(div_cols):
                 this_criteria[col] = div[i]
 
-            # Get flattened sad for all criteria and this div
-            sad_return = self.sad(this_criteria)
-            flat_sad = flatten_sad(sad_return)[1]
+            # Species present in each subpatch for this div
+            packed = self._presence_by_cell(this_criteria)
 
             # Store results
+            if form in ('sar', 'both'):
+                spp_full = popcount(packed)
+            if form in ('ear', 'both'):
+                end_full = popcount(packed & single_presence(packed))
             if form == 'sar':
-                this_full = np.sum((flat_sad > 0), axis=0)
-                this_mean = np.mean(this_full)
+                this_full = spp_full
+                this_mean = np.mean(spp_full)
             elif form == 'ear':
-                totcnt = np.sum(flat_sad, axis=1)
-                totcnt_arr = \
-                    np.array([list(totcnt),]*np.shape(flat_sad)[1]).transpose()
-
-                this_full = np.sum(np.equal(flat_sad, totcnt_arr), axis=0)
-                this_mean = np.mean(this_full)
+                this_full = end_full
+                this_mean = np.mean(end_full)
             else:
-                raise NotImplementedError('No SAR of form %s available' % form)
+                this_full = np.vstack((spp_full, end_full))
+                this_mean = np.mean(spp_full)
+                mean_endemics.append(np.mean(end_full))
 
             full_result.append(this_full)
             mean_result.append(this_mean)
@@ -342,148 +964,538 @@ class Patch:
             # Store area
             area = 1
             for i, col in enumerate(div_cols):
-                dmin = self.data_table.meta[(col, 'minimum')]
-                dmax = self.data_table.meta[(col, 'maximum')]
-                dprec = self.data_table.meta[(col, 'precision')]
-                length = (dmax + dprec - dmin)
-
-                area *= length / div[i]
+                area *= self._col_length(col) / div[i]
 
             areas.append(area)
 
         # Return
-        rec_sar = np.array(zip(mean_result, areas), dtype=[('items', np.float),
-                                                           ('area', np.float)])
+        if form == 'both':
+            rec_sar = np.array(zip(mean_result, mean_endemics, areas),
+                               dtype=[('items', np.float), ('endemics',
+                               np.float), ('area', np.float)])
+        else:
+            rec_sar = np.array(zip(mean_result, areas), dtype=[('items',
+                                                np.float), ('area', np.float)])
         return rec_sar, full_result
 
-    def ied(self, criteria, normalize=True, exponent=0.75):
+    def sar_window(self, div_cols, grid, win_list, criteria, step=(1, 1),
+                                                                form='sar'):
         '''
-        Calculates the individual energy distribution for the entire community
-        given the criteria
+        Calculate an empirical species-area relationship from moving windows
+        (non-nested quadrats) placed on a fine grid of cells.
 
         Parameters
         ----------
+        div_cols : tuple
+            Column names to divide, eg, ('x', 'y'). Must be metric.
+        grid : tuple
+            Number of divisions of each div_col in the finest grid of cells,
+            eg, (64, 32). Windows are made of whole cells of this grid.
+        win_list : list of tuples
+            List of window sizes, in cells of grid along each div_col, eg,
+            [(1, 1), (2, 3), (8, 8)].
         criteria : dict
-            Dictionary must have contain a key with the value 'energy'.  See
-            sad method for further requirements.
-        normalize : bool
-            If True, this distribution is normalized by dividing by the lowest
-            energy value within each element of criteria. If False, returns raw
-            energy values.
-        exponent : float
-            The exponent of the allometric scaling relationship if energy is
-            calculated from mass.
+            See docstring for Patch.sad. Here, criteria should only contain
+            the species and count columns and columns with the value 'whole'
+            (any items referring to div_cols are ignored).
+        step : tuple
+            Number of cells that each window is moved along each div_col. The
+            default (1, 1) places a window at every cell of grid.
+        form : string
+            'sar', 'ear' or 'both'. See Patch.sar.
 
         Returns
         -------
-        result : list
-            List of tuples containing results, where first element is 
-            dictionary of criteria for this calculation and second element is a 
-            1D ndarray containing the energy measurement of each individual in
-            the subset.  The third element is the full (not unique) species
-            list for the given criteria. 
+        rec_sar: structured array
+            Returns a structured array with fields 'items' and 'area' that
+            contains the average items/species in the windows of each size
+            (and 'endemics' if form is 'both').
+        full_result : list of ndarrays
+            List of same length as win_list containing arrays with the count
+            of species or endemics in each window of that size. See Patch.sar.
 
         Notes
         -----
-        If count_col is None or is all ones, the entire energy column for each
-        subtable is returned.  Else, the average energy per individual,
-        repeated for each individual is returned. This is equivalent to the psi
-        distribution from Harte (2011).
+        The abundance of each species in each cell of grid is summed once into
+        an integral image (summed-area table). The abundance of all species in
+        any window is then found from four values of the integral image, so
+        windows of any size are counted without filtering the table again.
+        '''
 
+        if form not in ('sar', 'ear', 'both'):
+            raise NotImplementedError('No SAR of form %s available' % form)
 
-        '''
-        
-        spp_list, spp_col, count_col, engy_col, mass_col, combinations = \
-            self.parse_criteria(criteria)
+        # Species abundance in each cell of grid, shape (species, nx, ny)
+        criteria = {k: v for k, v in criteria.items() if k not in div_cols}
+        for i, col in enumerate(div_cols):
+            criteria[col] = grid[i]
+        combinations = self.parse_criteria(criteria)[5]
+        if set(combinations.columns) != set(div_cols):
+            raise ValueError('criteria for sar_window can only split ' +
+                             'div_cols')
+
+        spp_by_cell = self._species_by_cell(criteria)
+        cube = spp_by_cell.reshape((len(spp_by_cell),) + combinations.shape,
+                                                                    order='F')
+        axes = [combinations.columns.index(col) + 1 for col in div_cols]
+        cube = cube.transpose([0] + axes)
+
+        integral = self._cached(('integral', _criteria_key(criteria),
+                        tuple(div_cols)), lambda: integral_image(cube))
+        cell_area = np.prod([self._col_length(col) / grid[i] for i, col in
+                                                        enumerate(div_cols)])
 
-        if engy_col == None and mass_col == None:
-            raise ValueError("No energy or mass column given")
-        elif engy_col == None and mass_col != None:
-            mass = True
-            this_engy = mass_col
-        else:
-            mass = False
-            this_engy = engy_col
+        areas = []
+        mean_result = []
+        mean_endemics = []
+        full_result = []
 
-        result = []
-        for comb in combinations:
+        for win in win_list:
 
-            subtable = self.data_table.get_subtable(comb)
-            
-            # If all counts are not 1
-            if count_col and (not np.all(subtable[count_col] == 1)):
-                
-                # Remove any zero counts
-                subtable = subtable[subtable[count_col] != 0]
-                # Convert counts to ints
-                temp_counts = subtable[count_col].astype(int)
+            counts = window_sums(integral, win, step)
+            counts = counts.reshape(len(counts), -1)
 
-                energy = np.repeat((subtable[this_engy] /
-                        subtable[count_col]), temp_counts)
-                species = np.repeat(subtable[spp_col], temp_counts)
+            spp_full, end_full = sar_ear_counts(counts, form=form,
+                                                    totals=integral[:, -1, -1])
+            if form == 'sar':
+                full_result.append(spp_full)
+                mean_result.append(np.mean(spp_full))
+            elif form == 'ear':
+                full_result.append(end_full)
+                mean_result.append(np.mean(end_full))
             else:
-                energy = subtable[this_engy] 
-                species = subtable[spp_col]
+                full_result.append(np.vstack((spp_full, end_full)))
+                mean_result.append(np.mean(spp_full))
+                mean_endemics.append(np.mean(end_full))
 
-            # Convert mass to energy if mass is True
-            if mass:
-                energy = (energy ** exponent)
-                
-            # Normalizing energy
-            if normalize:
-                energy = energy / np.min(energy)
-            result.append((comb, energy, species))
+            areas.append(cell_area * np.prod(win))
 
-        return result
+        if form == 'both':
+            rec_sar = np.array(zip(mean_result, mean_endemics, areas),
+                               dtype=[('items', np.float), ('endemics',
+                               np.float), ('area', np.float)])
+        else:
+            rec_sar = np.array(zip(mean_result, areas), dtype=[('items',
+                                                np.float), ('area', np.float)])
+        return rec_sar, full_result
 
-    def sed(self, criteria, normalize=True, exponent=0.75, clean=False):
+    def sar_sample(self, div_cols, quad_list, criteria, n_quads=100,
+                            form='sar', seed=None, processes=None):
         '''
-        Calculates the species-level energy distribution for each given species
-        in the community.
+        Calculate an empirical species-area relationship from quadrats placed
+        at random in the patch.
 
         Parameters
         ----------
+        div_cols : tuple
+            Column names giving the location of each record, eg, ('x', 'y').
+            Must be metric.
+        quad_list : list of tuples
+            List of quadrat sizes in the units of div_cols, eg, [(1, 1),
+            (5, 10)].
         criteria : dict
-            Dictionary must have contain a key with the value 'energy' or
-            'mass'.  See sad method for further requirements.
-        normalize : bool
-            If True, this distribution is normalized by dividing by the lowest
-            energy value within each element of criteria. If False, returns raw
-            energy values.
-        exponent : float
-            The exponent of the allometric scaling relationship if energy is
-            calculated from mass
-        clean : bool
-            If False, sed dictionary contains all species.  If True, species
-            with no individuals are removed.  This is useful when subsetting.
+            See docstring for Patch.sad. Here, criteria should only contain
+            the species and count columns and columns with the value 'whole'
+            (any items referring to div_cols are ignored).
+        n_quads : int
+            Number of quadrats of each size.
+        form : string
+            'sar', 'ear' or 'both'. See Patch.sar.
+        seed : int or None
+            Seed for the random placement of quadrats.
+        processes : int or None
+            If given, quadrats are counted in this many parallel threads.
 
         Returns
         -------
-        result : list of tuples
-            Each tuple contains two objects.  The first object is a dict with
-            the division specifications that generated the given species energy
-            distributions.  The second object is a dict with a keyword
-            corresponding to each species in the spp_list.  Each species
-            keyword looks up a np.array that contains the given species
-            energy distribution.
-
-        Note
-        ----
-        The theta distribution from Harte (2011) is a an sed.
+        rec_sar: structured array
+            Returns a structured array with fields 'items' and 'area' that
+            contains the average items/species in the quadrats of each size
+            (and 'endemics' if form is 'both').
+        full_result : list of ndarrays
+            List of same length as quad_list containing arrays with the count
+            of species or endemics in each quadrat of that size. See Patch.sar.
 
+        Notes
+        -----
+        Each quadrat is a half-open rectangle lying entirely inside the patch
+        limits given by the metadata. Records in each quadrat are found with
+        a SpatialIndex over div_cols (see build_spatial_index), so only the
+        records near the edges of a quadrat are looked at individually.
         '''
+
+        self._check_records('sar_sample')
+        if form not in ('sar', 'ear', 'both'):
+            raise NotImplementedError('No SAR of form %s available' % form)
+
+        criteria = {k: v for k, v in criteria.items() if k not in div_cols}
         spp_list, spp_col, count_col, engy_col, mass_col, combinations = \
             self.parse_criteria(criteria)
+        if spp_col == None:
+            raise TypeError('No species column specified in "criteria" ' +
+                                                                   'parameter')
+        if len(combinations) != 1:
+            raise ValueError('criteria for sar_sample can only have whole ' +
+                             'columns')
+
+        table = self.data_table.table
+        spp_ind = self._species_index(spp_col)[1]
+        if count_col:
+            counts = table[count_col]
+        else:
+            counts = np.ones(len(table), dtype=int)
+        totals = np.bincount(spp_ind, weights=counts, minlength=len(spp_list))
+
+        index = self._spatial_index(div_cols)
+        mins = [self.data_table.meta[(col, 'minimum')] for col in div_cols]
+        lengths = [self._col_length(col) for col in div_cols]
+
+        def count_quads(corners):
+            # Abundance of each species (rows) in each quadrat (columns)
+            abund = np.empty((len(spp_list), len(corners)))
+            for i, (x0, y0, x1, y1) in enumerate(corners):
+                rows = index.query_rect(x0, x1, y0, y1)
+                abund[:, i] = np.bincount(spp_ind[rows], weights=counts[rows],
+                                                    minlength=len(spp_list))
+            return sar_ear_counts(abund, form=form, totals=totals)
+
+        rand = np.random.RandomState(seed)
+        areas = []
+        mean_result = []
+        mean_endemics = []
+        full_result = []
 
-        ied = self.ied(criteria, normalize=normalize, exponent=exponent)
+        for quad in quad_list:
+            if quad[0] > lengths[0] or quad[1] > lengths[1]:
+                raise ValueError('Quadrat of size %s does not fit in patch'
+                                                                % str(quad))
+
+            x0 = mins[0] + rand.uniform(0, lengths[0] - quad[0], n_quads)
+            y0 = mins[1] + rand.uniform(0, lengths[1] - quad[1], n_quads)
+            corners = np.column_stack((x0, y0, x0 + quad[0], y0 + quad[1]))
+
+            if processes:
+                pool = ThreadPool(processes)
+                chunks = np.array_split(corners, processes)
+                parts = pool.map(count_quads, chunks)
+                pool.close()
+                pool.join()
+            else:
+                parts = [count_quads(corners)]
 
-        result = []
-        for this_ied in ied:
-            this_criteria_sed = {}
+            if form in ('sar', 'both'):
+                spp_full = np.concatenate([part[0] for part in parts])
+            if form in ('ear', 'both'):
+                end_full = np.concatenate([part[1] for part in parts])
 
-            for spp in spp_list:
-                spp_ind = (spp == this_ied[2])
-                this_spp_sed = this_ied[1][spp_ind]
+            if form == 'sar':
+                full_result.append(spp_full)
+                mean_result.append(np.mean(spp_full))
+            elif form == 'ear':
+                full_result.append(end_full)
+                mean_result.append(np.mean(end_full))
+            else:
+                full_result.append(np.vstack((spp_full, end_full)))
+                mean_result.append(np.mean(spp_full))
+                mean_endemics.append(np.mean(end_full))
+
+            areas.append(quad[0] * quad[1])
+
+        if form == 'both':
+            rec_sar = np.array(zip(mean_result, mean_endemics, areas),
+                               dtype=[('items', np.float), ('endemics',
+                               np.float), ('area', np.float)])
+        else:
+            rec_sar = np.array(zip(mean_result, areas), dtype=[('items',
+                                                np.float), ('area', np.float)])
+        return rec_sar, full_result
+
+    def comm(self, div_cols, div_list, criteria):
+        '''
+        Calculates commonality (shared species and Sorensen similarity)
+        between all pairs of sub-patches for each division given in div_list.
+
+        Parameters
+        ----------
+        div_cols : tuple
+            Column names to divide, eg, ('x', 'y'). Must be metric.
+        div_list : list of tuples
+            List of division pairs in same order as div_cols, eg, [(2,2),
+            (2,4), (4,4)]. Values are number of divisions of div_col.
+        criteria : dict
+            See docstring for Patch.sad. Here, criteria should only contain
+            the species and count columns and columns with the value 'whole'
+            (any items referring to div_cols are ignored).
+
+        Returns
+        -------
+        result : list of structured arrays
+            List of same length as div_list. Each structured array has one
+            row for each pair of sub-patches with fields 'cell1' and 'cell2'
+            (index of the sub-patches in the order of Patch.sad), 'dist'
+            (distance between the sub-patch centers), 'shared' (number of
+            species found in both) and 'sorensen' (Sorensen similarity, nan if
+            neither sub-patch holds any species).
+
+        Notes
+        -----
+        The presence of each species in each sub-patch is held in a sparse
+        matrix P, so the number of species shared by every pair of sub-patches
+        is the product P * P.T. The product is kept sparse, and only the pairs
+        sharing species are written into the result. Distances between
+        centers are computed for all pairs at once.
+        '''
+
+        criteria = {k: v for k, v in criteria.items() if k not in div_cols}
+
+        result = []
+        for div in div_list:
+
+            this_criteria = deepcopy(criteria)
+            for i, col in enumerate(div_cols):
+                this_criteria[col] = div[i]
+            combinations = self.parse_criteria(this_criteria)[5]
+            if set(combinations.columns) != set(div_cols):
+                raise ValueError('criteria for comm can only split div_cols')
+
+            # Presence of each species (columns) in each sub-patch (rows)
+            presence = sparse.csr_matrix(
+                        self._species_by_cell(this_criteria).T > 0, dtype=int)
+            richness = np.asarray(presence.sum(axis=1)).ravel()
+            n_cells = len(richness)
+
+            # Pairs with shared species, at their position in the pair order
+            shared_all = sparse.triu(presence * presence.T, 1).tocoo()
+            row, col = shared_all.row, shared_all.col
+            pos = row * n_cells - row * (row + 1) // 2 + col - row - 1
+            cell1, cell2 = np.triu_indices(n_cells, 1)
+            shared = np.zeros(len(cell1), dtype=int)
+            shared[pos] = shared_all.data
+            denom = richness[cell1] + richness[cell2]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                sorensen = np.where(denom > 0, 2 * shared / denom, np.nan)
+
+            centers = self.get_sp_centers(div_cols, this_criteria)
+            dist = np.sqrt(np.sum((centers[cell1] - centers[cell2]) ** 2,
+                                                                    axis=1))
+
+            this_result = np.empty(len(cell1), dtype=[('cell1', int),
+                            ('cell2', int), ('dist', np.float), ('shared', int),
+                            ('sorensen', np.float)])
+            this_result['cell1'] = cell1
+            this_result['cell2'] = cell2
+            this_result['dist'] = dist
+            this_result['shared'] = shared
+            this_result['sorensen'] = sorensen
+            result.append(this_result)
+
+        return result
+
+    def get_sp_centers(self, div_cols, criteria):
+        '''
+        Returns the centers of the sub-patches made by criteria.
+
+        Parameters
+        ----------
+        div_cols : tuple
+            Column names giving the location of each record, eg, ('x', 'y').
+            Must be metric and divided in criteria.
+        criteria : dict
+            See docstring for Patch.sad.
+
+        Returns
+        -------
+        : ndarray
+            2D array with one row for each combination of criteria, in the
+            order of Patch.sad, giving the center of the sub-patch along each
+            of div_cols.
+        '''
+
+        combinations = self.parse_criteria(criteria)[5]
+        level_ind = combinations.level_index()
+
+        centers = np.empty((len(combinations), len(div_cols)))
+        for i, col in enumerate(div_cols):
+            j = combinations.columns.index(col)
+            mids = np.array([(lvl[0][1] + lvl[1][1]) / 2 for lvl in
+                                                    combinations.levels[j]])
+            centers[:, i] = mids[level_ind[:, j]]
+        return centers
+
+    def _col_length(self, col):
+        '''Returns the length of metric column col given by the metadata.'''
+        dmin = self.data_table.meta[(col, 'minimum')]
+        dmax = self.data_table.meta[(col, 'maximum')]
+        dprec = self.data_table.meta[(col, 'precision')]
+        return dmax + dprec - dmin
+
+    def ied(self, criteria, normalize=True, exponent=0.75, weighted=False):
+        '''
+        Calculates the individual energy distribution for the entire community
+        given the criteria
+
+        Parameters
+        ----------
+        criteria : dict
+            Dictionary must have contain a key with the value 'energy'.  See
+            sad method for further requirements.
+        normalize : bool
+            If True, this distribution is normalized by dividing by the lowest
+            energy value within each element of criteria. If False, returns raw
+            energy values.
+        exponent : float
+            The exponent of the allometric scaling relationship if energy is
+            calculated from mass.
+        weighted : bool
+            If True, the energy of each record is returned once as a weighted
+            sample (see distributions.weighted_sample) whose weights are the
+            counts of the record, instead of being repeated for each
+            individual.
+
+        Returns
+        -------
+        result : list
+            List of tuples containing results, where first element is 
+            dictionary of criteria for this calculation and second element is a 
+            1D ndarray containing the energy measurement of each individual in
+            the subset.  The third element is the full (not unique) species
+            list for the given criteria. If weighted is True, the second
+            element is a weighted sample and the third element has one species
+            per record.
+
+        Notes
+        -----
+        If count_col is None or is all ones, the entire energy column for each
+        subtable is returned.  Else, the average energy per individual,
+        repeated for each individual is returned. This is equivalent to the psi
+        distribution from Harte (2011).
+
+
+        '''
+
+        self._check_records('ied')
+        spp_list = self.parse_criteria(criteria)[0]
+        return [(comb, energy, spp_list[spp_ind]) for comb, energy, spp_ind in
+                self._ied(criteria, normalize, exponent, weighted)]
+
+    def _ied(self, criteria, normalize, exponent, weighted):
+        '''
+        Returns ied, with the index of each species in the species list of
+        criteria in place of the species.
+        '''
+        
+        spp_list, spp_col, count_col, engy_col, mass_col, combinations = \
+            self.parse_criteria(criteria)
+
+        if engy_col == None and mass_col == None:
+            raise ValueError("No energy or mass column given")
+        elif engy_col == None and mass_col != None:
+            mass = True
+            this_engy = mass_col
+        else:
+            mass = False
+            this_engy = engy_col
+
+        spp_ind = self._species_index(spp_col)[1]
+        order, bounds = self._cell_rows(criteria)
+
+        result = []
+        for i, comb in enumerate(combinations):
+
+            rows = order[bounds[i]:bounds[i + 1]]
+            subtable = self.data_table.table[rows]
+            
+            # If all counts are not 1
+            if count_col and (not np.all(subtable[count_col] == 1)):
+                
+                # Remove any zero counts
+                nonzero = subtable[count_col] != 0
+                subtable = subtable[nonzero]
+                rows = rows[nonzero]
+                # Convert counts to ints
+                temp_counts = subtable[count_col].astype(int)
+
+                energy = subtable[this_engy] / subtable[count_col]
+                species = spp_ind[rows]
+                if not weighted:
+                    energy = np.repeat(energy, temp_counts)
+                    species = np.repeat(species, temp_counts)
+            else:
+                energy = subtable[this_engy] 
+                species = spp_ind[rows]
+                temp_counts = np.ones(len(subtable), dtype=int)
+
+            # Convert mass to energy if mass is True
+            if mass:
+                energy = (energy ** exponent)
+                
+            # Normalizing energy
+            if normalize:
+                energy = energy / np.min(energy)
+
+            if weighted:
+                energy = weighted_sample(energy, temp_counts)
+            result.append((comb, energy, species))
+
+        return result
+
+    def sed(self, criteria, normalize=True, exponent=0.75, clean=False,
+                                                            weighted=False):
+        '''
+        Calculates the species-level energy distribution for each given species
+        in the community.
+
+        Parameters
+        ----------
+        criteria : dict
+            Dictionary must have contain a key with the value 'energy' or
+            'mass'.  See sad method for further requirements.
+        normalize : bool
+            If True, this distribution is normalized by dividing by the lowest
+            energy value within each element of criteria. If False, returns raw
+            energy values.
+        exponent : float
+            The exponent of the allometric scaling relationship if energy is
+            calculated from mass
+        clean : bool
+            If False, sed dictionary contains all species.  If True, species
+            with no individuals are removed.  This is useful when subsetting.
+        weighted : bool
+            If True, each species energy distribution is a weighted sample.
+            See Patch.ied.
+
+        Returns
+        -------
+        result : list of tuples
+            Each tuple contains two objects.  The first object is a dict with
+            the division specifications that generated the given species energy
+            distributions.  The second object is a dict with a keyword
+            corresponding to each species in the spp_list.  Each species
+            keyword looks up a np.array that contains the given species
+            energy distribution.
+
+        Note
+        ----
+        The theta distribution from Harte (2011) is a an sed.
+
+        '''
+        self._check_records('sed')
+        spp_list, spp_col, count_col, engy_col, mass_col, combinations = \
+            self.parse_criteria(criteria)
+
+        ied = self._ied(criteria, normalize, exponent, weighted)
+
+        result = []
+        for this_ied in ied:
+            this_criteria_sed = {}
+
+            # Group individuals by index of species with one stable sort
+            order, groups = group_by_species(this_ied[2])
+            sorted_engy = this_ied[1][order]
+
+            for ind, spp in enumerate(spp_list):
+                start, stop = groups.get(ind, (0, 0))
+                this_spp_sed = sorted_engy[start:stop]
 
                 if clean: # If True, don't add empty species lists
                     if len(this_spp_sed) > 0:
@@ -522,23 +1534,898 @@ class Patch:
 
         '''
 
-        sed = self.sed(criteria, normalize=normalize, exponent=exponent)
+        self._check_records('ased')
+        spp_list = self.parse_criteria(criteria)[0]
+        ied = self._ied(criteria, normalize, exponent, True)
 
         result = []
-        for this_sed in sed:
-            spp_list = list(this_sed[1].viewkeys())
-            spp_list.sort()
-
-            # Take the mean energy for each species
-            nu = [np.mean(this_sed[1][spp]) for spp in spp_list if
-                                                    len(this_sed[1][spp]) != 0]
-            # Truncated spp_list if necessary
-            spp_list = [spp for spp in spp_list if len(this_sed[1][spp]) != 0]
-            
-            result.append((this_sed[0], np.array(nu), np.array(spp_list)))
+        for this_ied in ied:
+            vals, wts = split_weighted(this_ied[1])
+
+            # Sum energy and individuals of each species with bincount
+            spp_ind = this_ied[2]
+            tot_engy = np.bincount(spp_ind, weights=vals * wts,
+                                                    minlength=len(spp_list))
+            tot_ind = np.bincount(spp_ind, weights=wts,
+                                                    minlength=len(spp_list))
+
+            # Drop species with no individuals
+            present = tot_ind > 0
+            nu = tot_engy[present] / tot_ind[present]
+
+            result.append((this_ied[0], nu, spp_list[present]))
+
+        return result
+
+    def o_ring(self, div_cols, bin_edges, criteria, pairs=None):
+        '''
+        Calculates the O-ring statistic and pair-correlation function g(r)
+        of the point pattern of each species, and optionally of pairs of
+        species.
+
+        Parameters
+        ----------
+        div_cols : tuple
+            Column names giving the location of each record, eg, ('x', 'y').
+            Must be metric.
+        bin_edges : array-like
+            Increasing distances giving the edges of the rings (annuli).
+        criteria : dict
+            See docstring for Patch.sad. Each combination of criteria is
+            analyzed separately (any items referring to div_cols are
+            ignored).
+        pairs : None, 'all' or list of tuples
+            If None, only the pattern of each species with itself is
+            analyzed. If 'all', every ordered pair of different species is
+            also analyzed, otherwise only the (focal, other) species pairs in
+            the list.
+
+        Returns
+        -------
+        result : list of tuples
+            List of tuples containing results, where the first element is a
+            dictionary of criteria for this calculation and the second element
+            is a dictionary. It has a key for each species present, and for
+            each (focal, other) pair of species present if pairs is given,
+            that looks up a structured array with one row per ring and fields
+            'r' (mid distance of the ring), 'pairs' (number of pairs of
+            individuals in the ring), 'o_ring' and 'g'.
+
+        Notes
+        -----
+        O(r) is the mean density of (other) individuals in the ring (r_k,
+        r_k+1] around each focal individual and g(r) = O(r) / lambda, where
+        lambda is the density of (other) individuals in the whole area given
+        by the metadata of div_cols (Wiegand and Moloney 2004). No edge
+        correction is made. Individuals at the same point are not counted as
+        pairs. The records of each species are split into groups with the
+        same count, with a KD-tree for each group. Pairs in all rings are
+        counted with one unweighted dual traversal of two trees
+        (scipy.spatial.cKDTree.count_neighbors) for each pair of groups,
+        multiplied by the counts of the two groups, so no list of neighbors
+        is ever built.
+        '''
+
+        self._check_records('o_ring')
+        criteria = {k: v for k, v in criteria.items() if k not in div_cols}
+        spp_list, spp_col, count_col, engy_col, mass_col, combinations = \
+            self.parse_criteria(criteria)
+        if spp_col == None:
+            raise TypeError('No species column specified in "criteria" ' +
+                                                                   'parameter')
+
+        bin_edges = np.asarray(bin_edges, dtype=float)
+        ring_area = np.pi * np.diff(bin_edges ** 2)
+        mids = (bin_edges[1:] + bin_edges[:-1]) / 2
+        area = np.prod([self._col_length(col) for col in div_cols])
+
+        table = self.data_table.table
+        points = np.column_stack([table[col] for col in div_cols])
+        spp_ind = self._species_index(spp_col)[1]
+        if count_col:
+            counts = table[count_col].astype(float)
+        else:
+            counts = np.ones(len(table))
+        order, bounds = self._cell_rows(criteria)
+
+        result = []
+        for i, comb in enumerate(combinations):
+
+            rows = order[bounds[i]:bounds[i + 1]]
+            rows = rows[counts[rows] > 0]
+            spp_order, groups = group_by_species(spp_ind[rows])
+
+            # Trees of the records with each count, and number of
+            # individuals, of each species present. Weighted count_neighbors
+            # between trees of different sizes is unreliable in scipy.
+            trees = {}
+            nind = {}
+            for ind, (start, stop) in groups.iteritems():
+                spp_rows = rows[spp_order[start:stop]]
+                trees[spp_list[ind]] = [(count,
+                        cKDTree(points[spp_rows[counts[spp_rows] == count]]))
+                        for count in np.unique(counts[spp_rows])]
+                nind[spp_list[ind]] = np.sum(counts[spp_rows])
+
+            if pairs is None:
+                spp_pairs = [(spp, spp) for spp in sorted(trees)]
+            elif pairs == 'all':
+                spp_pairs = list(itertools.product(sorted(trees), repeat=2))
+            else:
+                spp_pairs = [(spp, spp) for spp in sorted(trees)] + \
+                    [pair for pair in pairs if pair[0] in trees and pair[1]
+                                                    in trees]
+
+            stats = {}
+            for focal, other in spp_pairs:
+                cum = np.zeros(len(bin_edges))
+                for count1, tree1 in trees[focal]:
+                    for count2, tree2 in trees[other]:
+                        cum += count1 * count2 * tree1.count_neighbors(tree2,
+                                                                    bin_edges)
+                ring_pairs = np.diff(cum)
+                o_ring = ring_pairs / (nind[focal] * ring_area)
+
+                this_stats = np.empty(len(mids), dtype=[('r', np.float),
+                    ('pairs', np.float), ('o_ring', np.float), ('g',
+                    np.float)])
+                this_stats['r'] = mids
+                this_stats['pairs'] = ring_pairs
+                this_stats['o_ring'] = o_ring
+                this_stats['g'] = o_ring / (nind[other] / area)
+
+                if focal == other:
+                    stats[focal] = this_stats
+                else:
+                    stats[(focal, other)] = this_stats
+
+            result.append((comb, stats))
 
         return result
 
+    def census_tensor(self, time_col, div_cols, grid, criteria):
+        '''
+        Builds the abundance of each species in each cell of a grid in each
+        census in one pass over the table.
+
+        Parameters
+        ----------
+        time_col : str
+            Column giving the census (eg, year) of each record.
+        div_cols : tuple
+            Column names to divide, eg, ('x', 'y'). Must be metric.
+        grid : tuple
+            Number of divisions of each div_col in the finest grid of cells.
+            Sub-patches analyzed from the tensor are blocks of these cells.
+        criteria : dict
+            See docstring for Patch.sad. Here, criteria should only contain
+            the species and count columns and columns with the value 'whole'
+            (any items referring to time_col or div_cols are ignored).
+
+        Returns
+        -------
+        : object of class CensusTensor
+            Sparse (census, cell, species) abundances with methods giving the
+            sad, sar, turnover and species-time relationship of each census.
+        '''
+
+        self._check_records('census_tensor')
+        criteria = {k: v for k, v in criteria.items() if k not in div_cols
+                                                            and k != time_col}
+        for i, col in enumerate(div_cols):
+            criteria[col] = grid[i]
+        spp_list, spp_col, count_col, engy_col, mass_col, combinations = \
+            self.parse_criteria(criteria)
+        if spp_col == None:
+            raise TypeError('No species column specified in "criteria" ' +
+                                                                   'parameter')
+        if set(combinations.columns) != set(div_cols):
+            raise ValueError('criteria for census_tensor can only split ' +
+                             'div_cols')
+
+        def build():
+            table = self.data_table.table
+            times, time_ind = np.unique(table[time_col], return_inverse=True)
+            cell = self._cell_index(criteria)
+            spp_ind = self._species_index(spp_col)[1]
+            if count_col:
+                counts = table[count_col]
+            else:
+                counts = np.ones(len(table), dtype=int)
+
+            valid = cell >= 0
+            ncells = len(combinations)
+            counts = sparse.coo_matrix((counts[valid], (time_ind[valid] *
+                        ncells + cell[valid], spp_ind[valid])),
+                        shape=(len(times) * ncells, len(spp_list)))
+
+            level_ind = combinations.level_index()
+            coords = level_ind[:, [combinations.columns.index(col) for col in
+                                                                    div_cols]]
+            cell_area = np.prod([self._col_length(col) / grid[i] for i, col
+                                                    in enumerate(div_cols)])
+            return CensusTensor(counts, times, spp_list, grid, coords,
+                                                                    cell_area)
+
+        return self._cached(('tensor', time_col, tuple(div_cols),
+                                            _criteria_key(criteria)), build)
+
+    def sta(self, time_col, div_cols, div_list, criteria):
+        '''
+        Calculates an empirical species-time-area relationship, the mean
+        number of species found in a sub-patch over runs of consecutive
+        censuses.
+
+        Parameters
+        ----------
+        time_col : str
+            Column giving the census (eg, year) of each record. Each unique
+            value is one census.
+        div_cols : tuple
+            Column names to divide, eg, ('x', 'y'). Must be metric.
+        div_list : list of tuples
+            List of division pairs in same order as div_cols, eg, [(2,2),
+            (2,4), (4,4)]. Values are number of divisions of div_col.
+        criteria : dict
+            See docstring for Patch.sad. Here, criteria should only contain
+            the species and count columns and columns with the value 'whole'
+            (any items referring to time_col or div_cols are ignored).
+
+        Returns
+        -------
+        rec_sta : structured array
+            Structured array with fields 'items', 'area' and 'time', with one
+            row for each division in div_list and each number of consecutive
+            censuses from 1 to the number of censuses. 'items' is the mean
+            number of species found in a sub-patch of that area over that
+            many consecutive censuses, averaged over sub-patches and starting
+            censuses.
+
+        Notes
+        -----
+        The species present in each sub-patch in each census are held as
+        packed bit sets (see pack_presence). Species found over a run of
+        censuses are the union (bitwise or) of the sets of each census, which
+        is extended one census at a time, and richness is the popcount of the
+        union.
+        '''
+
+        criteria = {k: v for k, v in criteria.items() if k not in div_cols
+                                                            and k != time_col}
+
+        items = []
+        areas = []
+        times = []
+
+        for div in div_list:
+
+            this_criteria = deepcopy(criteria)
+            this_criteria[time_col] = 'split'
+            for i, col in enumerate(div_cols):
+                this_criteria[col] = div[i]
+            combinations = self.parse_criteria(this_criteria)[5]
+            if set(combinations.columns) != set(div_cols) | set([time_col]):
+                raise ValueError('criteria for sta can only split time_col ' +
+                                 'and div_cols')
+
+            # Packed presence with shape (census, sub-patch, bytes)
+            packed = self._presence_by_cell(this_criteria)
+            time_axis = combinations.columns.index(time_col)
+            packed = packed.reshape(combinations.shape + (-1,), order='F')
+            packed = np.rollaxis(packed, time_axis)
+            ntime = len(packed)
+            packed = packed.reshape(ntime, -1, packed.shape[-1])
+
+            # Sum richness over starting censuses for each run length
+            totals = np.zeros(ntime)
+            for start in range(ntime):
+                union = np.zeros_like(packed[0])
+                for length in range(1, ntime - start + 1):
+                    union |= packed[start + length - 1]
+                    totals[length - 1] += np.mean(popcount(union))
+
+            area = 1
+            for i, col in enumerate(div_cols):
+                area *= self._col_length(col) / div[i]
+
+            items.extend(totals / np.arange(ntime, 0, -1))
+            areas.extend([area] * ntime)
+            times.extend(range(1, ntime + 1))
+
+        return np.array(zip(items, areas, times), dtype=[('items', np.float),
+                                        ('area', np.float), ('time', int)])
+
+    def rarefaction(self, criteria, n_samples=None):
+        '''
+        Calculates the expected number of species in random samples of
+        individuals (rarefaction curve) for each combination of criteria.
+
+        Parameters
+        ----------
+        criteria : dict
+            See docstring for Patch.sad.
+        n_samples : array-like or None
+            Sample sizes (numbers of individuals) at which to calculate the
+            expected number of species. If None, every sample size from 1 to
+            the number of individuals in each combination is used.
+
+        Returns
+        -------
+        result : list of tuples
+            List of tuples containing results, where the first element is a
+            dictionary of criteria for this calculation, the second element is
+            a 1D array of sample sizes and the third element is a 1D array of
+            the expected number of species at each sample size.
+
+        Notes
+        -----
+        See rarefy.
+        '''
+
+        result = []
+        for comb, sad_list, spp_list in self.sad(criteria):
+            if n_samples is None:
+                this_n = np.arange(1, np.sum(sad_list) + 1)
+            else:
+                this_n = np.asarray(n_samples)
+            result.append((comb, this_n, rarefy(sad_list, this_n)))
+
+        return result
+
+
+class CensusTensor(object):
+    '''
+    Abundance of each species in each cell of a grid in each census, stored
+    sparsely.
+
+    Parameters
+    ----------
+    counts : scipy.sparse matrix
+        Matrix with one row for each census and cell, census by census, and
+        one column for each species.
+    times : ndarray
+        Census (eg, year) of each block of rows, in order.
+    spp_list : ndarray
+        Species of each column.
+    grid : tuple
+        Number of cells along each div_col.
+    coords : ndarray
+        2D array giving the index of each cell along each div_col.
+    cell_area : float
+        Area of one cell.
+
+    Attributes
+    ----------
+    shape : tuple
+        Number of censuses, cells and species.
+
+    Notes
+    -----
+    Made by Patch.census_tensor. Analyses of all censuses read the tensor
+    instead of the table. Sub-patches made of blocks of cells are found by
+    summing the cells of each block with one sparse matrix operation.
+    '''
+
+    def __init__(self, counts, times, spp_list, grid, coords, cell_area):
+        '''Initialize CensusTensor object. See class docstring.'''
+
+        self.counts = sparse.csr_matrix(counts)
+        self.counts.eliminate_zeros()
+        self.times = times
+        self.spp_list = spp_list
+        self.grid = tuple(grid)
+        self.coords = coords
+        self.cell_area = cell_area
+        self.shape = (len(times), len(coords), len(spp_list))
+
+    def sad(self):
+        '''
+        Returns a list of tuples of each census and the abundance of each
+        species (in the order of spp_list) in the whole patch in that census.
+        '''
+        totals = self._totals()
+        return [(time, totals[i]) for i, time in enumerate(self.times)]
+
+    def _totals(self):
+        '''Returns the array of the abundance of each species in each census.'''
+        ntime, ncells, nspp = self.shape
+        coo = self.counts.tocoo()
+        return np.bincount((coo.row // ncells) * nspp + coo.col,
+                    weights=coo.data, minlength=ntime * nspp).reshape(ntime,
+                    nspp).astype(self.counts.dtype)
+
+    def blocks(self, div):
+        '''
+        Returns a sparse matrix of the abundance of each species (columns) in
+        each sub-patch made by dividing the grid into div blocks along each
+        div_col, census by census (rows). Each element of grid must be a
+        multiple of the element of div.
+        '''
+
+        ntime, ncells, nspp = self.shape
+        block = np.zeros(ncells, dtype=int)
+        for i, (ncell, ndiv) in enumerate(zip(self.grid, div)):
+            if ndiv <= 0 or ncell % ndiv != 0:
+                raise ValueError('Grid of %s cells cannot be divided into %s '
+                                                    % (ncell, ndiv) + 'blocks')
+            block = block * ndiv + self.coords[:, i] // (ncell // ndiv)
+
+        nblocks = int(np.prod(div))
+        coo = self.counts.tocoo()
+        rows = (coo.row // ncells) * nblocks + block[coo.row % ncells]
+        return sparse.csr_matrix((coo.data, (rows, coo.col)),
+                                            shape=(ntime * nblocks, nspp))
+
+    def sar(self, div_list, form='sar'):
+        '''
+        Calculates the species-area relationship of each census.
+
+        Parameters
+        ----------
+        div_list : list of tuples
+            List of divisions of the grid along each div_col, eg, [(1, 1),
+            (2, 2)]. Each division must divide the grid evenly.
+        form : string
+            'sar', 'ear' or 'both'. See Patch.sar.
+
+        Returns
+        -------
+        result : list of tuples
+            List with a tuple for each census, in order, of the census and the
+            rec_sar and full_result that Patch.sar returns for it.
+        '''
+
+        if form not in ('sar', 'ear', 'both'):
+            raise NotImplementedError('No SAR of form %s available' % form)
+
+        ntime, ncells, nspp = self.shape
+        totals = self._totals()
+        spp_full = []
+        end_full = []
+        areas = []
+
+        for div in div_list:
+            nblocks = int(np.prod(div))
+            blocks = self.blocks(div).tocoo()
+            time = blocks.row // nblocks
+
+            # Species present, and those with all individuals, in each block
+            spp_full.append(np.bincount(blocks.row, weights=blocks.data > 0,
+                    minlength=ntime * nblocks).reshape(ntime, nblocks))
+            endemic = (blocks.data > 0) & (blocks.data ==
+                                                    totals[time, blocks.col])
+            end_full.append(np.bincount(blocks.row, weights=endemic,
+                    minlength=ntime * nblocks).reshape(ntime, nblocks))
+            areas.append(self.cell_area * ncells / nblocks)
+
+        result = []
+        for t, time in enumerate(self.times):
+            spp = [full[t].astype(int) for full in spp_full]
+            end = [full[t].astype(int) for full in end_full]
+            if form == 'sar':
+                rec_sar = np.array(zip([np.mean(x) for x in spp], areas),
+                            dtype=[('items', np.float), ('area', np.float)])
+                full_result = spp
+            elif form == 'ear':
+                rec_sar = np.array(zip([np.mean(x) for x in end], areas),
+                            dtype=[('items', np.float), ('area', np.float)])
+                full_result = end
+            else:
+                rec_sar = np.array(zip([np.mean(x) for x in spp],
+                            [np.mean(x) for x in end], areas),
+                            dtype=[('items', np.float), ('endemics',
+                            np.float), ('area', np.float)])
+                full_result = [np.vstack(x) for x in zip(spp, end)]
+            result.append((time, rec_sar, full_result))
+
+        return result
+
+    def turnover(self):
+        '''
+        Returns a structured array with one row for each pair of consecutive
+        censuses, with fields 'time1', 'time2', 'shared', 'gained' and 'lost'
+        giving the number of species in the patch found in both, only in the
+        second and only in the first census.
+        '''
+
+        present = self._totals() > 0
+        first = present[:-1]
+        second = present[1:]
+
+        result = np.empty(len(first), dtype=[('time1', self.times.dtype),
+                        ('time2', self.times.dtype), ('shared', int),
+                        ('gained', int), ('lost', int)])
+        result['time1'] = self.times[:-1]
+        result['time2'] = self.times[1:]
+        result['shared'] = np.sum(first & second, axis=1)
+        result['gained'] = np.sum(~first & second, axis=1)
+        result['lost'] = np.sum(first & ~second, axis=1)
+        return result
+
+    def species_time(self):
+        '''
+        Returns the mean number of species found in the patch over runs of 1
+        to all consecutive censuses, averaged over starting censuses.
+        '''
+
+        present = self._totals() > 0
+        ntime = len(present)
+        totals = np.zeros(ntime)
+        for start in range(ntime):
+            seen = np.logical_or.accumulate(present[start:], axis=0)
+            totals[:ntime - start] += np.sum(seen, axis=1)
+        return totals / np.arange(ntime, 0, -1)
+
+
+class Combinations(object):
+    '''
+    Lazy sequence of all combinations of the levels of criteria columns.
+
+    Parameters
+    ----------
+    columns : list
+        Names of the columns in criteria that have levels.
+    levels : list of lists
+        Levels of each column, in the same order as columns. Each level is a
+        condition or list of conditions as used by DataTable.get_subtable.
+
+    Notes
+    -----
+    Combinations are generated as they are needed, so no list of all
+    combinations is ever built. The first column varies fastest. A
+    Combinations object with no columns holds a single empty dict. Indexing
+    returns the combination at that position and a Combinations object
+    compares equal to a list holding the same combinations.
+    '''
+
+    def __init__(self, columns, levels):
+        '''Initialize Combinations object. See class docstring.'''
+
+        self.columns = list(columns)
+        self.levels = [list(lvl) for lvl in levels]
+        self.shape = tuple(len(lvl) for lvl in self.levels)
+
+    def __len__(self):
+        return int(np.prod(self.shape))
+
+    def __iter__(self):
+        # itertools.product varies the last item fastest, so reverse columns
+        for rev_comb in itertools.product(*self.levels[::-1]):
+            yield dict(zip(self.columns, rev_comb[::-1]))
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError('Combination index out of range')
+        if len(self.columns) == 0:
+            return {}
+        level_ind = np.unravel_index(index, self.shape, order='F')
+        return dict((col, self.levels[i][level_ind[i]]) for i, col in
+                                                    enumerate(self.columns))
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def level_index(self):
+        '''
+        Returns a 2D array with one row for each combination, in order, giving
+        the index of the level of each column in the combination.
+        '''
+        if len(self.columns) == 0:
+            return np.zeros((1, 0), dtype=int)
+        ind = np.arange(len(self))
+        return np.array(np.unravel_index(ind, self.shape, order='F'),
+                                    dtype=int).reshape(len(self.columns), -1).T
+
+
+class SpatialIndex(object):
+    '''
+    Spatial index that sorts points along a Morton (Z-order) curve, so that
+    each node of the implied quadtree holds a contiguous range of points.
+
+    Parameters
+    ----------
+    x, y : ndarray
+        Coordinates of the points.
+    bits : int
+        Number of bits of each coordinate in the Morton code, which sets the
+        depth of the quadtree. At most 26.
+    leaf_size : int
+        Nodes holding this many points or fewer are not split further.
+
+    Attributes
+    ----------
+    order : ndarray
+        Indices of the points in Morton order. Positions returned by the
+        range methods are positions in this order.
+    codes : ndarray
+        Sorted Morton codes of the points.
+
+    Notes
+    -----
+    A query walks down the quadtree from the root one level at a time,
+    keeping nodes that lie inside the query region whole and splitting nodes
+    that straddle its edge, so only the nodes along the edge of the region
+    are visited. The points of each node are found with a binary search of
+    the sorted codes. If the points are stored in Morton order (see
+    Patch.build_spatial_index), the ranges are ranges of rows of the table.
+    Patch.sar_sample queries it for its random quadrats.
+    '''
+
+    def __init__(self, x, y, bits=16, leaf_size=16):
+        '''Initialize SpatialIndex object. See class docstring.'''
+
+        if bits > 26:
+            raise ValueError('bits must be at most 26')
+        self.bits = bits
+        self.leaf_size = leaf_size
+
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        self.mins = (np.min(x), np.min(y)) if len(x) else (0., 0.)
+        maxs = (np.max(x), np.max(y)) if len(x) else (0., 0.)
+        # Widen cells slightly so the maximum falls in the last cell
+        self.widths = tuple(max(maxs[i] - self.mins[i], 1e-12) * (1 + 1e-9) /
+                                                2 ** bits for i in range(2))
+
+        codes = morton_code(self._cell(x, 0), self._cell(y, 1))
+        self.order = np.argsort(codes, kind='mergesort')
+        self.codes = codes[self.order]
+        self.x = x[self.order]
+        self.y = y[self.order]
+
+    def _cell(self, values, axis):
+        '''Returns the finest quadtree cell of values along axis.'''
+        ind = np.floor((values - self.mins[axis]) / self.widths[axis])
+        return np.clip(ind, 0, 2 ** self.bits - 1).astype(np.int64)
+
+    def _ranges(self, classify):
+        '''
+        Returns the ranges of positions of the nodes that classify finds
+        inside (2) and on the edge of (1) a region, as two arrays of shape
+        (k, 2) sorted by position. classify takes arrays of the x and y limits
+        of nodes and returns an array.
+        '''
+
+        inner = []
+        edge = []
+        ix = np.zeros(1, dtype=np.int64)
+        iy = np.zeros(1, dtype=np.int64)
+        code = np.zeros(1, dtype=np.int64)
+
+        # Visit the nodes of each level of the quadtree at once
+        for level in range(self.bits, -1, -1):
+            size = 2 ** level
+            x0 = self.mins[0] + ix * self.widths[0]
+            y0 = self.mins[1] + iy * self.widths[1]
+            where = classify(x0, x0 + size * self.widths[0], y0,
+                                                    y0 + size * self.widths[1])
+            start = np.searchsorted(self.codes, code)
+            stop = np.searchsorted(self.codes, code + size ** 2)
+
+            keep = (where > 0) & (stop > start)
+            ix, iy, code, where, start, stop = [arr[keep] for arr in
+                                            (ix, iy, code, where, start, stop)]
+
+            is_inner = where == 2
+            inner.append(np.column_stack((start[is_inner], stop[is_inner])))
+
+            # Nodes with few points or a single location are not split
+            is_leaf = ~is_inner & ((level == 0) | (stop - start <=
+                    self.leaf_size) | (self.codes[np.maximum(stop - 1, 0)] ==
+                    self.codes[np.minimum(start, len(self.codes) - 1)]))
+            edge.append(np.column_stack((start[is_leaf], stop[is_leaf])))
+
+            split = ~is_inner & ~is_leaf
+            if not np.any(split):
+                break
+            half = size // 2
+            quads = np.arange(4)
+            ix = (ix[split][:, np.newaxis] + (quads & 1) * half).ravel()
+            iy = (iy[split][:, np.newaxis] + (quads >> 1) * half).ravel()
+            code = (code[split][:, np.newaxis] + quads * half ** 2).ravel()
+
+        inner = np.vstack(inner).astype(int)
+        edge = np.vstack(edge).astype(int)
+        return (inner[np.argsort(inner[:, 0])], edge[np.argsort(edge[:, 0])])
+
+    def rect_ranges(self, x0, x1, y0, y1):
+        '''
+        Returns ranges of positions of the points with x0 <= x < x1 and
+        y0 <= y < y1. The first array holds ranges whose points are all in
+        the rectangle and the second ranges whose points may not be.
+        '''
+
+        def classify(nx0, nx1, ny0, ny1):
+            outside = (nx1 <= x0) | (nx0 >= x1) | (ny1 <= y0) | (ny0 >= y1)
+            inside = (nx0 >= x0) & (nx1 <= x1) & (ny0 >= y0) & (ny1 <= y1)
+            return np.where(outside, 0, np.where(inside, 2, 1))
+
+        return self._ranges(classify)
+
+    def radius_ranges(self, cx, cy, radius):
+        '''
+        Returns ranges of positions of the points within radius of (cx, cy).
+        See rect_ranges.
+        '''
+
+        def classify(nx0, nx1, ny0, ny1):
+            near_x = np.minimum(np.maximum(cx, nx0), nx1) - cx
+            near_y = np.minimum(np.maximum(cy, ny0), ny1) - cy
+            far_x = np.maximum(np.abs(nx0 - cx), np.abs(nx1 - cx))
+            far_y = np.maximum(np.abs(ny0 - cy), np.abs(ny1 - cy))
+            outside = near_x ** 2 + near_y ** 2 > radius ** 2
+            inside = far_x ** 2 + far_y ** 2 <= radius ** 2
+            return np.where(outside, 0, np.where(inside, 2, 1))
+
+        return self._ranges(classify)
+
+    def query_rect(self, x0, x1, y0, y1):
+        '''
+        Returns the indices of the points with x0 <= x < x1 and y0 <= y < y1.
+        '''
+        inner, edge = self.rect_ranges(x0, x1, y0, y1)
+        pos = _expand_ranges(edge)
+        keep = ((self.x[pos] >= x0) & (self.x[pos] < x1) & (self.y[pos] >= y0)
+                                                        & (self.y[pos] < y1))
+        return self.order[np.concatenate((_expand_ranges(inner), pos[keep]))]
+
+    def query_radius(self, cx, cy, radius):
+        '''Returns the indices of the points within radius of (cx, cy).'''
+        inner, edge = self.radius_ranges(cx, cy, radius)
+        pos = _expand_ranges(edge)
+        keep = (self.x[pos] - cx) ** 2 + (self.y[pos] - cy) ** 2 <= radius ** 2
+        return self.order[np.concatenate((_expand_ranges(inner), pos[keep]))]
+
+
+def criteria_columns(*criteria):
+    '''
+    Returns the names of the columns used by criteria, in order of first use.
+
+    Parameters
+    ----------
+    criteria : dicts or lists
+        Criteria dictionaries (see Patch.sad), whose keys are columns, or
+        lists of column names, eg, div_cols of Patch.sar.
+
+    Returns
+    -------
+    : list
+        Names of columns, to give as columns of Patch so that only the
+        columns an analysis needs are loaded.
+    '''
+
+    columns = []
+    for crit in criteria:
+        for col in crit:
+            if col not in columns:
+                columns.append(col)
+    return columns
+
+
+def _criteria_key(criteria):
+    '''Returns a hashable key for a criteria dictionary.'''
+    return tuple(sorted(criteria.items()))
+
+
+def _sql_level_index(name, levels):
+    '''
+    Returns an SQL expression giving the index of the metric level in levels
+    that the value of column name falls in, or -1, as by _level_index.
+
+    The expression is a binary search over the edges of the levels, nested
+    CASE expressions comparing with the edges themselves, so values on an
+    edge fall in the same level as in _level_index.
+    '''
+
+    edges = np.unique([lvl[0][1] for lvl in levels] + [lvl[1][1] for lvl in
+                                                                    levels])
+    labels = _level_index(edges, levels)
+    keep = np.concatenate(([True], labels[1:] != labels[:-1]))
+    edges = edges[keep]
+    labels = labels[keep]
+
+    def search(lo, hi):
+        if lo == hi:
+            return str(labels[lo])
+        mid = (lo + hi + 1) // 2
+        return 'CASE WHEN %s < %r THEN %s ELSE %s END' % (name,
+                        float(edges[mid]), search(lo, mid - 1), search(mid, hi))
+
+    return 'CASE WHEN %s < %r THEN -1 ELSE %s END' % (name, float(edges[0]),
+                                                search(0, len(edges) - 1))
+
+
+def morton_code(ix, iy):
+    '''
+    Interleaves the bits of non-negative integer coordinates (of at most 26
+    bits) into Morton (Z-order) codes, with the bits of ix in the even
+    positions.
+    '''
+
+    code = np.zeros(np.shape(ix), dtype=np.int64)
+    ix = np.asarray(ix, dtype=np.int64)
+    iy = np.asarray(iy, dtype=np.int64)
+    for bit in range(26):
+        code |= ((ix >> bit) & 1) << (2 * bit)
+        code |= ((iy >> bit) & 1) << (2 * bit + 1)
+    return code
+
+
+def _expand_ranges(ranges):
+    '''Returns the integers in each [start, stop) range of an (k, 2) array.'''
+
+    if len(ranges) == 0:
+        return np.zeros(0, dtype=int)
+    lengths = ranges[:, 1] - ranges[:, 0]
+    offsets = np.repeat(ranges[:, 0] - np.cumsum(lengths) + lengths, lengths)
+    return np.arange(np.sum(lengths)) + offsets
+
+
+def _combination_index(table, combinations):
+    '''
+    Returns the index of the combination in combinations that each row of
+    table falls in, or -1 for rows that are in none.
+    '''
+
+    cell = np.zeros(len(table), dtype=int)
+    stride = 1
+    for col, levels in zip(combinations.columns, combinations.levels):
+        col_ind = _level_index(table[col], levels)
+        cell = np.where((cell >= 0) & (col_ind >= 0), cell + stride * col_ind,
+                                                                        -1)
+        stride *= len(levels)
+    return cell
+
+
+def _nbytes(obj):
+    '''Returns the number of bytes in all arrays held by obj.'''
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if sparse.issparse(obj):
+        return sum(_nbytes(getattr(obj, name, None)) for name in ('data',
+                                            'indices', 'indptr', 'row', 'col'))
+    if isinstance(obj, (tuple, list)):
+        return sum(_nbytes(item) for item in obj)
+    if isinstance(obj, dict):
+        return sum(_nbytes(item) for item in obj.itervalues())
+    if isinstance(obj, (CensusTensor, SpatialIndex)):
+        return _nbytes(vars(obj))
+    return 0
+
+
+def _level_index(values, levels):
+    '''
+    Returns the index of the level in levels that each value falls in, or -1
+    if it falls in none. Levels are conditions made by Patch.parse_criteria.
+    '''
+
+    values = np.asarray(values)
+    level_ind = np.zeros(len(values), dtype=int)
+
+    if type(levels[0][1]) == type('') and levels[0][1] == 'whole':
+        return level_ind  # Whole column
+
+    if type(levels[0]) == type([]):  # Metric, [('>=', start), ('<', end)]
+        starts = np.array([lvl[0][1] for lvl in levels])
+        ends = np.array([lvl[1][1] for lvl in levels])
+        level_ind = np.searchsorted(starts, values, side='right') - 1
+        valid = level_ind >= 0
+        valid[valid] = values[valid] < ends[level_ind[valid]]
+    else:  # Categorical, ('==', value), levels sorted by Patch.parse_criteria
+        cats = np.array([lvl[1] for lvl in levels])
+        level_ind = np.searchsorted(cats, values)
+        valid = level_ind < len(cats)
+        valid[valid] = cats[level_ind[valid]] == values[valid]
+
+    level_ind[~valid] = -1
+    return level_ind
+
+
 def flatten_sad(sad):
     '''
     Takes a list of tuples, like sad output, ignores keys, and converts values 
@@ -555,6 +2442,246 @@ def flatten_sad(sad):
     return combs, result
 
 
+def rarefy(sad, n_samples, block_size=2**22):
+    '''
+    Expected number of species in random samples of individuals drawn without
+    replacement from a community with the given species abundance distribution.
+
+    Parameters
+    ----------
+    sad : array-like
+        Abundance of each species, such as the second element of each tuple
+        returned by Patch.sad.
+    n_samples : int or array-like
+        Sample sizes (numbers of individuals). Must be between 0 and the total
+        number of individuals.
+    block_size : int
+        Maximum number of terms evaluated at once, which limits memory use
+        when there are many sample sizes.
+
+    Returns
+    -------
+    : ndarray
+        Expected number of species at each sample size.
+
+    Notes
+    -----
+    The expected number of species in a sample of n of N individuals is the
+    sum over species of 1 - C(N - N_i, n) / C(N, n) (Hurlbert 1971), which is
+    evaluated in log space with _ln_choose so that large N does not overflow.
+    Species with the same abundance are evaluated once and weighted by their
+    number, and all sample sizes in a block are evaluated in one array
+    operation.
+    '''
+
+    abund = np.asarray(sad)
+    abund = abund[abund > 0]
+    n_samples = np.atleast_1d(n_samples).astype(float)
+    total = np.sum(abund)
+
+    if np.any(n_samples < 0) or np.any(n_samples > total):
+        raise ValueError('Sample sizes must be between 0 and the number of ' +
+                         'individuals (%s)' % total)
+
+    values, inverse = np.unique(abund, return_inverse=True)
+    mult = np.bincount(inverse)
+    rest = (total - values)[:, np.newaxis]
+
+    expected = np.empty(len(n_samples))
+    step = max(1, block_size // max(1, len(values)))
+    for start in range(0, len(n_samples), step):
+        n = n_samples[start:start + step]
+        with np.errstate(invalid='ignore'):
+            ln_miss = _ln_choose(rest, n) - _ln_choose(total, n)
+        miss = np.where(n <= rest, np.exp(ln_miss), 0)
+        expected[start:start + step] = np.dot(mult, 1 - miss)
+
+    return expected
+
+
+def group_by_species(species):
+    '''
+    Groups records by species with a single stable sort.
+
+    Parameters
+    ----------
+    species : ndarray
+        1D array of species identifiers, one per record.
+
+    Returns
+    -------
+    order : ndarray
+        Indices that sort species, keeping records of the same species in
+        their original order.
+    groups : dict
+        Dictionary with a key for each species in species, looking up the
+        (start, stop) of the species' records in the sorted array.
+    '''
+
+    species = np.asarray(species)
+    order = np.argsort(species, kind='mergesort')
+    unq_spp, starts = np.unique(species[order], return_index=True)
+    stops = np.append(starts[1:], len(species))
+    groups = dict(zip(unq_spp, zip(starts, stops)))
+    return order, groups
+
+
+def integral_image(cube):
+    '''
+    Makes the integral image (summed-area table) of the abundance of each
+    species in a grid of cells.
+
+    Parameters
+    ----------
+    cube : ndarray
+        3D array of the abundance of each species (first axis) in each cell
+        of a grid (second and third axes).
+
+    Returns
+    -------
+    : ndarray
+        Array with one more row and column than the grid in which element
+        [s, i, j] is the total abundance of species s in the cells [:i, :j].
+    '''
+
+    cube = np.asarray(cube)
+    if cube.dtype.kind in 'biu':
+        cube = cube.astype(np.int64)
+    integral = np.zeros((cube.shape[0], cube.shape[1] + 1, cube.shape[2] + 1),
+                                                            dtype=cube.dtype)
+    integral[:, 1:, 1:] = np.cumsum(np.cumsum(cube, axis=1), axis=2)
+    return integral
+
+
+def window_sums(integral, size, step=(1, 1)):
+    '''
+    Sums the abundance of each species in every window of the given size
+    from an integral image.
+
+    Parameters
+    ----------
+    integral : ndarray
+        Integral image made by integral_image.
+    size : tuple
+        Number of cells in the window along each axis of the grid.
+    step : tuple
+        Number of cells that the window moves along each axis of the grid.
+
+    Returns
+    -------
+    : ndarray
+        3D array with the abundance of each species (first axis) in the
+        window starting at each position (second and third axes).
+    '''
+
+    nx = integral.shape[1] - 1
+    ny = integral.shape[2] - 1
+    if size[0] > nx or size[1] > ny or min(size) < 1:
+        raise ValueError('Window of size %s does not fit in grid of %s cells'
+                                                    % (str(size), str((nx, ny))))
+
+    x0 = np.arange(0, nx - size[0] + 1, step[0])
+    y0 = np.arange(0, ny - size[1] + 1, step[1])
+    x1 = x0 + size[0]
+    y1 = y0 + size[1]
+
+    return (integral[:, x1[:, np.newaxis], y1] - integral[:, x0[:, np.newaxis],
+            y1] - integral[:, x1[:, np.newaxis], y0] + integral[:,
+            x0[:, np.newaxis], y0])
+
+
+def sar_ear_counts(flat_sad, form='both', totals=None):
+    '''
+    Counts species and endemics in each column (cell) of a species-by-cell
+    array, such as the second element returned by flatten_sad.
+
+    Parameters
+    ----------
+    flat_sad : ndarray
+        2D array with species in rows and cells in columns.
+    form : string
+        'sar', 'ear' or 'both'. Counts that are not requested are None.
+    totals : ndarray
+        Total abundance of each species in the patch. If None, the sum of
+        each row of flat_sad, which is only correct if cells do not overlap.
+
+    Returns
+    -------
+    : tuple
+        1D arrays with the number of species present in each cell and the
+        number of species whose individuals are all found in that cell.
+
+    Notes
+    -----
+    Each cell is compared to the species totals by broadcasting the column of
+    totals across the array, so no repeated copy of the totals is made.
+    '''
+
+    flat_sad = np.asarray(flat_sad)
+    spp_full = None
+    end_full = None
+
+    if form in ('sar', 'both'):
+        spp_full = np.sum(flat_sad > 0, axis=0)
+    if form in ('ear', 'both'):
+        if totals is None:
+            totcnt = np.sum(flat_sad, axis=1)
+        else:
+            totcnt = np.asarray(totals)
+        end_full = np.sum(flat_sad == totcnt[:, np.newaxis], axis=0)
+
+    return spp_full, end_full
+
+
+# Number of set bits in each possible byte
+_POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)],
+                                                                dtype=np.uint8)
+
+
+def pack_presence(flat_sad):
+    '''
+    Packs the presence of species in cells into bit sets.
+
+    Parameters
+    ----------
+    flat_sad : ndarray
+        2D array with species in rows and cells in columns, such as the
+        second element returned by flatten_sad.
+
+    Returns
+    -------
+    : ndarray
+        uint8 array with one row for each cell, in which bit i is set if
+        species i is present (has abundance greater than zero) in the cell.
+
+    Notes
+    -----
+    Each species takes one bit instead of the 64 bits of a count, so the
+    union, intersection and difference of the species in cells are the
+    bitwise or, and and and-not of their rows.
+    '''
+    return np.packbits(np.asarray(flat_sad).T > 0, axis=-1)
+
+
+def popcount(packed):
+    '''
+    Returns the number of species in each bit set (the last axis) of an
+    array made by pack_presence.
+    '''
+    return np.sum(_POPCOUNT_TABLE[packed], axis=-1, dtype=int)
+
+
+def single_presence(packed):
+    '''
+    Returns the bit set of the species present in exactly one row (cell) of
+    an array made by pack_presence.
+    '''
+    packed = np.asarray(packed)
+    seen = np.bitwise_or.accumulate(packed, axis=0)
+    repeated = np.bitwise_or.reduce(packed[1:] & seen[:-1], axis=0)
+    return seen[-1] & ~repeated
+
+
 def distance(pt1, pt2):
     ''' Calculate Euclidean distance between two points '''
     return np.sqrt((pt1[0] - pt2[0]) ** 2 + (pt1[1] - pt2[1]) ** 2)
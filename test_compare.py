@@ -548,6 +548,58 @@ class TestCompare(unittest.TestCase):
         smry = ied_c.summary()
         self.assertTrue(smry['observed']['balls'] == [4905, 190])
 
+    def test_weighted(self):
+
+        # Weighted and expanded data give the same comparisons
+        vals = np.array([1., 2, 3, 5, 8])
+        wts = np.array([2, 1, 3, 1, 4])
+        sad = [6, 4, 1]
+        exp_c = CompareIED([(np.repeat(vals, wts), sad)], ['psi'])
+        wtd_c = CompareIED([(weighted_sample(vals, wts), sad)], ['psi'])
+
+        def assert_same(exp, wtd):
+            if type(exp) == dict:
+                self.assertEqual(sorted(exp), sorted(wtd))
+                for kw in exp:
+                    assert_same(exp[kw], wtd[kw])
+            elif type(exp) in (list, tuple):
+                self.assertEqual(len(exp), len(wtd))
+                for this_exp, this_wtd in zip(exp, wtd):
+                    assert_same(this_exp, this_wtd)
+            else:
+                nt.assert_allclose(exp, wtd)
+
+        assert_same(exp_c.compare_mse(), wtd_c.compare_mse())
+        assert_same(exp_c.compare_mse(mse_base='rad'),
+                    wtd_c.compare_mse(mse_base='rad'))
+        assert_same(exp_c.compare_aic(crt=True), wtd_c.compare_aic(crt=True))
+        assert_same(exp_c.compare_aic_measures(),
+                    wtd_c.compare_aic_measures())
+        assert_same(exp_c.compare_LRT(dist.psi()),
+                    wtd_c.compare_LRT(dist.psi()))
+        assert_same(exp_c.compare_rarity((1, 2)), wtd_c.compare_rarity((1, 2)))
+        assert_same(exp_c.compare_moments(), wtd_c.compare_moments())
+        assert_same(exp_c.summary(), wtd_c.summary())
+
+        # Observed rads are weighted samples, and weighted moments of
+        # samples with varied weights match expanded ones
+        exp_rads = exp_c.compare_rads()
+        wtd_rads = wtd_c.compare_rads()
+        nt.assert_allclose(exp_rads['psi'][0], wtd_rads['psi'][0])
+        self.assertTrue(is_weighted(wtd_rads['observed'][0]))
+        nt.assert_allclose(exp_rads['observed'][0], np.repeat(
+                                    wtd_rads['observed'][0]['value'], wts))
+        for moment in (variance, skew, kurtosis):
+            nt.assert_allclose(moment([np.repeat(vals, wts)]),
+                                    moment([weighted_sample(vals, wts)]))
+
+        # Cdfs have one value for each value of the weighted sample
+        exp_cdfs = exp_c.compare_cdfs()
+        wtd_cdfs = wtd_c.compare_cdfs()
+        for kw in exp_cdfs:
+            nt.assert_allclose(exp_cdfs[kw][0], np.repeat(wtd_cdfs[kw][0],
+                                                                    wts))
+
     def test_nll(self):
         
         # Test against R result: sum(dnorm(c(1,2,3,4,5), log=TRUE))
@@ -569,6 +621,12 @@ class TestCompare(unittest.TestCase):
         res = empirical_cdf(test_data)
         self.assertTrue(np.array_equal(R_res, res))
 
+        # Weighted sample gives the cdf of the expanded data at each value
+        test_data = weighted_sample([1,2,3,4,5,6], [4,1,1,1,1,2])
+        R_res = [.4,.5,.6,.7,.8,1]
+        res = empirical_cdf(test_data)
+        self.assertTrue(np.allclose(R_res, res))
+
     def test_aic(self):
         
         # Test that passing either a pmf of nll gives the same result
@@ -678,6 +736,10 @@ class TestCompare(unittest.TestCase):
         pred = mean_squared_error(pred, obs)
         self.assertEqual(pred, comp_val)
 
+        # Weighted errors match expanded data
+        self.assertEqual(mean_squared_error([1, 2], [2, 4], [3, 1]),
+                         mean_squared_error([1, 1, 1, 2], [2, 2, 2, 4]))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -4,9 +4,13 @@ Unit tests for data.py
 
 import unittest
 import os
+import sqlite3
 import numpy as np
 from matplotlib.mlab import csv2rec
-from macroeco.data import DataTable, Metadata
+from macroeco.data import (DataTable, Metadata, read_csv, load_cache,
+                           csv_to_npy, db_table, compile_sql,
+                           index_columns, parse_value, subset_mask,
+                           Vocabulary)
 
 class TestDataTable(unittest.TestCase):
 
@@ -37,6 +41,142 @@ class TestDataTable(unittest.TestCase):
         xy1 = DataTable('xyfile1.csv')
         np.testing.assert_array_equal(xy1.table, self.xyarr1)
 
+    def test_read_csv(self):
+        # Column names are cleaned as by csv2rec
+        names = open('names.csv', 'w')
+        names.write('''Spp Code, x, (y), x, print
+                    a b, 1, 2.5, 3, 4''')
+        names.close()
+        table = read_csv('names.csv')
+        os.remove('names.csv')
+        self.assertEqual(table.dtype.names, ('spp_code', 'x', 'y', 'x_1',
+                                                                    'print_'))
+        self.assertEqual(table['spp_code'][0], '                    a b')
+        self.assertEqual(table['y'].dtype, np.float)
+
+        # Given types are used
+        table = read_csv('xyfile1.csv', dtypes={'x': np.float64})
+        self.assertEqual(table['x'].dtype, np.float64)
+        np.testing.assert_array_equal(table['x'], self.xyarr1['x'])
+
+    def test_columns(self):
+        table = read_csv('xyfile1.csv', columns=['count', 'x'])
+        self.assertEqual(table.dtype.names, ('x', 'count'))
+        np.testing.assert_array_equal(table['count'], self.xyarr1['count'])
+        self.assertRaises(ValueError, read_csv, 'xyfile1.csv', columns=['z'])
+
+        xy1 = DataTable('xyfile1.csv', columns=['spp_code', 'x'])
+        self.assertEqual(xy1.table.dtype.names, ('spp_code', 'x'))
+        self.assertEqual(len(xy1.asklist), 8)
+
+        # Records with more columns are appended
+        xy1.append('xyfile1.csv')
+        self.assertEqual(len(xy1.table), 10)
+
+        # Cache of some columns serves fewer columns, not more
+        DataTable('xyfile1.csv', cache=True, columns=['spp_code', 'x', 'y'])
+        xy2 = DataTable('xyfile1.csv', cache=True, columns=['x', 'y'])
+        self.assertEqual(xy2.table.dtype.names, ('x', 'y'))
+        np.testing.assert_array_equal(xy2.table['y'], self.xyarr1['y'])
+        self.assertEqual(load_cache('xyfile1.csv', columns=['count']), None)
+        self.assertEqual(load_cache('xyfile1.csv'), None)
+        os.remove('xyfile1.csv.cache.npy')
+        os.remove('xyfile1.csv.cache.json')
+
+    def test_cache(self):
+        xy1 = DataTable('xyfile1.csv', cache=True)
+        self.assertTrue(os.path.exists('xyfile1.csv.cache.npy'))
+        self.assertTrue(os.path.exists('xyfile1.csv.cache.json'))
+        self.assertEqual(load_cache('xyfile1.csv')[1], None)
+
+        # Loaded from cache
+        xy2 = DataTable('xyfile1.csv', cache=True)
+        np.testing.assert_array_equal(xy2.table, xy1.table)
+        self.assertEqual(xy2.table.dtype, xy1.table.dtype)
+        self.assertEqual(xy2.asklist, xy1.asklist)
+
+        # Touched file with same contents keeps cache
+        stat = os.stat('xyfile1.csv')
+        os.utime('xyfile1.csv', (stat.st_atime, stat.st_mtime + 10))
+        self.assertNotEqual(load_cache('xyfile1.csv'), None)
+
+        # Changed file invalidates cache
+        open('xyfile1.csv', 'a').write('\n1, 1, 1, 5')
+        self.assertEqual(load_cache('xyfile1.csv'), None)
+        xy3 = DataTable('xyfile1.csv', cache=True)
+        self.assertEqual(len(xy3.table), 6)
+        self.assertEqual(len(load_cache('xyfile1.csv')[0]), 6)
+
+        # New metadata file invalidates cache
+        open('xyfile1.xml', 'w').write('<eml></eml>')
+        self.assertEqual(load_cache('xyfile1.csv'), None)
+        os.remove('xyfile1.xml')
+        os.remove('xyfile1.csv.cache.npy')
+        os.remove('xyfile1.csv.cache.json')
+
+    def test_mmap(self):
+        # Written in chunks, same table as read_csv
+        csv_to_npy('xyfile1.csv', 'xyfile1.npy', chunksize=2)
+        np.testing.assert_array_equal(np.load('xyfile1.npy'), self.xyarr1)
+        os.remove('xyfile1.npy')
+
+        xy1 = DataTable('xyfile1.csv', mmap=True)
+        self.assertTrue(isinstance(xy1.table.base, np.memmap))
+        np.testing.assert_array_equal(xy1.table, self.xyarr1)
+        sub = xy1.get_subtable({'spp_code': ('==', 0)})
+        np.testing.assert_array_equal(sub, self.xyarr1[0:3])
+        del xy1, sub
+        os.remove('xyfile1.csv.cache.npy')
+        os.remove('xyfile1.csv.cache.json')
+
+    def test_db_table(self):
+        sql = open('xyfile1.sql', 'w')
+        sql.write('''CREATE TABLE plot (spp TEXT, x INTEGER, y REAL,
+                                        count INTEGER);
+                     INSERT INTO plot VALUES ('oak', 0, 0.5, 1);
+                     INSERT INTO plot VALUES ('maple', 1, 1, NULL);
+                     INSERT INTO plot VALUES (NULL, 2, 1.5, 3);''')
+        sql.close()
+
+        # String widths and types found from data, NULLs filled
+        table = db_table('xyfile1.sql', 'SELECT * FROM plot', chunksize=2)
+        self.assertEqual(table.dtype.names, ('spp', 'x', 'y', 'count'))
+        self.assertEqual(table['spp'].dtype, np.dtype('S5'))
+        self.assertEqual(table['x'].dtype, np.int64)
+        np.testing.assert_array_equal(table['spp'], ['oak', 'maple', ''])
+        np.testing.assert_array_equal(table['y'], [0.5, 1, 1.5])
+        np.testing.assert_array_equal(table['count'], [1, np.nan, 3])
+
+        table = db_table('xyfile1.sql', 'SELECT spp FROM plot WHERE x > 0;')
+        np.testing.assert_array_equal(table['spp'], ['maple', ''])
+        self.assertRaises(sqlite3.OperationalError, db_table, 'xyfile1.sql',
+                          'SELECT * FROM plot WHERE x > 5')
+
+        # Script built into a database once, and queried through it
+        table = db_table('xyfile1.sql', 'SELECT * FROM plot', cache=True)
+        np.testing.assert_array_equal(table['spp'], ['oak', 'maple', ''])
+        self.assertEqual(compile_sql('xyfile1.sql'), 'xyfile1.sql.cache.db')
+        index_columns('xyfile1.sql.cache.db', ['spp', 'x', 'z'])
+        con = sqlite3.connect('xyfile1.sql.cache.db')
+        indexes = con.execute("SELECT name FROM sqlite_master WHERE type = "
+                              "'index'").fetchall()
+        con.close()
+        self.assertEqual(sorted(indexes), [('plot_spp_index',),
+                                           ('plot_x_index',)])
+
+        # Database is kept until the script changes
+        compile_sql('xyfile1.sql')
+        con = sqlite3.connect('xyfile1.sql.cache.db')
+        self.assertEqual(len(con.execute("SELECT name FROM sqlite_master "
+                                    "WHERE type = 'index'").fetchall()), 2)
+        con.close()
+        open('xyfile1.sql', 'a').write("INSERT INTO plot VALUES "
+                                       "('fir', 3, 2, 1);")
+        table = db_table('xyfile1.sql', 'SELECT * FROM plot', cache=True)
+        self.assertEqual(len(table), 4)
+        os.remove('xyfile1.sql')
+        os.remove('xyfile1.sql.cache.db')
+
     def test_get_subtable(self):
         xy1 = DataTable('xyfile1.csv')
         xy1.meta = {('x', 'maximum'): 1,
@@ -61,6 +201,83 @@ class TestDataTable(unittest.TestCase):
         sub = xy1.get_subtable({'spp_code': ('==', 0), 'x': ('>', 0)})
         np.testing.assert_array_equal(sub, self.xyarr1[2])
 
+    def test_encode(self):
+        vocab = Vocabulary(['b'])
+        np.testing.assert_array_equal(vocab.encode(['a', 'b', 'a']), [1, 0, 1])
+        np.testing.assert_array_equal(vocab.decode([1, 0]), ['a', 'b'])
+        self.assertEqual(len(vocab), 2)
+
+        xy1 = DataTable('xyfile1.csv', encode=['spp_code'])
+        self.assertEqual(xy1.encoded, ['spp_code'])
+        self.assertEqual(xy1.table['spp_code'].dtype, np.int32)
+        np.testing.assert_array_equal(xy1.decode('spp_code',
+                            xy1.table['spp_code']), self.xyarr1['spp_code'])
+        np.testing.assert_array_equal(xy1.decode('x', xy1.table['x']),
+                                      self.xyarr1['x'])
+
+        # Appended records are encoded with the same vocabulary
+        xy1.append(self.xyarr1[3:])
+        np.testing.assert_array_equal(xy1.table['spp_code'], [0, 0, 0, 1, 1,
+                                                              1, 1])
+        self.assertEqual(len(xy1.vocabulary), 2)
+
+        # Columns of a query are encoded as rows are fetched
+        sql = open('xyfile1.sql', 'w')
+        sql.write('''CREATE TABLE plot (spp TEXT, x INTEGER);
+                     INSERT INTO plot VALUES ('oak', 0);
+                     INSERT INTO plot VALUES ('fir', 1);
+                     INSERT INTO plot VALUES ('oak', 2);''')
+        sql.close()
+        table = db_table('xyfile1.sql', 'SELECT * FROM plot', chunksize=2,
+                         encode=['spp'], vocabulary=vocab)
+        np.testing.assert_array_equal(table['spp'], [3, 2, 3])
+        self.assertEqual(table['spp'].dtype, np.int32)
+        self.assertRaises(ValueError, db_table, 'xyfile1.sql',
+                          'SELECT * FROM plot', encode=['spp'])
+        xy2 = DataTable('xyfile1.sql', 'SELECT * FROM plot', encode=['spp'],
+                        vocabulary=vocab)
+        np.testing.assert_array_equal(xy2.table['spp'], [3, 2, 3])
+        np.testing.assert_array_equal(xy2.decode('spp', xy2.table['spp']),
+                                      ['oak', 'fir', 'oak'])
+        os.remove('xyfile1.sql')
+
+    def test_subset(self):
+        subset = {'spp_code': ('==', 0), 'y': [('>=', 0), ('<', 1)]}
+        np.testing.assert_array_equal(subset_mask(self.xyarr1, subset),
+                                      [True, True, False, False, False])
+
+        # Read in chunks, keeping only records meeting subset
+        table = read_csv('xyfile1.csv', subset=subset, chunksize=2)
+        np.testing.assert_array_equal(table, self.xyarr1[0:2])
+        self.assertRaises(ValueError, read_csv, 'xyfile1.csv',
+                          columns=['x'], subset=subset)
+
+        # Codes with only digits in some chunks are kept as text
+        codes = open('codes.csv', 'w')
+        codes.write('spp,x\n007,0\n008,1\na3,0\n')
+        codes.close()
+        whole = read_csv('codes.csv')
+        table = read_csv('codes.csv', subset={'x': ('==', 0)}, chunksize=2)
+        self.assertEqual(table['spp'].dtype, whole['spp'].dtype)
+        np.testing.assert_array_equal(table['spp'], ['007', 'a3'])
+        csv_to_npy('codes.csv', 'codes.npy', chunksize=2)
+        np.testing.assert_array_equal(np.load('codes.npy'), whole)
+        os.remove('codes.csv')
+        os.remove('codes.npy')
+
+        xy1 = DataTable('xyfile1.csv', subset=subset, columns=['count'])
+        self.assertEqual(xy1.table.dtype.names, ('spp_code', 'y', 'count'))
+        np.testing.assert_array_equal(xy1.table['count'], [1, 2])
+
+        # Cache holds the whole table
+        xy2 = DataTable('xyfile1.csv', subset=subset, cache=True)
+        np.testing.assert_array_equal(xy2.table, self.xyarr1[0:2])
+        self.assertEqual(len(load_cache('xyfile1.csv')[0]), 5)
+        xy2 = DataTable('xyfile1.csv', subset=subset, cache=True)
+        np.testing.assert_array_equal(xy2.table, self.xyarr1[0:2])
+        os.remove('xyfile1.csv.cache.npy')
+        os.remove('xyfile1.csv.cache.json')
+
 class TestMetadata(unittest.TestCase):
     
     def setUp(self):
@@ -119,6 +336,43 @@ eml.xsd"><dataset>
                                     ('y', 'precision'): None,
                                     ('y', 'type'): 'ordinal'})
 
+    def test_dtypes_from_metadata(self):
+        # Interval x has precision 0.1, so is read as float
+        meta = Metadata('xyfile1.csv', [])
+        self.assertEqual(meta.get_dtypes(['x', 'y', 'z']), {'x': np.float64})
+        xy1 = DataTable('xyfile1.csv')
+        self.assertEqual(xy1.table['x'].dtype, np.float64)
+        self.assertEqual(xy1.table['y'].dtype, np.int)
+
+    def test_metadata_cache(self):
+        # File is parsed once and shared
+        meta1 = Metadata('xyfile1.csv', [])
+        meta2 = Metadata('xyfile1.csv', [('x', 'precision')])
+        self.assertTrue(meta1.root is meta2.root)
+        self.assertEqual(meta2.meta_dict, {('x', 'precision'): 0.1})
+        self.assertEqual(meta1.get_value('x', 'type'), 'interval')
+        self.assertEqual(meta1.get_value('y', 'maximum'), None)
+        self.assertEqual(meta2.index['x']['type'], 'interval')
+
+        # Values are only found for the columns and elements asked for
+        self.assertTrue('type' not in meta1.index['y'])
+
+        # Parsed again when the file changes
+        text = open('xyfile1.xml').read()
+        open('xyfile1.xml', 'w').write(text.replace('99.9', '199.9'))
+        meta3 = Metadata('xyfile1.csv', [('x', 'maximum')])
+        self.assertEqual(meta3.meta_dict, {('x', 'maximum'): 199.9})
+        self.assertTrue(meta3.root is not meta1.root)
+
+    def test_parse_value(self):
+        self.assertEqual(parse_value(' 10'), 10)
+        self.assertEqual(type(parse_value('10')), int)
+        self.assertEqual(parse_value('1e-1'), 0.1)
+        self.assertEqual(parse_value('None'), None)
+        self.assertEqual(parse_value(None), None)
+        self.assertEqual(parse_value('interval'), 'interval')
+        self.assertEqual(parse_value('__import__("os")'), '__import__("os")')
+
     def test_physical_coverage(self):
         meta = Metadata('xyfile1.csv', [])
         edges = meta.get_physical_coverage()
@@ -826,6 +826,13 @@ class TestDistributions(unittest.TestCase):
         # Test rad doesn't throw an error
         ps.rad()
 
+        # Test fit gives the same parameters for weighted and expanded data
+        ied = np.array([1, 1, 2, 3, 3, 3])
+        wied = weighted_sample([1, 2, 3], [2, 1, 3])
+        ps1 = psi().fit([(ied, [4, 2])])
+        ps2 = psi().fit([(wied, [4, 2])])
+        self.assertTrue(ps1.params['E'] == ps2.params['E'])
+
     def test_nu(self):
         
         # Test error is raised when pdf called
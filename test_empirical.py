@@ -271,6 +271,109 @@ d, 1, 1, 1, snake''')
         self.assertTrue(np.array_equal(sad[2][1], np.array([1])))
         self.assertTrue(sad[2][2][0] == 'b')
 
+    def test_cache(self):
+
+        # Repeated calls reuse the cache and give the same result
+        crit = {'spp_code': 'species', 'count': 'count', 'x': 2, 'y': 2}
+        sad1 = self.pat2.sad(crit)
+        self.assertTrue(len(self.pat2._cache) > 0)
+        sad2 = self.pat2.sad(crit)
+        self.assertTrue(np.array_equal(sad1[3][1], sad2[3][1]))
+
+        # Changing metadata clears the cache, as does clear_cache
+        self.pat2.data_table.meta = dict(self.xymeta6)
+        self.pat2.sad({'spp_code': 'species', 'count': 'count', 'x': 1})
+        self.assertTrue(('sxc', tuple(sorted(crit.items()))) not in
+                                                            self.pat2._cache)
+        self.pat2.clear_cache()
+        self.assertTrue(len(self.pat2._cache) == 0)
+
+        # The cache never grows past its limit
+        self.pat2.cache_limit = 100
+        self.pat2.sad(crit)
+        self.assertTrue(self.pat2._cache_bytes <= 100)
+        sad3 = self.pat2.sad(crit)
+        self.assertTrue(np.array_equal(sad1[3][1], sad3[3][1]))
+
+    def test_pushdown(self):
+
+        # Write census of pat2 and pat1 to sql scripts
+        for name, pat in (('xyfile6', self.pat2), ('xyfile5', self.pat1)):
+            sql = open(name + '.sql', 'w')
+            sql.write("CREATE TABLE plot (spp_code TEXT, x REAL, y REAL, "
+                      "count INTEGER);\n")
+            for row in pat.data_table.table:
+                sql.write("INSERT INTO plot VALUES ('%s', %r, %r, %d);\n" %
+                                                                tuple(row))
+            sql.close()
+
+        pat = Patch('xyfile6.sql', 'SELECT * FROM plot', pushdown=True)
+        pat.data_table.meta = self.xymeta6
+        self.assertTrue(pat.data_table.table is None)
+
+        # Same sads as patch loaded from csv
+        for crit in [{'spp_code': 'species', 'count': 'count', 'x': 2},
+                     {'spp_code': 'species', 'count': 'count', 'x': 2,
+                      'y': 2},
+                     {'spp_code': 'species', 'x': 'split', 'y': 'whole'}]:
+            sad = pat.sad(crit)
+            sad2 = self.pat2.sad(crit)
+            self.assertEqual([s[0] for s in sad], [s[0] for s in sad2])
+            for s, s2 in zip(sad, sad2):
+                np.testing.assert_array_equal(s[1], s2[1])
+                np.testing.assert_array_equal(s[2], s2[2])
+
+        # Through a database built from the script, with criteria indexed
+        pat_db = Patch('xyfile6.sql', 'SELECT * FROM plot', pushdown=True,
+                       cache=True)
+        pat_db.data_table.meta = self.xymeta6
+        crit = {'spp_code': 'species', 'count': 'count', 'x': 2, 'y': 2}
+        np.testing.assert_array_equal(flatten_sad(pat_db.sad(crit))[1],
+                                      flatten_sad(self.pat2.sad(crit))[1])
+        os.remove('xyfile6.sql.cache.db')
+
+        sar = pat.sar(('x', 'y'), [(1, 1), (2, 2)], {'spp_code': 'species',
+                                                     'count': 'count'})
+        sar2 = self.pat2.sar(('x', 'y'), [(1, 1), (2, 2)],
+                             {'spp_code': 'species', 'count': 'count'})
+        np.testing.assert_array_equal(sar[0], sar2[0])
+
+        # Fractional cells, and a subset query
+        pat = Patch('xyfile5.sql', 'SELECT * FROM plot WHERE x < .15',
+                    pushdown=True)
+        pat.data_table.meta = self.xymeta5
+        pat1 = Patch('xyfile5.csv', {'x': ('<', .15)})
+        pat1.data_table.meta = self.xymeta5
+        crit = {'spp_code': 'species', 'count': 'count', 'y': 3}
+        sad = pat.sad(crit)
+        self.assertEqual(list(sad[0][2]), ['grt', 'rty'])
+        for s, s2 in zip(sad, pat1.sad(crit)):
+            np.testing.assert_array_equal(s[1], s2[1])
+
+        self.assertRaises(TypeError, pat.append, 'xyfile5.csv')
+        self.assertRaises(ValueError, pat.ied, {'spp_code': 'species',
+                                        'count': 'count', 'energy': 'energy'})
+        self.assertRaises(ValueError, Patch, 'xyfile5.csv', pushdown=True)
+        os.remove('xyfile5.sql')
+        os.remove('xyfile6.sql')
+
+    def test_columns(self):
+        crit = {'spp_code': 'species', 'count': 'count', 'x': 2}
+        columns = criteria_columns(crit, ('x', 'y'))
+        self.assertEqual(sorted(columns), ['count', 'spp_code', 'x', 'y'])
+        self.assertEqual(criteria_columns(['y'], {'x': 2, 'y': 2}), ['y', 'x'])
+
+        pat = Patch('xyfile6.csv', {'spp_code': ('==', 'a')}, columns=['x',
+                                                                    'count'])
+        self.assertEqual(pat.data_table.table.dtype.names, ('spp_code', 'x',
+                                                                    'count'))
+        pat.data_table.meta = self.xymeta6
+        sad = pat.sad(crit)
+        pat2 = Patch('xyfile6.csv', {'spp_code': ('==', 'a')})
+        pat2.data_table.meta = self.xymeta6
+        np.testing.assert_array_equal(flatten_sad(sad)[1],
+                                      flatten_sad(pat2.sad(crit))[1])
+
     def test_parse_criteria(self):
 
         # Checking parse returns what we would expect 
@@ -303,8 +406,23 @@ d, 1, 1, 1, snake''')
                                 'count'})
         self.assertTrue(pars[5] == [{}])
 
+        # Check that combinations are ordered with first column fastest
+        pars = self.pat4.parse_criteria({'spp_code': 'species', 'count':
+                                'count', 'x': 3})
+        self.assertTrue(len(pars[5]) == 3)
+        self.assertTrue(pars[5][0]['x'] == [('>=', 0), ('<', 1)])
+        self.assertTrue(pars[5][-1] == list(pars[5])[2])
+
         # TODO: Test that error is thrown if step < prec
 
+    def test_combinations(self):
+        comb = Combinations(['a', 'b'], [[1, 2, 3], ['x', 'y']])
+        self.assertTrue(len(comb) == 6)
+        self.assertTrue(list(comb)[3] == {'a': 1, 'b': 'y'})
+        self.assertTrue(comb[4] == {'a': 2, 'b': 'y'})
+        self.assertTrue(np.array_equal(comb.level_index()[4], [1, 1]))
+        self.assertTrue(Combinations([], []) == [{}])
+
     def test_sar(self):
         
         # Checking that sar function returns correct S0 for full plot
@@ -324,6 +442,16 @@ d, 1, 1, 1, snake''')
         ear = self.pat3.sar(('x', 'y'), [(1,1), (2,2)], {'spp_code': 'species',
         'count': 'count'}, form='ear')
         self.assertTrue(np.array_equal(ear[1][1], np.array([0,1,0,0])))
+
+        # Checking that sar and ear computed together match separate calls
+        both = self.pat3.sar(('x', 'y'), [(1,1), (2,2)], {'spp_code':
+                            'species', 'count': 'count'}, form='both')
+        self.assertTrue(np.array_equal(both[1][1][0], np.array([3,3,2,3])))
+        self.assertTrue(np.array_equal(both[1][1][1], np.array([0,1,0,0])))
+        self.assertTrue(both[0]['endemics'][1] == 0.25)
+
+        # Presence is packed without a species-by-cell array of counts
+        self.assertTrue('sxc' not in [key[0] for key in self.pat3._cache])
         
         # Test that returned areas are correct
         sar = self.pat1.sar(('x', 'y'), [(1,1)], {'spp_code': 'species',
@@ -331,8 +459,364 @@ d, 1, 1, 1, snake''')
         self.assertTrue(np.round(sar[0]['area'][0], decimals=2) == 0.06)
         self.assertTrue(sar[0]['items'][0] == 2)
 
+    def test_sar_window(self):
+
+        # Windows of one cell match the grid sar and whole plot gives S0
+        crit = {'spp_code': 'species', 'count': 'count'}
+        sar = self.pat4.sar(('x', 'y'), [(3,2)], crit)
+        win = self.pat4.sar_window(('x', 'y'), (3, 2), [(1,1), (3,2)], crit)
+        self.assertTrue(np.array_equal(np.sort(win[1][0]),
+                                                    np.sort(sar[1][0])))
+        self.assertTrue(win[0]['items'][1] == 4)
+        self.assertTrue(win[0]['area'][1] == 6)
+
+        # Overlapping windows of two cells, moved one cell at a time
+        win = self.pat4.sar_window(('x', 'y'), (3, 2), [(2,1)], crit,
+                                                                form='both')
+        self.assertTrue(np.array_equal(win[1][0][0], np.array([4,3,3,3])))
+        self.assertTrue(np.array_equal(win[1][0][1], np.array([1,0,0,0])))
+        win = self.pat4.sar_window(('x', 'y'), (3, 2), [(2,1)], crit,
+                                                                step=(2, 1))
+        self.assertTrue(len(win[1][0]) == 2)
+
+        # Windows larger than the grid raise an error
+        self.assertRaises(ValueError, self.pat4.sar_window, ('x', 'y'),
+                                                    (3, 2), [(4, 1)], crit)
+
+    def test_sar_sample(self):
+
+        # Quadrat covering the patch gives S0, unit quadrats hold one point
+        crit = {'spp_code': 'species', 'count': 'count'}
+        sar = self.pat4.sar(('x', 'y'), [(3,2)], crit)
+        samp = self.pat4.sar_sample(('x', 'y'), [(3, 2), (1, 1)], crit,
+                                            n_quads=50, form='both', seed=1)
+        self.assertTrue(samp[0]['items'][0] == 4)
+        self.assertTrue(samp[0]['endemics'][0] == 4)
+        self.assertTrue(samp[0]['area'][1] == 1)
+        self.assertTrue(set(samp[1][1][0]) <= set(sar[1][0]))
+        self.assertTrue(samp[1][1].shape == (2, 50))
+
+        # Parallel quadrats give the same result for the same seed
+        par = self.pat4.sar_sample(('x', 'y'), [(3, 2), (1, 1)], crit,
+                            n_quads=50, form='both', seed=1, processes=3)
+        self.assertTrue(np.array_equal(par[1][1], samp[1][1]))
+
+        self.assertRaises(ValueError, self.pat4.sar_sample, ('x', 'y'),
+                                                            [(4, 1)], crit)
+
+    def test_spatial_index(self):
+
+        # Rectangle and radius queries match a brute force search
+        rand = np.random.RandomState(0)
+        x = rand.uniform(0, 10, 500)
+        y = rand.uniform(0, 5, 500)
+        index = SpatialIndex(x, y, leaf_size=4)
+        for x0, x1, y0, y1 in [(0, 10, 0, 5), (2.5, 3, 1, 4), (9, 20, -1, .5),
+                                                               (3, 3, 0, 5)]:
+            rows = index.query_rect(x0, x1, y0, y1)
+            match = np.where((x >= x0) & (x < x1) & (y >= y0) & (y < y1))[0]
+            self.assertTrue(np.array_equal(np.sort(rows), match))
+        for cx, cy, r in [(5, 2.5, 1), (0, 0, 3), (20, 20, 1), (5, 2.5, 20)]:
+            rows = index.query_radius(cx, cy, r)
+            match = np.where((x - cx) ** 2 + (y - cy) ** 2 <= r ** 2)[0]
+            self.assertTrue(np.array_equal(np.sort(rows), match))
+
+        # Inner ranges hold only points in the rectangle
+        inner, edge = index.rect_ranges(1, 9, 1, 4)
+        self.assertTrue(len(inner) > 0)
+        for start, stop in inner:
+            self.assertTrue(np.all((index.x[start:stop] >= 1) &
+                                                (index.x[start:stop] < 9)))
+
+        # Morton codes interleave bits of x (even) and y (odd)
+        self.assertTrue(np.array_equal(morton_code([0, 1, 0, 3], [0, 0, 1, 3]),
+                                                                [0, 1, 2, 15]))
+
+        # Sorting a patch in Morton order gives row ranges, same sads
+        crit = {'spp_code': 'species', 'count': 'count', 'x': 3, 'y': 2}
+        sad = self.pat4.sad(crit)
+        index = self.pat4.build_spatial_index(('x', 'y'))
+        for this_sad, new_sad in zip(sad, self.pat4.sad(crit)):
+            self.assertTrue(np.array_equal(this_sad[1], new_sad[1]))
+        table = self.pat4.data_table.table
+        inner, edge = index.rect_ranges(0, 3, 0, 2)
+        self.assertTrue(np.sum(inner[:, 1] - inner[:, 0]) == len(table))
+        rows = index.query_rect(0, 1, 0, 2)
+        self.assertTrue(np.array_equal(np.sort(rows), np.where(table['x'] <
+                                                                    1)[0]))
+
+    def test_comm(self):
+
+        # Shared species match sets of species in each cell from sad, also
+        # where most pairs of cells share no species
+        crit = {'spp_code': 'species', 'count': 'count'}
+        comm = self.pat2.comm(('x', 'y'), [(2, 2), (1, 1), (4, 4)], crit)
+        self.assertTrue(len(comm[0]) == 6)
+        self.assertTrue(len(comm[2]) == 120)
+        for div, div_comm in [(2, comm[0]), (4, comm[2])]:
+            sad = self.pat2.sad({'spp_code': 'species', 'count': 'count',
+                                                        'x': div, 'y': div})
+            spp = [set(cell[2][cell[1] > 0]) for cell in sad]
+            for row in div_comm:
+                set1 = spp[row['cell1']]
+                set2 = spp[row['cell2']]
+                self.assertTrue(row['shared'] == len(set1 & set2))
+                if len(set1) + len(set2) > 0:
+                    self.assertTrue(np.round(row['sorensen'], 6) ==
+                        np.round(2 * len(set1 & set2) / (len(set1) +
+                                                        len(set2)), 6))
+        self.assertTrue(set(np.round(comm[0]['dist'], 6)) == {1,
+                                                        np.round(np.sqrt(2), 6)})
+        self.assertTrue(len(comm[1]) == 0)
+
+        # Centers of cells
+        centers = self.pat2.get_sp_centers(('x', 'y'), {'x': 2, 'y': 2})
+        self.assertTrue(set(map(tuple, centers)) == {(.5, .5), (.5, 1.5),
+                                                        (1.5, .5), (1.5, 1.5)})
+
+    def test_append(self):
+
+        crit = {'spp_code': 'species', 'count': 'count', 'x': 2, 'y': 2}
+        crit_rep = {'spp_code': 'species', 'count': 'count', 'reptile':
+                                                                    'split'}
+        before = self.pat2.sad(crit)
+        self.pat7.sad(crit_rep)
+
+        # New species and records in existing cells update cached sads
+        new = np.rec.fromrecords([('eee', 1, 1, 2), ('a', 0, 0, 5)],
+                                            names='spp_code,x,y,count')
+        self.assertTrue(self.pat2.append(new) == 2)
+        self.assertTrue('sxc' in [key[0] for key in self.pat2._cache])
+        after = self.pat2.sad(crit)
+        self.assertTrue(np.array_equal(after[0][2], ['a', 'b', 'c', 'd',
+                                                                    'eee']))
+        for this_before, this_after in zip(before, after):
+            self.assertTrue(this_before[0] == this_after[0])
+        self.assertTrue(np.array_equal(after[0][1], [6, 1, 0, 3, 0]))
+        self.assertTrue(np.array_equal(after[3][1], [0, 1, 3, 1, 2]))
+        self.assertTrue(self.pat2.sar(('x', 'y'), [(1, 1)], {'spp_code':
+                                'species', 'count': 'count'})[0]['items'] == 5)
+
+        # New level of a split column invalidates its combinations
+        new = np.rec.fromrecords([('a', 0, 0, 1, 'crocodile')],
+                                        names='spp_code,x,y,count,reptile')
+        self.pat7.append(new)
+        sad = self.pat7.sad(crit_rep)
+        self.assertTrue(len(sad) == 5)
+        self.assertTrue(sad[4][0]['reptile'] == ('==', 'crocodile'))
+        self.assertTrue(np.array_equal(sad[4][1], [1, 0, 0, 0]))
+
+        # Records outside the permanent subset are not appended
+        pat = Patch('xyfile6.csv', {'spp_code': ('!=', 'a')})
+        self.assertTrue(pat.append(new[['spp_code', 'x', 'y', 'count']]) == 0)
+
+    def test_append_after_eviction(self):
+
+        # Species list and levels dropped from a small cache still grow
+        crit = {'spp_code': 'species', 'count': 'count', 'reptile': 'split'}
+        pat = Patch('xyfile11.csv')
+        pat.data_table.meta = self.xymeta11
+        pat.sad(crit)
+        pat.sad(crit)
+        pat.cache_limit = sum(size for key, (value, size) in
+                    pat._cache.items() if key[0] in ('cells', 'parse', 'sxc'))
+        pat.parse_criteria({'count': 'count'})
+        self.assertTrue(('species', 'spp_code') not in pat._cache)
+        self.assertTrue(('levels', 'reptile') not in pat._cache)
+        pat.cache_limit = 2**28
+
+        new = np.rec.fromrecords([('eee', 0, 0, 2, 'crocodile')],
+                                        names='spp_code,x,y,count,reptile')
+        pat.append(new)
+        sad = pat.sad(crit)
+        self.assertTrue(len(sad) == 5)
+        self.assertTrue(np.array_equal(sad[4][2][-1], 'eee'))
+        self.assertTrue(np.array_equal(sad[4][1], [0, 0, 0, 0, 2]))
+
+    def test_o_ring(self):
+
+        ring_file = open('ring_file.csv', 'w')
+        ring_file.write('''spp_code, x, y, count
+a, 0, 0, 1
+a, 1, 0, 1
+a, 0, 3, 2
+b, 0, 1, 1
+c, 1, 1, 0''')
+        ring_file.close()
+        pat = Patch('ring_file.csv')
+        pat.data_table.meta = {('x', 'minimum'): 0, ('x', 'maximum'): 3,
+                ('x', 'precision'): 1, ('y', 'minimum'): 0, ('y', 'maximum'):
+                3, ('y', 'precision'): 1}
+        os.remove('ring_file.csv')
+
+        edges = [0, 1.5, 3.5]
+        ring_area = np.pi * np.array([1.5 ** 2, 3.5 ** 2 - 1.5 ** 2])
+        crit = {'spp_code': 'species', 'count': 'count'}
+        ring = pat.o_ring(('x', 'y'), edges, crit)
+        self.assertTrue(set(ring[0][1].keys()) == {'a', 'b'})
+        stats = ring[0][1]['a']
+        self.assertTrue(np.array_equal(stats['r'], [.75, 2.5]))
+        self.assertTrue(np.array_equal(stats['pairs'], [2, 8]))
+        self.assertTrue(np.allclose(stats['o_ring'], [2, 8] / (4 *
+                                                                ring_area)))
+        self.assertTrue(np.allclose(stats['g'], stats['o_ring'] / (4 / 16)))
+        self.assertTrue(np.array_equal(ring[0][1]['b']['pairs'], [0, 0]))
+
+        # Pairs of species
+        ring = pat.o_ring(('x', 'y'), edges, crit, pairs=[('a', 'b'),
+                                                                ('a', 'c')])
+        self.assertTrue(set(ring[0][1].keys()) == {'a', 'b', ('a', 'b')})
+        stats = ring[0][1][('a', 'b')]
+        self.assertTrue(np.array_equal(stats['pairs'], [2, 2]))
+        self.assertTrue(np.allclose(stats['g'], [2, 2] / (4 * ring_area) /
+                                                                    (1 / 16)))
+        ring = pat.o_ring(('x', 'y'), edges, crit, pairs='all')
+        self.assertTrue(len(ring[0][1]) == 4)
+
+        # Species of different sizes and counts match a brute-force count
+        np.random.seed(7)
+        spp = np.array(['s01'] * 40 + ['s02'] * 15)
+        xy = np.random.randint(0, 10, (len(spp), 2))
+        count = np.random.randint(1, 4, len(spp))
+        ring_file = open('ring_file.csv', 'w')
+        ring_file.write('spp_code, x, y, count\n')
+        for row in zip(spp, xy[:, 0], xy[:, 1], count):
+            ring_file.write('%s, %d, %d, %d\n' % row)
+        ring_file.close()
+        pat = Patch('ring_file.csv')
+        pat.data_table.meta = {('x', 'minimum'): 0, ('x', 'maximum'): 9,
+                ('x', 'precision'): 1, ('y', 'minimum'): 0, ('y', 'maximum'):
+                9, ('y', 'precision'): 1}
+        os.remove('ring_file.csv')
+
+        edges = [0, 2, 4.5, 8]
+        ring = pat.o_ring(('x', 'y'), edges, crit, pairs='all')
+        for focal, other in [('s01', 's01'), ('s01', 's02'), ('s02', 's01')]:
+            dist = np.sqrt(np.sum((xy[spp == focal][:, None] -
+                                   xy[spp == other][None]) ** 2, axis=2))
+            wts = count[spp == focal][:, None] * count[spp == other][None]
+            brute = [np.sum(wts[(dist > lo) & (dist <= hi)]) for lo, hi in
+                                                zip(edges[:-1], edges[1:])]
+            key = focal if focal == other else (focal, other)
+            self.assertTrue(np.array_equal(ring[0][1][key]['pairs'], brute))
+
+    def test_sta(self):
+
+        sta_file = open('sta_file.csv', 'w')
+        sta_file.write('''year, spp_code, x, y, count
+2000, a, 0, 0, 1
+2000, b, 1, 0, 2
+2001, a, 0, 0, 1
+2001, c, 0, 0, 4
+2001, b, 1, 0, 0''')
+        sta_file.close()
+        pat = Patch('sta_file.csv')
+        pat.data_table.meta = {('x', 'minimum'): 0, ('x', 'maximum'): 1,
+                ('x', 'precision'): 1, ('y', 'minimum'): 0, ('y', 'maximum'):
+                0, ('y', 'precision'): 1}
+        os.remove('sta_file.csv')
+
+        sta = pat.sta('year', ('x', 'y'), [(2, 1), (1, 1)], {'spp_code':
+                                                'species', 'count': 'count'})
+        self.assertTrue(np.array_equal(sta['items'], [1, 1.5, 2, 3]))
+        self.assertTrue(np.array_equal(sta['area'], [1, 1, 2, 2]))
+        self.assertTrue(np.array_equal(sta['time'], [1, 2, 1, 2]))
+
+        # Census tensor gives sads, sars, turnover and species-time
+        tensor = pat.census_tensor('year', ('x', 'y'), (2, 1), {'spp_code':
+                                                'species', 'count': 'count'})
+        self.assertTrue(tensor.shape == (2, 2, 3))
+        sad = tensor.sad()
+        self.assertTrue(sad[0][0] == 2000)
+        self.assertTrue(np.array_equal(sad[0][1], [1, 2, 0]))
+        self.assertTrue(np.array_equal(sad[1][1], [1, 0, 4]))
+
+        sar = tensor.sar([(1, 1), (2, 1)], form='both')
+        self.assertTrue(np.array_equal(sar[0][1]['items'], [2, 1]))
+        self.assertTrue(np.array_equal(sar[0][1]['area'], [2, 1]))
+        self.assertTrue(np.array_equal(sar[1][2][1], [[2, 0], [2, 0]]))
+        self.assertTrue(np.array_equal(sar[0][2][1], [[1, 1], [1, 1]]))
+        self.assertRaises(ValueError, tensor.sar, [(3, 1)])
+
+        turn = tensor.turnover()
+        self.assertTrue(list(turn[0]) == [2000, 2001, 1, 1, 1])
+        self.assertTrue(np.array_equal(tensor.species_time(), [2, 3]))
+
+    def test_pack_presence(self):
+
+        # Popcount of packed sets gives richness of cells and their unions
+        rand = np.random.RandomState(0)
+        flat_sad = rand.poisson(.5, (100, 7))
+        packed = pack_presence(flat_sad)
+        self.assertTrue(packed.shape == (7, 13))
+        self.assertTrue(np.array_equal(popcount(packed),
+                                                np.sum(flat_sad > 0, axis=0)))
+        self.assertTrue(popcount(packed[0] | packed[1]) ==
+                            np.sum((flat_sad[:, 0] + flat_sad[:, 1]) > 0))
+        self.assertTrue(popcount(packed[0] & packed[1]) ==
+                            np.sum((flat_sad[:, 0] > 0) & (flat_sad[:, 1] > 0)))
+
+        # Species found in only one cell
+        once = np.sum(flat_sad > 0, axis=1) == 1
+        self.assertTrue(np.array_equal(popcount(packed &
+            single_presence(packed)), np.sum((flat_sad > 0) & once[:,
+                                                    np.newaxis], axis=0)))
+
+    def test_rarefaction(self):
+
+        # Manual check: sad (1, 1, 2), n = 2 gives 1/2 + 1/2 + 5/6
+        rare = rarefy([1, 0, 1, 2], [0, 1, 2, 4])
+        self.assertTrue(np.allclose(rare, [0, 1, 1 + 5 / 6, 3]))
+        self.assertRaises(ValueError, rarefy, [1, 2], 4)
+
+        # Large N does not overflow and full sample gives S
+        rare = rarefy([10**6, 1, 5000], [1, 10**5, 10**6 + 5001])
+        self.assertTrue(np.allclose(rare[[0, 2]], [1, 3]))
+        self.assertTrue(np.all(np.isfinite(rare)))
+
+        # Patch rarefaction of each combination ends at its S
+        rare = self.pat2.rarefaction({'spp_code': 'species', 'count':
+                                                            'count', 'x': 2})
+        sad = self.pat2.sad({'spp_code': 'species', 'count': 'count', 'x': 2})
+        for this_rare, this_sad in zip(rare, sad):
+            self.assertTrue(this_rare[0] == this_sad[0])
+            self.assertTrue(this_rare[1][-1] == np.sum(this_sad[1]))
+            self.assertTrue(np.allclose(this_rare[2][-1],
+                                                    np.sum(this_sad[1] > 0)))
+        rare = self.pat2.rarefaction({'spp_code': 'species', 'count':
+                                                    'count'}, n_samples=[1])
+        self.assertTrue(np.allclose(rare[0][2], [1]))
+
+    def test_ssad_summary(self):
+
+        # Statistics match those of the ssads at each division
+        crit = {'spp_code': 'species', 'count': 'count'}
+        summary = self.pat2.ssad_summary(('x', 'y'), [(1, 1), (2, 2)], crit)
+        self.assertTrue(len(summary) == 8)
+        self.assertTrue(np.array_equal(summary['cells'], [1] * 4 + [4] * 4))
+        self.assertTrue(np.array_equal(summary['area'], [4] * 4 + [1] * 4))
+
+        ssad = self.pat2.ssad({'spp_code': 'species', 'count': 'count', 'x':
+                                                                2, 'y': 2})[1]
+        for row in summary[4:]:
+            cells = ssad[row['species']]
+            self.assertTrue(row['abundance'] == np.sum(cells))
+            self.assertTrue(row['occupancy'] == np.mean(cells > 0))
+            self.assertTrue(np.allclose(row['var'], np.var(cells)))
+            self.assertTrue(np.allclose(row['vmr'], np.var(cells) /
+                                                            np.mean(cells)))
+            self.assertTrue(np.allclose(row['morisita'], 4 * np.sum(cells *
+                            (cells - 1)) / (np.sum(cells) * (np.sum(cells) -
+                            1))))
+
+        # Manual check: species b is in cells (1, 4, 0, 1)
+        row = summary[5]
+        self.assertTrue(row['species'] == 'b')
+        self.assertTrue(row['occupancy'] == .75)
+        self.assertTrue(np.allclose(row['morisita'], 4 * 12 / 30))
+
     def test_ssad(self):
-        
+
         # Check that ssad does not lose any individuals
         ssad = self.pat2.ssad({'spp_code': 'species', 'count': 'count'})
         sad = self.pat2.sad({'spp_code': 'species', 'count': 'count'})
@@ -387,6 +871,15 @@ d, 1, 1, 1, snake''')
                         'mass' : 'mass', 'energy' : 'energy'}, normalize=False)
         self.assertTrue(np.array_equal(eng[0][1], np.array([.5,.5,2,3,4,5])))
 
+        # Test weighted ied is not expanded but keeps counts as weights
+        eng = self.pat5.ied({'spp_code': 'species', 'count': 'count',
+                        'energy': 'energy'}, normalize=False, weighted=True)
+        self.assertTrue(np.array_equal(eng[0][1]['value'],
+                                                    np.array([.5,2,3,4,5])))
+        self.assertTrue(np.array_equal(eng[0][1]['weight'],
+                                                    np.array([2,1,1,1,1])))
+        self.assertTrue(len(eng[0][2]) == 5)
+
     def test_sed(self):
 
         # Check correct result
@@ -402,5 +895,54 @@ d, 1, 1, 1, snake''')
         self.assertTrue(np.array_equal(eng[1][1]['rty'], np.array([1])))
         self.assertTrue(len(eng[1][1]) == 2)
 
+        # Check weighted sed matches the expanded results
+        eng = self.pat5.sed({'spp_code': 'species', 'count': 'count',
+                            'energy': 'energy'}, weighted=True)
+        self.assertTrue(np.array_equal(eng[0][1]['grt']['value'],
+                                                    np.array([1,4,6])))
+
+    def test_ased(self):
+
+        # Check means and that species without individuals are dropped
+        ased = self.pat5.ased({'spp_code': 'species', 'count': 'count',
+                            'energy': 'energy'}, normalize=False)
+        self.assertTrue(np.allclose(ased[0][1], np.array([1.5, 4.5])))
+        self.assertTrue(np.array_equal(ased[0][2], np.array(['grt', 'rty'])))
+        ased = self.pat5.ased({'spp_code': 'species', 'count': 'count',
+                            'energy': 'energy', 'x': 2}, normalize=False)
+        self.assertTrue(np.array_equal(ased[1][2], np.array(['rty'])))
+
+    def test_encode(self):
+        crit = {'spp_code': 'species', 'count': 'count', 'energy': 'energy',
+                'x': 2}
+        pat = Patch('xyfile9.csv', encode=['spp_code'])
+        pat.data_table.meta = self.xymeta9
+        self.assertEqual(pat.data_table.table['spp_code'].dtype, np.int32)
+
+        # Results give species, not codes
+        for enc, plain in zip(pat.sad(crit), self.pat5.sad(crit)):
+            self.assertTrue(np.array_equal(enc[1], plain[1]))
+            self.assertTrue(np.array_equal(enc[2], plain[2]))
+        for enc, plain in zip(pat.ied(crit), self.pat5.ied(crit)):
+            self.assertTrue(np.array_equal(enc[2], plain[2]))
+        eng = pat.sed(crit)
+        self.assertTrue(np.array_equal(eng[1][1]['rty'], np.array([1])))
+        ased = pat.ased(crit, normalize=False)
+        self.assertTrue(np.array_equal(ased[1][2], np.array(['rty'])))
+
+        # Patches sharing a vocabulary share codes
+        pat2 = Patch('xyfile9.csv', {'spp_code': ('==', 'rty')},
+                     encode=['spp_code'], vocabulary=pat.data_table.vocabulary)
+        pat2.data_table.meta = self.xymeta9
+        code = pat.data_table.vocabulary.codes['rty']
+        self.assertTrue(np.all(pat2.data_table.table['spp_code'] == code))
+        pat2.append('xyfile9.csv')
+        self.assertTrue(np.array_equal(pat2.sad(crit)[0][2], ['rty']))
+
+    def test_group_by_species(self):
+        order, groups = group_by_species(np.array(['b', 'a', 'b', 'a', 'c']))
+        self.assertTrue(np.array_equal(order, np.array([1, 3, 0, 2, 4])))
+        self.assertTrue(groups['a'] == (0, 2) and groups['c'] == (4, 5))
+
 
 
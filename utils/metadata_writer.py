@@ -9,6 +9,7 @@ metadata
 
 import xml.etree.ElementTree as ET
 import os
+from macroeco.data import clear_metadata_cache, index_attributes
 
 sub = ET.SubElement
 
@@ -109,6 +110,15 @@ class MetaWriter:
         self.numberOfRecords = sub(self.dataTable, 'numberOfRecords')
         self.numberOfRecords.text = "Unknown"
 
+        # Attribute element of each column, indexed as by macroeco.data
+        self.index = index_attributes(self.root)
+
+    def _attributes(self, name):
+        '''Returns a list of the attribute element of column name, if any.'''
+        if name in self.index:
+            return [self.index[name]['element']]
+        return []
+
     def add_attribute_types(self, typelist):
         '''
         Sets the type of the attribute to either ordinal (categorical) or
@@ -129,7 +139,7 @@ class MetaWriter:
         '''
 
         for item in typelist:
-            for attribute in self.attributes:
+            for attribute in self._attributes(item[0]):
                 tree = ET.ElementTree(attribute)
                 att = tree.findall('attributeName')[0]
                 if (att.text == item[0]):
@@ -203,7 +213,7 @@ class MetaWriter:
         '''
 
         for item in traitlist:
-            for attribute in self.attributes:
+            for attribute in self._attributes(item[0]):
                 tree = ET.ElementTree(attribute)
                 child = tree.findall('attributeName')[0]
                 if child.text == item[0]:
@@ -274,15 +284,19 @@ class MetaWriter:
         Writes out the xml tree that is contained in self.root and saves and
         .xml file in the currect working directory under the given filename. If
         no name is given save the xml as the same name as the input file.
+        Parsed metadata of the file cached by macroeco.data is cleared.
 
         
         '''
         
         tree = ET.ElementTree(self.root)
         if name == None:
-            tree.write(self.filename + '.xml')
-        else:
-            tree.write(name + '.xml')
+            name = self.filename
+        tree.write(name + '.xml')
+
+        # Metadata objects must not use the old file, even if unchanged in
+        # size and modification time
+        clear_metadata_cache(name + '.xml')
 
                 
 
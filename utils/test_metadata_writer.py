@@ -3,6 +3,7 @@
 
 import unittest
 from metadata_writer import *
+from macroeco.data import Metadata
 import numpy as np
 import xml.etree.ElementTree as ET
 
@@ -115,7 +116,22 @@ class TestMetadataWriter(unittest.TestCase):
         mt.attributes[ind].findall('./measurementScale/interval/numericDomain/bounds/maximum')
         self.assertTrue(maybe[0].text == "5")
 
-         
+    def test_write_clears_metadata_cache(self):
+        mt = MetaWriter('meta1.csv')
+        mt.add_attribute_types([('row', {'cat' : False})])
+        mt.add_attribute_traits([('row', {'precision' : 1})])
+        mt.write_meta_data()
+        self.assertEqual(Metadata('meta1.csv', []).get_value('row',
+                                                            'precision'), 1)
+
+        # Same size and time, but a new file
+        mt.add_attribute_traits([('row', {'precision' : 2})])
+        stat = os.stat('meta1.xml')
+        mt.write_meta_data()
+        os.utime('meta1.xml', (stat.st_atime, stat.st_mtime))
+        self.assertEqual(Metadata('meta1.csv', []).get_value('row',
+                                                            'precision'), 2)
+        os.remove('meta1.xml')
 
 if __name__ == '__main__':
     unittest.main()
@@ -14,7 +14,7 @@ Classes
 import xml.etree.ElementTree as etree
 import sys, os, logging
 import matplotlib.pyplot as plt
-from macroeco.data import Metadata
+from macroeco.data import Metadata, Vocabulary
 
 
 paramfile = 'parameters.xml'  # Parameter file found in output dir
@@ -37,6 +37,9 @@ class Workflow:
         Whether to log to console in addition to file, False by default
     short_output_name : bool
         Whether to use the run-name alone to name output. False by default.
+    cache : bool
+        Whether the patches of the script keep a binary cache of each parsed
+        csv table, so reruns of the workflow skip parsing. False by default.
         
     Attributes
     ----------
@@ -48,16 +51,27 @@ class Workflow:
         Whether the script can pause for user interaction
     runs : dict
         If parameters are needed, sets of parameter values are named runs
+    vocabulary : Vocabulary
+        Vocabulary shared by the datasets of the current run, to be passed to
+        Patch to encode species columns with codes that match between
+        datasets. A new vocabulary is made for each run. Workflow does not
+        make the patches, so a script shares it by passing it itself, eg,
+        Patch(data_path, encode=['spp'], vocabulary=wf.vocabulary).
+    cache : bool
+        Whether to keep binary caches of parsed csv tables, to be passed to
+        Patch in the same way, eg, Patch(data_path, cache=wf.cache).
     '''
 
     def __init__(self, required_params={}, optional_params={},
-                 clog=False, svers=None, short_output_name=False):
+                 clog=False, svers=None, short_output_name=False,
+                 cache=False):
 
         # Store script name from command line call
         script_path, script_extension = os.path.splitext(sys.argv[0])
         self.script_name = os.path.split(script_path)[-1]
         self.script_vers = svers
         self.short_output_name = short_output_name
+        self.cache = cache
 
         # Store output directory path - contains params file, log, results
         # TODO: Make more robust to non-absolute path entries
@@ -96,6 +110,7 @@ class Workflow:
         self.parameters = Parameters(self.script_name, self.script_vers,
                                      required_params, optional_params)
         self.interactive = self.parameters.interactive
+        self.vocabulary = Vocabulary()
 
         
     def single_datasets(self):
@@ -131,6 +146,9 @@ class Workflow:
                 self.parameters.data_path[run_name] = ['']
             else:
                 make_map(self.parameters.data_path[run_name], run_name)
+
+            # Codes of encoded columns are shared by the datasets of the run
+            self.vocabulary = Vocabulary()
                 
             # Loop through each dataset and yield values for dataset and run
             for data_path in self.parameters.data_path[run_name]:
@@ -178,6 +196,9 @@ class Workflow:
             else:
                 make_map(self.parameters.data_path[run_name], run_name)
 
+            # Codes of encoded columns are shared by the datasets of the run
+            self.vocabulary = Vocabulary()
+
             abs_data_paths = [os.path.abspath(os.path.join(self.output_path,
                              data_path)) for data_path in self.parameters.
                              data_path[run_name]]